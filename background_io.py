@@ -0,0 +1,199 @@
+"""Overlaps reading input files, and encoding/writing output images, with the work on each image.
+
+A reader thread reads the next few input files into memory while the current image is
+    being worked on, and a small pool of writer threads encodes and saves the finished
+    images while the next ones are being worked on.
+Pillow lets go of the GIL while it decodes, encodes and transforms images, so these
+    threads really do run alongside each other.
+"""
+import os
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional, Union
+
+from constants import *
+from instrumentation import timed
+
+#Put in the read-ahead queue once every job has been read
+END_OF_JOBS = object()
+
+#How long (in seconds) the reader waits for space in the queue before checking if it should stop
+READER_POLL_INTERVAL = 0.1
+
+
+class QueueDepths(NamedTuple):
+    """How far ahead input files are read, and how many finished images can wait to be saved"""
+    #None to decide by where the images are worked on (see get_read_ahead())
+    read_ahead : Optional[int] = None
+    writer_threads : int = DEFAULT_WRITER_THREADS
+    write_queue : int = DEFAULT_WRITE_QUEUE
+
+    def get_read_ahead(self, _num_jobs : int) -> int:
+        """
+        Returns how many files to read ahead of the images being worked on by _num_jobs
+            processes (just this process if it's 1).
+        Unless read_ahead was given, that's DEFAULT_READ_AHEAD for this process, and none
+            for a pool, whose workers each read their own files while the others work.
+        """
+        if self.read_ahead is not None:
+            return self.read_ahead
+        return DEFAULT_READ_AHEAD if _num_jobs == 1 else 0
+
+
+def prefetch_files(_jobs : Iterable[tuple], _read_ahead : int, \
+    _should_read : Optional[Callable[[str], bool]] = None) \
+    -> Iterator[tuple[tuple, Union[bytes, OSError, None]]]:
+    """
+    Yields each of _jobs (tuples whose first item is an input file path), along with the
+        contents of that file, which a background thread reads up to _read_ahead files early.
+    TIFFs aren't read ahead, and are yielded with None in place of their contents,
+        as are any files for which _should_read (if given) returns False.
+    If a file can't be read, the error is yielded in place of its contents, so that
+        its job can fail in the usual way.
+    _jobs is taken from in the background thread too, so any generators behind it
+        are run there.
+    """
+    file_queue = queue.Queue(maxsize=max(1, _read_ahead))
+    stopping = threading.Event()
+    reader = threading.Thread(target=read_ahead, args=(_jobs, file_queue, stopping, \
+        _should_read), name="reader", daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            item = file_queue.get()
+            if item is END_OF_JOBS:
+                break
+            #Taking the jobs themselves failed, rather than reading one of their files
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    #Also stops the reader if the files stop being taken before they have all been read
+    finally:
+        stopping.set()
+        reader.join()
+
+
+def read_ahead(_jobs : Iterable[tuple], _file_queue : queue.Queue, \
+    _stopping : threading.Event, _should_read : Optional[Callable[[str], bool]] = None) -> None:
+    """
+    Reads the input file of each of _jobs into _file_queue, followed by END_OF_JOBS
+        (or the error which stopped the jobs being taken), until _stopping is set.
+    Files which aren't read (see prefetch_files()) are put in the queue as None.
+    """
+    jobs = iter(_jobs)
+    try:
+        for job in jobs:
+            #TIFF scans are usually too big to hold several of, and are read a strip at a
+            #   time where possible, so are left to be read by their job (see tiff_strips.py)
+            if os.path.splitext(job[0])[1].lower() in TIFF_EXTENSIONS or \
+                (_should_read is not None and not _should_read(job[0])):
+                contents = None
+            else:
+                try:
+                    with timed("read"), open(job[0], "rb") as input_file:
+                        contents = input_file.read()
+                except OSError as error:
+                    contents = error
+            if not put_unless_stopping(_file_queue, (job, contents), _stopping):
+                return
+        put_unless_stopping(_file_queue, END_OF_JOBS, _stopping)
+    except Exception as error: #pylint: disable=broad-except
+        put_unless_stopping(_file_queue, error, _stopping)
+    finally:
+        #Generators are closed in the thread that ran them (e.g., for their SQLite connections)
+        if hasattr(jobs, "close"):
+            jobs.close()
+
+
+def put_unless_stopping(_queue : queue.Queue, _item : Any, _stopping : threading.Event) -> bool:
+    """
+    Puts _item in _queue, waiting for there to be space unless _stopping is set first.
+    Returns whether _item was put in the queue.
+    """
+    while not _stopping.is_set():
+        try:
+            _queue.put(_item, timeout=READER_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+class BackgroundWriter:
+    """
+    Runs functions which save finished images (i.e., encode and write them) on a pool
+        of threads, so that the next image can be worked on in the meantime.
+    At most _write_queue functions can be waiting or running at once; submit() waits
+        for the oldest to finish when there are that many, which keeps the number of
+        finished images held in memory down.
+    Functions submitted to a single thread run in the order they were submitted.
+
+    e.g.,
+        with BackgroundWriter(2, 4) as writer:
+            writer.submit(job, save_image, image_object, output_path)
+            for job, future in writer.take_finished():
+                ...
+    """
+    def __init__(self, _writer_threads : int, _write_queue : int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max(1, _writer_threads), \
+            thread_name_prefix="writer")
+        self.write_queue = max(1, _write_queue)
+        self.pending = deque()
+        self.finished = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Waits for every submitted function to finish, and stops the writer threads.
+        """
+        self.executor.shutdown(wait=True)
+
+    def submit(self, _key : Any, _function : Callable, *_arguments) -> None:
+        """
+        Calls _function with _arguments in a writer thread.
+        Its future will be given back by take_finished() alongside _key.
+        """
+        while len(self.pending) >= self.write_queue:
+            key, future = self.pending.popleft()
+            future.exception()
+            self.finished.append((key, future))
+
+        self.pending.append((_key, self.executor.submit(_function, *_arguments)))
+
+    def take_oldest(self) -> tuple[Any, Future]:
+        """
+        Waits for the oldest submitted function which hasn't been taken yet to finish,
+            and returns its (key, future).
+        """
+        if self.finished:
+            return self.finished.pop(0)
+
+        key, future = self.pending.popleft()
+        future.exception()
+        return key, future
+
+    def take_finished(self, _wait : bool = False) -> list[tuple[Any, Future]]:
+        """
+        Returns the (key, future) of every submitted function which has finished since
+            this was last called, in the order they were submitted.
+        If _wait is True, waits for all of them to finish first.
+        """
+        while self.pending and (_wait or self.pending[0][1].done()):
+            key, future = self.pending.popleft()
+            future.exception()
+            self.finished.append((key, future))
+
+        finished, self.finished = self.finished, []
+        return finished
+
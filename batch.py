@@ -0,0 +1,324 @@
+"""Runs per-image work for a batch of images, optionally spread over a pool of processes"""
+import contextlib
+import multiprocessing
+import os
+import signal
+import traceback
+
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from background_io import BackgroundWriter, QueueDepths, prefetch_files
+from constants import *
+import instrumentation
+from memory_budget import MemoryBudget
+
+#Process pools which are kept running between batches (see keep_pools_warm()),
+#   by their number of processes
+WARM_POOLS = {}
+KEEP_POOLS_WARM = False
+
+class JobFailure(NamedTuple):
+    """An input image which could not be processed, and the reason why"""
+    input_path : str
+    message : str
+
+
+def default_num_jobs() -> int:
+    """
+    Returns the number of worker processes to use when the user hasn't asked for a specific amount.
+    """
+    return os.cpu_count() or 1
+
+
+def default_num_threads() -> int:
+    """
+    Returns the number of threads to split the work on a single image between.
+    Within a worker process of a batch, that's just the one, as the batch's processes are
+        already using every core.
+    """
+    if multiprocessing.parent_process() is not None:
+        return 1
+    return default_num_jobs()
+
+
+def keep_pools_warm(_keep_warm : bool = True) -> None:
+    """
+    Sets whether the process pools started by run_batch() are kept running once their batch
+        has finished, so that later batches (e.g., those run by service.py) can reuse them
+        rather than starting new processes, which then have to import everything again.
+    Turning it off shuts down every pool that was being kept.
+    """
+    global KEEP_POOLS_WARM
+    KEEP_POOLS_WARM = _keep_warm
+    if not _keep_warm:
+        for executor in WARM_POOLS.values():
+            executor.shutdown(wait=True)
+        WARM_POOLS.clear()
+
+
+@contextlib.contextmanager
+def open_process_pool(_num_jobs : int) -> Iterator[ProcessPoolExecutor]:
+    """
+    Yields a pool of _num_jobs processes to run one batch on.
+    The pool is shut down once the batch has finished, unless pools are being kept warm,
+        in which case the pool kept from an earlier batch is reused if it still works.
+    """
+    if not KEEP_POOLS_WARM:
+        with ProcessPoolExecutor(max_workers=_num_jobs) as executor:
+            yield executor
+        return
+
+    executor = WARM_POOLS.get(_num_jobs)
+    if executor is not None:
+        try:
+            #Fails straight away if one of its processes has died since the last batch
+            executor.submit(int).result()
+        except BrokenProcessPool:
+            executor.shutdown(wait=True)
+            executor = None
+    if executor is None:
+        executor = WARM_POOLS[_num_jobs] = ProcessPoolExecutor(max_workers=_num_jobs, \
+            initializer=ignore_interrupts)
+    yield executor
+
+
+def ignore_interrupts() -> None:
+    """
+    Stops Ctrl+C from interrupting this (worker) process, which is instead shut down by
+        the main process once it has stopped, rather than in the middle of waiting for work.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_job(_worker : Callable, _job : tuple, _keyword_arguments : Optional[dict] = None) \
+    -> Optional[str]:
+    """
+    Calls _worker with the arguments in _job (and any _keyword_arguments), and returns None
+        if it succeeded, or a description of the error if it didn't.
+    Errors are turned into strings here so that they always make it back from a worker process.
+    """
+    try:
+        _worker(*_job, **(_keyword_arguments or {}))
+    except Exception as error: #pylint: disable=broad-except
+        debug(traceback.format_exc())
+        return describe_error(error)
+
+    return None
+
+
+def describe_error(_error : BaseException) -> str:
+    """
+    Returns a short description of _error to show the user.
+    """
+    return f"{type(_error).__name__}: {_error}"
+
+
+def run_worker_job(_worker : Callable, _job : tuple, _instrumented : bool, \
+    _keyword_arguments : Optional[dict] = None) -> tuple[Optional[str], Optional[tuple]]:
+    """
+    Does run_job() in a worker process, and also returns the timings recorded while doing it
+        (if _instrumented), so they can be added to the main process's report.
+    """
+    instrumentation.enable(_instrumented)
+
+    #Forget anything copied over from the main process when this process was started
+    instrumentation.take_records()
+    message = run_job(_worker, _job, _keyword_arguments)
+    return message, instrumentation.take_records()
+
+
+def run_batch(_worker : Callable, _jobs : Iterable[tuple], _num_jobs : Optional[int] = None, \
+    _on_success : Optional[Callable[[tuple], None]] = None, \
+    _queue_depths : Optional[QueueDepths] = None, _memory_budget : Optional[MemoryBudget] = None, \
+    _estimate_memory : Optional[Callable[[tuple], int]] = None) -> list[JobFailure]:
+    """
+    Calls _worker once per job, where each job is a tuple of arguments whose first item
+        is the input image path.
+    The jobs are spread over _num_jobs processes (defaulting to the number of cores),
+        or run in this process if only one is wanted.
+    _jobs can be a generator: only a few jobs per process are taken from it at a time,
+        so batches of any size can be run without listing all of their jobs first.
+    A failing job is reported and skipped rather than stopping the rest of the batch.
+    The output paths should already be part of each job, so that they don't depend on
+        the order in which the jobs happen to finish.
+    _on_success, if given, is called (in this process) with each job that succeeds,
+        as soon as it has finished.
+    If _queue_depths is given, each job's input file can be read ahead of time by a background
+        thread (see background_io.prefetch_files()) and given to _worker as _input_data.
+        By default that's only done when the jobs are run in this process: a pool's workers
+        read their own files (see QueueDepths.get_read_ahead()).
+        When the jobs are run in this process, _worker is also given a _defer_save function
+        to hand its finished images to, which saves them on writer threads while the next
+        job is worked on.
+    If _memory_budget is given, jobs are only started while the memory they are expected
+        to need (given by _estimate_memory) fits in it alongside the jobs already started,
+        so that a batch of very big images runs fewer of them at once.
+
+    Returns the list of jobs which failed, in the same order as _jobs.
+    """
+    if _num_jobs is None:
+        _num_jobs = default_num_jobs()
+    if _memory_budget is None:
+        #With no budget to keep to, every job fits
+        _memory_budget, _estimate_memory = MemoryBudget(0), None
+    if _estimate_memory is None:
+        _estimate_memory = lambda _job: 0
+
+    read_ahead = 0 if _queue_depths is None else _queue_depths.get_read_ahead(_num_jobs)
+    if read_ahead > 0:
+        _jobs = prefetch_files(_jobs, read_ahead)
+    else:
+        _jobs = ((job, None) for job in _jobs)
+
+    if _num_jobs == 1:
+        if _queue_depths is not None:
+            return run_overlapped_jobs(_worker, _jobs, _on_success, _queue_depths, \
+                _memory_budget, _estimate_memory)
+
+        #Only one job is worked on at a time, which is as little memory as can be used
+        failures = []
+        for job, _ in _jobs:
+            _estimate_memory(job)
+            message = run_job(_worker, job)
+            report_result(job, message, _on_success)
+            if message is not None:
+                failures.append(JobFailure(job[0], message))
+        return failures
+
+    #Failures are collected alongside their job's position, so they can be put back in order
+    indexed_failures = []
+    with open_process_pool(_num_jobs) as executor:
+        pending_futures = {}
+        for job_index, (job, input_data) in enumerate(_jobs):
+            job_memory = _estimate_memory(job)
+            if isinstance(input_data, OSError):
+                report_result(job, describe_error(input_data), _on_success)
+                indexed_failures.append((job_index, \
+                    JobFailure(job[0], describe_error(input_data))))
+                continue
+
+            #Wait for some of the jobs to finish if there are already plenty queued up,
+            #   or if this one wouldn't fit in memory alongside them
+            while len(pending_futures) >= _num_jobs * QUEUED_JOBS_PER_PROCESS or \
+                not _memory_budget.fits(job_memory):
+                finished_futures, _ = wait(pending_futures, return_when=FIRST_COMPLETED)
+                indexed_failures += collect_results(finished_futures, pending_futures, \
+                    _on_success, _memory_budget)
+
+            _memory_budget.take(job_memory)
+            pending_futures[executor.submit(run_worker_job, _worker, job, \
+                instrumentation.ENABLED, None if input_data is None else \
+                {"_input_data" : input_data})] = (job_index, job, job_memory)
+
+        indexed_failures += collect_results(list(pending_futures), pending_futures, \
+            _on_success, _memory_budget)
+
+    return [failure for _, failure in sorted(indexed_failures)]
+
+
+def run_overlapped_jobs(_worker : Callable, _jobs : Iterable[tuple[tuple, object]], \
+    _on_success : Optional[Callable[[tuple], None]], _queue_depths : QueueDepths, \
+    _memory_budget : MemoryBudget, _estimate_memory : Callable[[tuple], int]) \
+    -> list[JobFailure]:
+    """
+    Runs each of the (job, input file contents) in _jobs in this process, while the
+        images each job hands to its _defer_save function are saved on writer threads.
+    A job has only succeeded once all of its images have been saved, so its memory
+        is counted against _memory_budget until then.
+    Returns the list of jobs which failed, in the same order as _jobs.
+    """
+    failures = []
+    with BackgroundWriter(_queue_depths.writer_threads, _queue_depths.write_queue) as writer:
+        for job, input_data in _jobs:
+            job_memory = _estimate_memory(job)
+            while not _memory_budget.fits(job_memory):
+                failures += report_saved_jobs([writer.take_oldest()], _on_success, \
+                    _memory_budget)
+            _memory_budget.take(job_memory)
+
+            images_to_save = []
+            if isinstance(input_data, OSError):
+                message = describe_error(input_data)
+            else:
+                message = run_job(_worker, job, {"_input_data" : input_data, \
+                    "_defer_save" : lambda *_arguments: images_to_save.append(_arguments)})
+
+            #Every job goes through the writer (even if there's nothing to save),
+            #   so that they are all reported in order
+            writer.submit((job, message, job_memory), save_all, \
+                images_to_save if message is None else [])
+            failures += report_saved_jobs(writer.take_finished(), _on_success, _memory_budget)
+
+        failures += report_saved_jobs(writer.take_finished(_wait=True), _on_success, \
+            _memory_budget)
+
+    return failures
+
+
+def save_all(_images_to_save : list[tuple]) -> None:
+    """
+    Calls each (save function, image, ...) in _images_to_save, closing each image once saved.
+    """
+    for save_function, image_object, *arguments in _images_to_save:
+        with image_object:
+            save_function(image_object, *arguments)
+
+
+def report_saved_jobs(_saved_jobs : list[tuple[tuple, Future]], \
+    _on_success : Optional[Callable[[tuple], None]], _memory_budget : MemoryBudget) \
+    -> list[JobFailure]:
+    """
+    Reports the result of each ((job, error message or None, memory), saving future)
+        in _saved_jobs, and gives the jobs' memory back to _memory_budget.
+    Returns the jobs which failed.
+    """
+    failures = []
+    for (job, message, job_memory), future in _saved_jobs:
+        _memory_budget.give_back(job_memory)
+        if message is None and future.exception() is not None:
+            debug("".join(traceback.format_exception(future.exception())))
+            message = describe_error(future.exception())
+        report_result(job, message, _on_success)
+        if message is not None:
+            failures.append(JobFailure(job[0], message))
+
+    return failures
+
+
+def collect_results(_finished_futures : Iterable, _pending_futures : dict, \
+    _on_success : Optional[Callable[[tuple], None]], _memory_budget : MemoryBudget) \
+    -> list[tuple[int, JobFailure]]:
+    """
+    Takes each of _finished_futures out of _pending_futures (waiting for it if needed),
+        reports its result, and gives its memory back to _memory_budget.
+    Returns the (job index, failure) of each job which failed.
+    """
+    indexed_failures = []
+    for future in _finished_futures:
+        job_index, job, job_memory = _pending_futures.pop(future)
+        _memory_budget.give_back(job_memory)
+        try:
+            message, records = future.result()
+            instrumentation.add_records(records)
+        except BrokenProcessPool as error:
+            #A worker died outright (e.g., it was killed for using too much memory)
+            message = describe_error(error)
+        report_result(job, message, _on_success)
+        if message is not None:
+            indexed_failures.append((job_index, JobFailure(job[0], message)))
+
+    return indexed_failures
+
+
+def report_result(_job : tuple, _message : Optional[str], \
+    _on_success : Optional[Callable[[tuple], None]]) -> None:
+    """
+    Tells the user that _job's input couldn't be processed if there was an error message
+        for it, or passes the job on to _on_success if it worked.
+    """
+    if _message is not None:
+        print(f"Failed to process {_job[0]} ({_message})")
+    elif _on_success is not None:
+        _on_success(_job)
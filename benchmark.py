@@ -0,0 +1,316 @@
+"""Times each of photo_tools.py's commands on a reproducible, synthetic set of film scans.
+
+Should be run as
+    "python benchmark.py [--count N] [--megapixels 2,12,24] [--output results.json]
+        [--compare previous_results.json] [--encoder-profiles]
+        [extra photo_tools.py options, e.g. --jobs 4]"
+
+The synthetic scans are kept (and reused when the same settings are given again) in
+    --corpus-dir, and the results are printed as well as saved to --output as JSON,
+    so that runs can be compared with --compare to catch performance regressions.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+import PIL
+import PIL.ImageOps
+
+from constants import *
+from batch import default_num_threads
+from encoder_profiles import ENCODER_PROFILES
+from negative_engine import invert_negative
+
+#(width, height) ratios of common film and sensor formats
+ASPECT_RATIOS = [(3, 2), (4, 3), (1, 1), (16, 9), (5, 4)]
+
+#EXIF orientations which make a landscape image display as portrait
+PORTRAIT_ORIENTATIONS = [6, 8]
+
+#How much slower (as a fraction) a command has to get before it's reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+CORPUS_SETTINGS_NAME = "corpus.json"
+
+#The commands timed with each encoder profile (see --encoder-profiles), which save JPEGs
+#   like the corpus's
+ENCODER_PROFILE_COMMANDS = [[PADDING_COMMAND, "black"], [NEGATIVE_COMMAND]]
+
+
+def generate_corpus(_corpus_dir : str, _count : int, _megapixels : list[float], \
+    _portrait_fraction : float, _alternative_fraction : float, _seed : int) -> list[str]:
+    """
+    Fills _corpus_dir with _count synthetic scans, with sizes picked from _megapixels
+        and aspect ratios picked from ASPECT_RATIOS.
+    Some are marked as portrait by their EXIF orientation, and some are "alternative takes"
+        (with a 'b' suffix), like a real roll of scanned film.
+    The same arguments always give the same images, so the corpus is reused if it exists.
+    Returns the paths of the images.
+    """
+    settings = {"count" : _count, "megapixels" : _megapixels, "seed" : _seed, \
+        "portrait_fraction" : _portrait_fraction, "alternative_fraction" : _alternative_fraction}
+    settings_path = os.path.join(_corpus_dir, CORPUS_SETTINGS_NAME)
+    if os.path.exists(settings_path):
+        with open(settings_path, encoding="utf-8") as settings_file:
+            if json.load(settings_file) == settings:
+                return sorted(os.path.join(_corpus_dir, name) for name in os.listdir(_corpus_dir) \
+                    if name != CORPUS_SETTINGS_NAME)
+        sys.exit(f"{_corpus_dir} already holds a corpus made with different settings")
+
+    os.makedirs(_corpus_dir, exist_ok=True)
+    randomiser = random.Random(_seed)
+    image_paths = []
+
+    #Start at a non-1 index with gaps, like a scanner which has been used for other reels
+    file_index = randomiser.randint(2, 200)
+    for image_count in range(_count):
+        megapixels = randomiser.choice(_megapixels)
+        ratio_x, ratio_y = randomiser.choice(ASPECT_RATIOS)
+        width = round(math.sqrt(megapixels * 1e6 * ratio_x / ratio_y))
+        height = round(width * ratio_y / ratio_x)
+
+        #The first image can never be an alternative take
+        if image_count > 0 and randomiser.random() < _alternative_fraction:
+            name = f"PICT{file_index:04d}b.JPG"
+        else:
+            file_index += randomiser.randint(1, 3)
+            name = f"PICT{file_index:04d}.JPG"
+
+        exif = Image.Exif()
+        if randomiser.random() < _portrait_fraction:
+            exif[EXIF_ORIENTATION_TAG] = randomiser.choice(PORTRAIT_ORIENTATIONS)
+
+        with make_synthetic_scan((width, height), randomiser) as image_object:
+            image_object.save(os.path.join(_corpus_dir, name), quality=90, exif=exif)
+        image_paths.append(os.path.join(_corpus_dir, name))
+        print(f"Generated {name} ({width}x{height})")
+
+    with open(settings_path, "w", encoding="utf-8") as settings_file:
+        json.dump(settings, settings_file)
+
+    return sorted(image_paths)
+
+
+def make_synthetic_scan(_size : tuple[int,int], _randomiser : random.Random) -> Image.Image:
+    """
+    Makes an image with smooth gradients and grain, which compresses roughly like a film scan.
+    """
+    channels = []
+    for _ in range(3):
+        with Image.linear_gradient("L") as gradient:
+            gradient = gradient.rotate(_randomiser.uniform(0, 360)).resize(_size)
+        with Image.effect_noise(_size, _randomiser.uniform(10, 40)) as grain:
+            channels.append(Image.blend(gradient, grain, 0.3))
+
+    return Image.merge("RGB", channels)
+
+
+def get_benchmark_commands(_num_images : int) -> list[list[str]]:
+    """
+    Returns the photo_tools.py command arguments to time.
+    """
+    #Keep merged grids roughly square
+    grid_size = str(math.ceil(math.sqrt(_num_images)))
+    return [
+        [RENAMING_COMMAND],
+        [PADDING_COMMAND, "black"],
+        [NEGATIVE_COMMAND],
+        [MERGE_COMMAND, grid_size, "row", "row"],
+        [MERGE_COMMAND, grid_size, "column", "column"],
+    ]
+
+
+def time_command(_corpus_dir : str, _command : list[str], _extra_options : list[str], \
+    _input_bytes : int, _num_images : int) -> dict:
+    """
+    Runs photo_tools.py on the corpus with _command, and returns how long it took,
+        how fast it got through the images, its peak memory use, and how big its outputs are
+        (e.g., to compare encoder profiles).
+    """
+    arguments = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        "photo_tools.py"), _corpus_dir, *_command, FORCE_OPTION, *_extra_options]
+
+    start_timestamp = time.time()
+    start_time = time.perf_counter()
+    with subprocess.Popen(arguments, stdout=subprocess.DEVNULL) as process:
+        #wait4 gives the resource usage of just this command (and any workers it waited for)
+        _, status, resource_usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start_time
+
+    #ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak_rss = resource_usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    return {
+        "command" : " ".join(_command),
+        "exit_code" : process.returncode,
+        "seconds" : seconds,
+        "images_per_second" : _num_images / seconds,
+        "megabytes_per_second" : _input_bytes / 1e6 / seconds,
+        "peak_rss_megabytes" : peak_rss / 1e6,
+        "output_megabytes" : get_output_bytes(os.path.normpath(_corpus_dir) + \
+            MAP_COMMAND_TO_SUFFIX[_command[0]], start_timestamp) / 1e6,
+    }
+
+
+def time_inversion(_image_path : str, _repeats : int = 3) -> list[dict]:
+    """
+    Times making the image at _image_path negative with PIL.ImageOps.invert() and with
+        negative_engine.invert_negative(), on one thread and on default_num_threads().
+    Returns the best of _repeats times for each, in milliseconds per megapixel.
+    """
+    with Image.open(_image_path) as image_object:
+        image_object = image_object.convert("RGB")
+    megapixels = image_object.width * image_object.height / 1e6
+
+    num_threads = default_num_threads()
+    results = []
+    for name, invert in [("ImageOps.invert", PIL.ImageOps.invert), \
+        ("invert_negative, 1 thread", lambda _image: invert_negative(_image, None, 1)), \
+        (f"invert_negative, {num_threads} threads", \
+        lambda _image: invert_negative(_image, None, num_threads))]:
+        seconds = []
+        for _ in range(_repeats):
+            start_time = time.perf_counter()
+            invert(image_object)
+            seconds.append(time.perf_counter() - start_time)
+        results.append({"inversion" : name, \
+            "milliseconds_per_megapixel" : min(seconds) * 1000 / megapixels})
+
+    return results
+
+
+def time_encoder_profiles(_corpus_dir : str, _extra_options : list[str], _input_bytes : int, \
+    _num_images : int) -> list[dict]:
+    """
+    Times each of ENCODER_PROFILE_COMMANDS with Pillow's default encoder settings and with
+        each of ENCODER_PROFILES (see time_command()), noting the JPEG settings of each.
+    """
+    results = []
+    for profile in [None, *ENCODER_PROFILE_NAMES]:
+        profile_options = [] if profile is None else [ENCODER_PROFILE_OPTION, profile]
+        settings = ENCODER_PROFILES.get(profile, {}).get("JPEG", {"quality" : 75})
+        for command in ENCODER_PROFILE_COMMANDS:
+            result = time_command(_corpus_dir, command, profile_options + _extra_options, \
+                _input_bytes, _num_images)
+            result.update({"profile" : profile or "default", "settings" : " ".join( \
+                f"{name}={value}" for name, value in settings.items())})
+            results.append(result)
+
+    return results
+
+
+def get_output_bytes(_output_dir : str, _since : float) -> int:
+    """
+    Returns the total size of the files in _output_dir (and its subdirectories) which were
+        written after _since (a time.time() timestamp), i.e., the outputs of the latest run.
+    """
+    output_bytes = 0
+    for directory, _, file_names in os.walk(_output_dir):
+        for file_name in file_names:
+            file_stats = os.stat(os.path.join(directory, file_name))
+            if file_stats.st_mtime >= _since and not file_name.startswith("."):
+                output_bytes += file_stats.st_size
+    return output_bytes
+
+
+def compare_results(_results : list[dict], _previous_results_path : str) -> None:
+    """
+    Prints how each command's time has changed since the results in _previous_results_path,
+        and points out any which have got slower by more than REGRESSION_THRESHOLD.
+    """
+    with open(_previous_results_path, encoding="utf-8") as previous_file:
+        previous_results = {result["command"] : result \
+            for result in json.load(previous_file)["results"]}
+
+    for result in _results:
+        previous_result = previous_results.get(result["command"])
+        if previous_result is None:
+            continue
+        change = result["seconds"] / previous_result["seconds"] - 1
+        flag = "  <-- REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        print(f"{result['command']:<24} {previous_result['seconds']:8.2f}s -> "
+            f"{result['seconds']:8.2f}s ({change:+.0%}){flag}")
+
+
+def parse_arguments() -> tuple[argparse.Namespace, list[str]]:
+    """
+    Returns the benchmark's own arguments, and any others, which are passed on to photo_tools.py.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks photo_tools.py's commands.")
+    parser.add_argument("--count", type=int, default=36, help="number of images in the corpus")
+    parser.add_argument("--megapixels", default="2,12,24", \
+        help="comma-separated image sizes to pick from")
+    parser.add_argument("--portrait-fraction", type=float, default=0.2)
+    parser.add_argument("--alternative-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus-dir", \
+        default=os.path.join(tempfile.gettempdir(), "phototools_benchmark", "corpus"))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results to compare against")
+    parser.add_argument("--encoder-profiles", action="store_true", \
+        help="also time saving the images with each encoder profile")
+    return parser.parse_known_args()
+
+
+if __name__ == "__main__":
+    args, extra_options = parse_arguments()
+    corpus_paths = generate_corpus(args.corpus_dir, args.count, \
+        [float(megapixels) for megapixels in args.megapixels.split(",")], \
+        args.portrait_fraction, args.alternative_fraction, args.seed)
+    corpus_bytes = sum(os.path.getsize(path) for path in corpus_paths)
+
+    results = []
+    for command in get_benchmark_commands(len(corpus_paths)):
+        result = time_command(args.corpus_dir, command, extra_options, corpus_bytes, \
+            len(corpus_paths))
+        results.append(result)
+        print(f"{result['command']:<24} {result['seconds']:8.2f}s "
+            f"{result['images_per_second']:8.2f} images/s "
+            f"{result['megabytes_per_second']:8.2f} MB/s "
+            f"{result['peak_rss_megabytes']:8.1f} MB peak RSS "
+            f"{result['output_megabytes']:8.1f} MB output"
+            f"{'' if result['exit_code'] == 0 else ' (FAILED)'}")
+
+    profile_results = []
+    if args.encoder_profiles:
+        profile_results = time_encoder_profiles(args.corpus_dir, extra_options, corpus_bytes, \
+            len(corpus_paths))
+        print(f"\n{'profile':<10} {'command':<12} {'time':>8} {'output':>10}  JPEG settings")
+        for result in profile_results:
+            print(f"{result['profile']:<10} {result['command']:<12} {result['seconds']:7.2f}s "
+                f"{result['output_megabytes']:7.1f} MB  {result['settings']}"
+                f"{'' if result['exit_code'] == 0 else ' (FAILED)'}")
+        print()
+
+    #The biggest scan, as the threads have the most strips to share out
+    inversion_results = time_inversion(max(corpus_paths, key=os.path.getsize))
+    for result in inversion_results:
+        print(f"{result['inversion']:<32} {result['milliseconds_per_megapixel']:8.2f} ms/MP")
+
+    with open(args.output, "w", encoding="utf-8") as results_file:
+        json.dump({
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "pillow" : PIL.__version__,
+            "platform" : platform.platform(),
+            "cpu_count" : os.cpu_count(),
+            "options" : extra_options,
+            "corpus" : {"count" : len(corpus_paths), "bytes" : corpus_bytes, \
+                "megapixels" : args.megapixels, "seed" : args.seed},
+            "results" : results,
+            "inversion" : inversion_results,
+            "encoder_profiles" : profile_results,
+        }, results_file, indent=4)
+
+    if args.compare:
+        compare_results(results, args.compare)
@@ -9,8 +9,9 @@ class Error(enum.Enum):
     TOO_FEW_ARGUMENTS = 1
     WRONG_NUM_ARGUMENTS = 2
     INVALID_COMMAND = 3
-    TOO_MANY_FILES = 4
     WRONG_MERGE_ARGUMENTS = 5
+    INVALID_OPTION = 6
+    WRONG_PIPELINE_ARGUMENTS = 7
 
 class Direction(enum.Enum):
     """Special values for different grid directions"""
@@ -42,25 +43,48 @@ def direction_to_string(direction : Direction):
 
 
 
-def print_help(_error_code : Error, _extra_arg : Optional[str] = None) -> None:
+class UsageError(Exception):
+    """
+    The program was run incorrectly (e.g., with an unknown command or option).
+    Its message explains what was wrong, and how the program should be run.
+    """
+    def __init__(self, _error_code : Error, _extra_arg : Optional[str] = None) -> None:
+        super().__init__(get_help_message(_error_code, _extra_arg))
+        self.error_code = _error_code
+        self.extra_arg = _extra_arg
+
+
+def get_help_message(_error_code : Error, _extra_arg : Optional[str] = None) -> str:
     """
-    Prints a helpful string to the user, for when they have run the program incorrectly.
+    Returns a helpful string for the user, for when they have run the program incorrectly.
     """
     if _error_code == Error.TOO_FEW_ARGUMENTS:
-        print("You haven't supplied enough arguments.")
+        message = "You haven't supplied enough arguments."
     elif _error_code == Error.INVALID_COMMAND:
-        print("f{_command_name} is not a valid command.")
+        message = f"{_extra_arg} is not a valid command."
     elif _error_code == Error.WRONG_NUM_ARGUMENTS:
-        print("You have supplied the wrong number of arguments."
+        message = ("You have supplied the wrong number of arguments."
             f"{_extra_arg} needs {MAP_COMMAND_TO_NUM_ARGS[_extra_arg]} arguments.")
-    elif _error_code == Error.TOO_MANY_FILES:
-        print(f"There are too many files for this operation ({_extra_arg}/{MAX_FILES} files).")
     elif _error_code == Error.WRONG_MERGE_ARGUMENTS:
-        print("You have supplied an incorrect set of arguments for the merge function.")
+        message = "You have supplied an incorrect set of arguments for the merge function."
+    elif _error_code == Error.WRONG_PIPELINE_ARGUMENTS:
+        message = (f"{_extra_arg} can't be used in a pipeline. Pipelines are made of "
+            f"{NEGATIVE_COMMAND} and {PADDING_COMMAND} stages, optionally ending in a "
+            f"{MERGE_COMMAND} stage (e.g., neg,pad:black,merge:2:row:row).")
+    elif _error_code == Error.INVALID_OPTION:
+        message = f"{_extra_arg} is not a valid option."
     else:
-        print(f"Unknown error code: {_error_code}")
+        message = f"Unknown error code: {_error_code}"
 
-    print(f"Use 'python photo_tools.py <directory_name> {str(DISPLAY_COMMANDS)}'")
+    return (f"{message}\nUse 'python photo_tools.py <directory_name> {str(DISPLAY_COMMANDS)} "
+        f"{str(DISPLAY_OPTIONS)}'")
+
+def print_help(_error_code : Error, _extra_arg : Optional[str] = None) -> None:
+    """
+    Prints a helpful string to the user, for when they have run the program incorrectly,
+        and exits from the program.
+    """
+    print(get_help_message(_error_code, _extra_arg))
     sys.exit(_error_code)
 
 def debug(_arg : str) -> None:
@@ -70,13 +94,25 @@ def debug(_arg : str) -> None:
     if DEBUG:
         print(_arg)
 
-DEBUG = True
+DEBUG = False
 
-MAX_FILES = 1000
-
-IMAGE_SUFFIXES = ["*.JPG", "*.JPEG", "*.PNG"]
+#file extensions (compared in lower case) of the images which can be worked on
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".tif", ".tiff"]
+#(usually large) TIFF scans, which are read a strip at a time where possible (see tiff_strips.py)
+TIFF_EXTENSIONS = [".tif", ".tiff"]
 ONLY_INTEGERS_REGEX = "^\\d+$"
+NUMBERS_REGEX = "([0-9]+)"
 ONLY_CHARACTERS_REGEX = "^[a-zA-Z._-]+$"
+#e.g., "400x300", or "400" for a square
+IMAGE_SIZE_REGEX = "^(\\d+)(?:x(\\d+))?$"
+
+#EXIF tag holding the orientation of the camera, and the orientations which
+#   swap an image's width and height
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = [5, 6, 7, 8]
+
+#image modes which include an alpha channel
+ALPHA_MODES = ["RGBA", "LA", "PA", "RGBa", "La"]
 
 BLACK_COLOUR = (0,0,0)
 WHITE_COLOUR = (255,255,255)
@@ -84,25 +120,208 @@ BLACK_COLOUR_ALPHA = (0,0,0,255)
 WHITE_COLOUR_ALPHA = (255,255,255,255)
 
 
+#hidden file in an output directory, recording which outputs are up to date
+MANIFEST_NAME = ".phototools_manifest.json"
+MANIFEST_VERSION = 1
+#how often (in seconds) the manifest is saved during a long run
+MANIFEST_SAVE_INTERVAL = 5
+#the manifest kept by each shard of a batch split across machines, e.g., shard 2 of 4
+SHARD_MANIFEST_NAME = ".phototools_manifest.shard-{}-of-{}.json"
+
+#how many jobs are queued up for each worker process at a time
+QUEUED_JOBS_PER_PROCESS = 4
+
+#watching a directory for new images (see watch_folder.py)
+#how often (in seconds) the directory is checked for new or changed images
+WATCH_POLL_INTERVAL = 1
+#how long (in seconds) an image has to stay the same size before it's worked on
+WATCH_SETTLE_TIME = 2
+#the most images worked on in one batch, for each worker process
+WATCH_IMAGES_PER_PROCESS = 4
+
+#how many input files are read into memory ahead of the image being worked on
+DEFAULT_READ_AHEAD = 4
+#how many threads encode and write finished images, while the next ones are worked on
+DEFAULT_WRITER_THREADS = 2
+#how many finished images can be waiting to be encoded and written at once
+DEFAULT_WRITE_QUEUE = 4
+
+#how many bytes each pixel takes up once decoded (Pillow stores most modes in 4 bytes)
+DECODED_BYTES_PER_PIXEL = {"1" : 1, "L" : 1, "P" : 1, "I;16" : 2, "I;16L" : 2, "I;16B" : 2}
+MAX_DECODED_BYTES_PER_PIXEL = 4
+#e.g., "4G", "512M", "1.5GB" or a number of bytes
+MEMORY_SIZE_REGEX = "^(\\d+(?:\\.\\d+)?)([KMGT]?)B?$"
+MEMORY_UNITS = {"" : 1, "K" : 1024, "M" : 1024**2, "G" : 1024**3, "T" : 1024**4}
+
+#sidecar file next to an input directory, remembering its images' headers
+INDEX_SUFFIX = "_(index).sqlite"
+#how many newly read headers are saved to the index at once
+INDEX_WRITE_BATCH_SIZE = 1000
+
+
 RENAMING_COMMAND = "rename"
 RENAMING_SUFFIX = "_(renamed)/"
 
+#hardlink the original file where possible, otherwise copy its bytes
+LINK_RENAME_MODE = "link"
+#always make an independent copy of the original file's bytes
+COPY_RENAME_MODE = "copy"
+#decode and re-save the image (loses quality and EXIF data)
+REENCODE_RENAME_MODE = "reencode"
+RENAME_MODES = [LINK_RENAME_MODE, COPY_RENAME_MODE, REENCODE_RENAME_MODE]
+DEFAULT_RENAME_MODE = LINK_RENAME_MODE
+#how rename finds alternative takes: just by a letter at the end of their file names
+#   (e.g., PICT0011b), or also by looking like an earlier image (see perceptual_hash.py)
+FLAG_ALTERNATIVES = "flag"
+HASH_ALTERNATIVES = "hash"
+ALTERNATIVES_MODES = [FLAG_ALTERNATIVES, HASH_ALTERNATIVES]
+DEFAULT_ALTERNATIVES_MODE = FLAG_ALTERNATIVES
+#the letters given to alternative takes found by their looks, in order
+ALTERNATIVE_FLAGS = "bcdefghijklmnopqrstuvwxyz"
+
+#perceptual hashes, which are (nearly) the same for every scan of the same negative
+#the width and height each image is shrunk to for its DCT hash, which is made from
+#   the lowest HASH_FREQUENCIES x HASH_FREQUENCIES frequencies
+HASH_IMAGE_SIZE = 32
+HASH_FREQUENCIES = 8
+#the most bits in which two images' DCT and difference hashes can differ
+#   for them to be counted as scans of the same negative
+DUPLICATE_PHASH_DISTANCE = 6
+DUPLICATE_DHASH_DISTANCE = 12
+#how many images each worker process hashes at once
+HASH_BATCH_SIZE = 64
+
 PADDING_COMMAND = "pad"
 PADDING_SUFFIX = "_(padded)/"
 DEFAULT_PAD_COLOUR = (127,127,127)
+#e.g., --variants full,2048,1080@4x5.jpg
+PAD_VARIANT_SEPARATOR = ","
+FULL_SIZE_VARIANT = "full"
+VARIANT_RATIO_SEPARATOR = "@"
+PAD_VARIANT_REGEX = "^(" + FULL_SIZE_VARIANT + "|\\d+)(?:" + VARIANT_RATIO_SEPARATOR + \
+    "(\\d+)x(\\d+))?(\\.\\w+)?$"
 
 NEGATIVE_COMMAND = "neg"
 NEGATIVE_SUFFIX = "_(negative)/"
+#modes which negatives can be made from directly (others are converted to RGB(A) first)
+NEGATIVE_MODES = ["L", "LA", "RGB", "RGBA", "I;16", "I"]
+SIXTEEN_BIT_MODES = ["I;16", "I"]
+EIGHT_BIT_MAX = 255
+SIXTEEN_BIT_MAX = 65535
+#sample the film base colour from each image, rather than it being given
+AUTO_FILM_BASE = "auto"
+#percent of the darkest and brightest values ignored when sampling the film base and levels
+NEGATIVE_LEVELS_CLIP = 0.1
+#roughly how many pixels the film base and levels are sampled from
+NEGATIVE_SAMPLE_PIXELS = 65536
+#roughly how many bytes of an image's rows are looked up at once, by each thread
+#   (small enough for the strip to stay in the CPU's cache)
+NEGATIVE_STRIP_BYTES = 1 << 20
+
+#working on uncompressed or deflate compressed TIFFs a strip of rows at a time (see tiff_strips.py)
+#roughly how many bytes of rows are read, worked on and written at once
+TIFF_STRIP_BYTES = 1 << 20
+
+#named sets of encoder settings (see encoder_profiles.py)
+FAST_ENCODER_PROFILE = "fast"
+BALANCED_ENCODER_PROFILE = "balanced"
+ARCHIVE_ENCODER_PROFILE = "archive"
+ENCODER_PROFILE_NAMES = [FAST_ENCODER_PROFILE, BALANCED_ENCODER_PROFILE, ARCHIVE_ENCODER_PROFILE]
+#e.g., --encoder-options quality=80,progressive=true
+ENCODER_OVERRIDE_SEPARATOR = ","
+#the encoder options which can be overridden, and the formats which use them
+MAP_ENCODER_OPTION_TO_FORMATS = {
+    "quality" : ["JPEG", "WEBP"],
+    "optimize" : ["JPEG", "PNG"],
+    "progressive" : ["JPEG"],
+    "subsampling" : ["JPEG"],
+    "compress_level" : ["PNG"],
+    "method" : ["WEBP"],
+    "lossless" : ["WEBP"],
+}
+#the values each encoder option can be given
+MAP_ENCODER_OPTION_TO_VALUES = {
+    "quality" : range(0, 101),
+    "optimize" : [True, False],
+    "progressive" : [True, False],
+    "subsampling" : ["4:4:4", "4:2:2", "4:2:0"],
+    "compress_level" : range(0, 10),
+    "method" : range(0, 7),
+    "lossless" : [True, False],
+}
+#PNG compression level used when no other is asked for, as zlib's (and Pillow's) default
+DEFAULT_PNG_COMPRESS_LEVEL = 6
 
 MERGE_COMMAND = "merge"
 MERGE_SUFFIX = "_(merged)/"
 DEFAULT_MERGE_ROW_COUNT = 1
+#how many rows of the grid are held in memory while merging
+DEFAULT_MERGE_BAND_ROWS = 1
+#a single PNG, or a Deep Zoom pyramid of tiles
+MERGE_FORMAT_PNG = "png"
+MERGE_FORMAT_DEEP_ZOOM = "dzi"
+#a single JPEG has to be put together in memory in full before it can be saved
+MERGE_FORMAT_JPEG = "jpg"
+MERGE_FORMATS = [MERGE_FORMAT_PNG, MERGE_FORMAT_DEEP_ZOOM, MERGE_FORMAT_JPEG]
+DEFAULT_MERGE_FORMAT = MERGE_FORMAT_PNG
+MAP_MERGE_FORMAT_TO_EXTENSION = {
+    MERGE_FORMAT_PNG : ".PNG",
+    MERGE_FORMAT_DEEP_ZOOM : ".dzi",
+    MERGE_FORMAT_JPEG : ".JPG",
+}
+#where the images go in the merged image (see merge_layout.py)
+MERGE_LAYOUT_GRID = "grid"
+MERGE_LAYOUT_COMPACT = "compact"
+MERGE_LAYOUT_JUSTIFIED = "justified"
+MERGE_LAYOUTS = [MERGE_LAYOUT_GRID, MERGE_LAYOUT_COMPACT, MERGE_LAYOUT_JUSTIFIED]
+DEFAULT_MERGE_LAYOUT = MERGE_LAYOUT_GRID
+
+#decoded, shrunken copies of the images being merged (see thumbnail_cache.py)
+#where the cache is kept, within the user's cache directory
+THUMBNAIL_CACHE_DIR_NAME = "phototools/thumbnails"
+THUMBNAIL_CACHE_INDEX_NAME = "index.sqlite"
+THUMBNAIL_CACHE_EXTENSION = ".raw"
+#how many bytes of copies are kept, before the least recently used ones are removed
+DEFAULT_THUMBNAIL_CACHE_SIZE = 1 << 30
+#turns the cache off
+THUMBNAIL_CACHE_OFF = "off"
+#modes whose pixels can be kept as they are, without a palette
+THUMBNAIL_CACHE_MODES = ["L", "LA", "RGB", "RGBA", "I;16", "I"]
+#how long (in seconds) to wait for another merge which is updating the cache's index
+THUMBNAIL_CACHE_LOCK_TIMEOUT = 10
+
+#a series of commands done in memory, one after the other
+PIPELINE_COMMAND = "pipeline"
+PIPELINE_SUFFIX = "_(pipeline)/"
+#e.g., neg,pad:black,merge:2:row:row
+PIPELINE_STAGE_SEPARATOR = ","
+PIPELINE_ARGUMENT_SEPARATOR = ":"
+
+#split one batch across several machines (see shard_plan.py)
+#   by planning every job up front, and then collecting the shards' manifests
+PLAN_COMMAND = "plan"
+COLLECT_COMMAND = "collect"
+SHARDING_COMMANDS = [PLAN_COMMAND, COLLECT_COMMAND]
+#hidden file in an output directory, listing every planned job
+PLAN_NAME = ".phototools_plan.json"
+PLAN_VERSION = 2
+#commands whose jobs can be planned and split into shards
+SHARDABLE_COMMANDS = [RENAMING_COMMAND, PADDING_COMMAND, NEGATIVE_COMMAND, PIPELINE_COMMAND]
+#e.g., --shard 2/4
+SHARD_REGEX = "^(\\d+)/(\\d+)$"
+
+#a long-lived service which runs jobs sent to it (see service.py and service_client.py)
+#   only listens on this machine
+SERVICE_HOST = "127.0.0.1"
+DEFAULT_SERVICE_PORT = 8765
+SERVICE_JOBS_PATH = "/jobs"
 
 MAP_COMMAND_TO_SUFFIX = {
     RENAMING_COMMAND : RENAMING_SUFFIX,
     PADDING_COMMAND : PADDING_SUFFIX,
     NEGATIVE_COMMAND : NEGATIVE_SUFFIX,
     MERGE_COMMAND : MERGE_SUFFIX,
+    PIPELINE_COMMAND : PIPELINE_SUFFIX,
     }
 
 MAP_COMMAND_TO_NUM_ARGS = {
@@ -110,13 +329,92 @@ MAP_COMMAND_TO_NUM_ARGS = {
     PADDING_COMMAND : 3,        #final 4th argument (pad colour) is optional
     NEGATIVE_COMMAND : 3,
     MERGE_COMMAND : 6,          #numRows/numCols, "rows"/"columns" "row"/"column"
+    PIPELINE_COMMAND : 4,       #comma-separated commands
+    PLAN_COMMAND : 4,           #the command being planned, and its arguments
+    COLLECT_COMMAND : 4,        #the command which was planned, and its arguments
 }
 
 #commands that a user can enter to execute part of the code from the command-line
-VALID_COMMANDS = [RENAMING_COMMAND, PADDING_COMMAND, NEGATIVE_COMMAND, MERGE_COMMAND]
+VALID_COMMANDS = [RENAMING_COMMAND, PADDING_COMMAND, NEGATIVE_COMMAND, MERGE_COMMAND,
+                  PIPELINE_COMMAND, PLAN_COMMAND, COLLECT_COMMAND]
 
 #the display version of the commands to be presented to the user when they need help
 DISPLAY_COMMANDS = [RENAMING_COMMAND,
                     PADDING_COMMAND + " <black,white>",
                     NEGATIVE_COMMAND,
-                    MERGE_COMMAND + " <numRows>"]
+                    MERGE_COMMAND + " <numRows>",
+                    "<command>[:<argument>],<command>[:<argument>],...",
+                    PLAN_COMMAND + " <command> [<argument>...]",
+                    COLLECT_COMMAND + " <command> [<argument>...]"]
+
+#options that can be given alongside any command, as "--name value"
+JOBS_OPTION = "--jobs"
+RENAME_MODE_OPTION = "--rename-mode"
+ALTERNATIVES_OPTION = "--alternatives"
+BAND_ROWS_OPTION = "--band-rows"
+TILE_SIZE_OPTION = "--tile-size"
+OUTPUT_WIDTH_OPTION = "--output-width"
+FORCE_OPTION = "--force"
+STATS_OPTION = "--stats"
+CPROFILE_OPTION = "--cprofile"
+DEBUG_OPTION = "--debug"
+RECURSIVE_OPTION = "--recursive"
+READ_AHEAD_OPTION = "--read-ahead"
+WRITER_THREADS_OPTION = "--writer-threads"
+WRITE_QUEUE_OPTION = "--write-queue"
+MAX_MEMORY_OPTION = "--max-memory"
+FILM_BASE_OPTION = "--film-base"
+GAMMA_OPTION = "--gamma"
+VARIANTS_OPTION = "--variants"
+MERGE_FORMAT_OPTION = "--merge-format"
+MERGE_LAYOUT_OPTION = "--merge-layout"
+SHARD_OPTION = "--shard"
+WATCH_OPTION = "--watch"
+ENCODER_PROFILE_OPTION = "--encoder"
+ENCODER_OPTIONS_OPTION = "--encoder-options"
+THUMBNAIL_CACHE_OPTION = "--thumbnail-cache"
+
+VALID_OPTIONS = [JOBS_OPTION, RENAME_MODE_OPTION, ALTERNATIVES_OPTION, BAND_ROWS_OPTION, \
+    TILE_SIZE_OPTION, OUTPUT_WIDTH_OPTION, FORCE_OPTION, STATS_OPTION, CPROFILE_OPTION, DEBUG_OPTION, \
+    RECURSIVE_OPTION, READ_AHEAD_OPTION, WRITER_THREADS_OPTION, WRITE_QUEUE_OPTION, \
+    MAX_MEMORY_OPTION, FILM_BASE_OPTION, GAMMA_OPTION, VARIANTS_OPTION, \
+    MERGE_FORMAT_OPTION, ENCODER_PROFILE_OPTION, ENCODER_OPTIONS_OPTION, SHARD_OPTION, \
+    WATCH_OPTION, THUMBNAIL_CACHE_OPTION, MERGE_LAYOUT_OPTION]
+
+#options which are just given as "--name", without a value
+FLAG_OPTIONS = [FORCE_OPTION, DEBUG_OPTION, RECURSIVE_OPTION, WATCH_OPTION]
+
+#options which change which outputs are made, or what they hold, so a shard has to be run
+#   with the same ones as its plan was made with
+PLANNED_OPTIONS = [RENAME_MODE_OPTION, ALTERNATIVES_OPTION, RECURSIVE_OPTION, \
+    FILM_BASE_OPTION, GAMMA_OPTION, VARIANTS_OPTION, TILE_SIZE_OPTION, OUTPUT_WIDTH_OPTION, \
+    MERGE_FORMAT_OPTION, MERGE_LAYOUT_OPTION, ENCODER_PROFILE_OPTION, ENCODER_OPTIONS_OPTION]
+
+#the display version of the options to be presented to the user when they need help
+DISPLAY_OPTIONS = ["[" + JOBS_OPTION + " <numProcesses>]",
+                   "[" + RENAME_MODE_OPTION + " <" + ",".join(RENAME_MODES) + ">]",
+                   "[" + ALTERNATIVES_OPTION + " <" + ",".join(ALTERNATIVES_MODES) + ">]",
+                   "[" + BAND_ROWS_OPTION + " <numGridRows>]",
+                   "[" + TILE_SIZE_OPTION + " <width>x<height>]",
+                   "[" + OUTPUT_WIDTH_OPTION + " <width>]",
+                   "[" + FORCE_OPTION + "]",
+                   "[" + STATS_OPTION + " <report.json, or - for stderr>]",
+                   "[" + CPROFILE_OPTION + " <profile.prof>]",
+                   "[" + DEBUG_OPTION + "]",
+                   "[" + RECURSIVE_OPTION + "]",
+                   "[" + READ_AHEAD_OPTION + " <numFiles>]",
+                   "[" + WRITER_THREADS_OPTION + " <numThreads>]",
+                   "[" + WRITE_QUEUE_OPTION + " <numImages>]",
+                   "[" + MAX_MEMORY_OPTION + " <size, e.g. 4G>]",
+                   "[" + FILM_BASE_OPTION + " <" + AUTO_FILM_BASE + ", or R,G,B>]",
+                   "[" + GAMMA_OPTION + " <gamma, e.g. 1.8>]",
+                   "[" + VARIANTS_OPTION + " <width or " + FULL_SIZE_VARIANT + ">[" + \
+                       VARIANT_RATIO_SEPARATOR + "<W>x<H>][.<format>],...]",
+                   "[" + MERGE_FORMAT_OPTION + " <" + ",".join(MERGE_FORMATS) + ">]",
+                   "[" + MERGE_LAYOUT_OPTION + " <" + ",".join(MERGE_LAYOUTS) + ">]",
+                   "[" + ENCODER_PROFILE_OPTION + " <" + ",".join(ENCODER_PROFILE_NAMES) + ">]",
+                   "[" + ENCODER_OPTIONS_OPTION + " <name>=<value>,... (" + \
+                       ",".join(MAP_ENCODER_OPTION_TO_FORMATS) + ")]",
+                   "[" + SHARD_OPTION + " <shardNumber>/<numShards>]",
+                   "[" + WATCH_OPTION + "]",
+                   "[" + THUMBNAIL_CACHE_OPTION + " <size, e.g. 1G, or " + THUMBNAIL_CACHE_OFF + ">]"]
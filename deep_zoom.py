@@ -0,0 +1,244 @@
+"""Writes an image as a Deep Zoom pyramid of tiles, a few rows at a time, so the whole image
+    never has to be in memory.
+
+A Deep Zoom image is a small "<name>.dzi" file describing the image, alongside a
+    "<name>_files/" directory with a subdirectory of "<column>_<row>.<format>" tiles for each
+    level of the pyramid. The highest level is the full-sized image, and each level below it
+    is half the size of the one above, down to a single pixel.
+Viewers (e.g., OpenSeadragon) only load the tiles of the part of the image being looked at,
+    at the level closest to how far it is zoomed in, so even gigapixel images open instantly.
+"""
+import math
+import os
+import shutil
+
+from typing import Callable, Optional
+
+from PIL import Image
+
+from background_io import BackgroundWriter
+
+#The width and height of every tile (apart from those at the right and bottom edges)
+DEEP_ZOOM_TILE_SIZE = 256
+
+#The tiles' file format for each of the image modes that can be written
+MAP_MODE_TO_TILE_FORMAT = {
+    "L" : "jpg",
+    "RGB" : "jpg",
+    "LA" : "png",
+    "RGBA" : "png",
+}
+
+DEEP_ZOOM_FILES_SUFFIX = "_files"
+
+#Tiles don't overlap, so that every tile can be cut from its own rows
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="0" \
+TileSize="{tile_size}">
+    <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+class PyramidLevel:
+    """The rows of one level of a pyramid which haven't been made into tiles yet"""
+    def __init__(self, _width : int) -> None:
+        self.width = _width
+        #Rows waiting for enough more to fill a row of tiles
+        self.untiled_rows = None
+        #A single row waiting for the next one, so they can be halved together
+        self.unhalved_row = None
+        self.num_tile_rows = 0
+
+
+class DeepZoomWriter:
+    """
+    Writes a Deep Zoom pyramid of a known size, with its rows supplied in order as a series
+        of images ("bands") which are as wide as the full-sized image.
+    Each band is cut into tiles, and also halved and passed down to the level below, so only
+        fewer than two rows of tiles per level are ever kept in memory.
+    Each tile is saved by calling _save_tile(tile, tile_path), on a pool of _tile_threads
+        threads if there are any, so that tiles are encoded alongside each other.
+    The .dzi file is only written to _dzi_path once every tile has been saved, so a
+        viewer never finds an unfinished pyramid.
+    The tiles are saved in a hidden directory next to _files_dir, which only replaces
+        _files_dir (and any tiles left in it, e.g., by a merge at another size) once they
+        have all been saved.
+
+    e.g.,
+        with DeepZoomWriter("out.dzi", "out_files", (100, 200), "RGB", save_image) as writer:
+            writer.write_rows(top_half)
+            writer.write_rows(bottom_half)
+    """
+    def __init__(self, _dzi_path : str, _files_dir : str, _size : tuple[int,int], _mode : str, \
+        _save_tile : Callable[[Image.Image, str], None], _tile_threads : int = 0, \
+        _tile_size : int = DEEP_ZOOM_TILE_SIZE) -> None:
+        if _mode not in MAP_MODE_TO_TILE_FORMAT:
+            raise ValueError(f"Can't write a Deep Zoom image in {_mode} mode")
+
+        self.dzi_path = _dzi_path
+        self.files_dir = _files_dir
+        files_parent_dir, files_dir_name = os.path.split(os.path.normpath(_files_dir))
+        self.temp_files_dir = os.path.join(files_parent_dir, f".{os.getpid()}.{files_dir_name}")
+        self.size = _size
+        self.mode = _mode
+        self.save_tile = _save_tile
+        self.tile_size = _tile_size
+        self.tile_format = MAP_MODE_TO_TILE_FORMAT[_mode]
+        self.rows_written = 0
+        self.closed = False
+
+        #Level 0 is a single pixel, and each level above it is twice the size
+        max_level = math.ceil(math.log2(max(_size))) if max(_size) > 1 else 0
+        self.levels = [PyramidLevel(math.ceil(_size[0] / 2**(max_level - level))) \
+            for level in range(max_level + 1)]
+        #(left over from a run which crashed before it could remove it)
+        shutil.rmtree(self.temp_files_dir, ignore_errors=True)
+        for level in range(max_level + 1):
+            os.makedirs(os.path.join(self.temp_files_dir, str(level)))
+
+        self.tile_writer = None
+        if _tile_threads > 0:
+            self.tile_writer = BackgroundWriter(_tile_threads, 2 * _tile_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close(_exception_type is None)
+
+    def write_rows(self, _band : Image.Image) -> None:
+        """
+        Adds all of the rows in _band to the pyramid, directly below any rows that have
+            already been written, saving every tile which they complete.
+        """
+        if _band.mode != self.mode or _band.size[0] != self.size[0]:
+            raise ValueError(f"Band of {_band.mode} {_band.size} doesn't fit a "
+                f"{self.mode} Deep Zoom image of {self.size}")
+        if self.rows_written + _band.size[1] > self.size[1]:
+            raise ValueError("Too many rows have been written to the Deep Zoom image")
+
+        self.add_rows(len(self.levels) - 1, _band)
+        self.rows_written += _band.size[1]
+
+    def add_rows(self, _level : int, _rows : Image.Image) -> None:
+        """
+        Adds _rows to the bottom of _level, saving each row of tiles as soon as it is full,
+            and passes them on (halved) to the level below.
+        """
+        level = self.levels[_level]
+        if _level > 0:
+            self.add_halved_rows(_level, _rows)
+
+        rows = stack_rows(level.untiled_rows, _rows)
+        top = 0
+        while rows.size[1] - top >= self.tile_size:
+            self.save_tile_row(_level, rows, top, self.tile_size)
+            top += self.tile_size
+
+        #A copy is kept, as the band the rows came from is closed once it has been written
+        level.untiled_rows = None
+        if top < rows.size[1]:
+            level.untiled_rows = rows.crop((0, top, level.width, rows.size[1]))
+
+    def add_halved_rows(self, _level : int, _rows : Image.Image) -> None:
+        """
+        Halves _rows (along with any row left over from before) and adds them to the
+            level below _level, keeping back the last row if there's an odd number of them.
+        """
+        level = self.levels[_level]
+        rows = stack_rows(level.unhalved_row, _rows)
+        even_height = rows.size[1] - rows.size[1] % 2
+
+        level.unhalved_row = None
+        if even_height < rows.size[1]:
+            level.unhalved_row = rows.crop((0, even_height, level.width, rows.size[1]))
+        if even_height > 0:
+            if even_height < rows.size[1]:
+                rows = rows.crop((0, 0, level.width, even_height))
+            self.add_rows(_level - 1, rows.reduce(2))
+
+    def save_tile_row(self, _level : int, _rows : Image.Image, _top : int, _height : int) -> None:
+        """
+        Cuts the _height rows of _rows starting at _top into the next row of tiles
+            of _level, and saves them.
+        """
+        level = self.levels[_level]
+        for column, left in enumerate(range(0, level.width, self.tile_size)):
+            tile = _rows.crop((left, _top, min(left + self.tile_size, level.width), _top + _height))
+            tile_path = os.path.join(self.temp_files_dir, str(_level), \
+                f"{column}_{level.num_tile_rows}.{self.tile_format}")
+
+            if self.tile_writer is None:
+                self.save_tile(tile, tile_path)
+            else:
+                self.tile_writer.submit(tile_path, self.save_tile, tile, tile_path)
+                #Stop as soon as saving a tile has gone wrong
+                for _, future in self.tile_writer.take_finished():
+                    future.result()
+
+        level.num_tile_rows += 1
+
+    def close(self, _finish : bool = True) -> None:
+        """
+        Saves the last, partly-filled row of tiles of every level, waits for every tile
+            to be saved, and then writes the .dzi file.
+        If _finish is False, the tiles being saved are just waited for (e.g., after an error).
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if _finish:
+                if self.rows_written != self.size[1]:
+                    raise ValueError(f"Only {self.rows_written} of the Deep Zoom image's "
+                        f"{self.size[1]} rows were written")
+                self.finish_levels()
+                if self.tile_writer is not None:
+                    for _, future in self.tile_writer.take_finished(_wait=True):
+                        future.result()
+
+                shutil.rmtree(self.files_dir, ignore_errors=True)
+                os.rename(self.temp_files_dir, self.files_dir)
+                with open(self.dzi_path, "w", encoding="utf-8") as dzi_file:
+                    dzi_file.write(DZI_TEMPLATE.format(format=self.tile_format, \
+                        tile_size=self.tile_size, width=self.size[0], height=self.size[1]))
+        finally:
+            if self.tile_writer is not None:
+                self.tile_writer.close()
+            #Only there if the tiles weren't all saved
+            shutil.rmtree(self.temp_files_dir, ignore_errors=True)
+
+    def finish_levels(self) -> None:
+        """
+        Passes the leftover row of each level down to the level below, and saves the
+            leftover rows of each level as its final row of tiles, from the top level down.
+        """
+        for level_index in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[level_index]
+            if level_index > 0 and level.unhalved_row is not None:
+                self.add_rows(level_index - 1, level.unhalved_row.reduce(2))
+                level.unhalved_row = None
+            if level.untiled_rows is not None:
+                self.save_tile_row(level_index, level.untiled_rows, 0, level.untiled_rows.size[1])
+                level.untiled_rows = None
+
+
+def get_deep_zoom_files_dir(_dzi_path : str) -> str:
+    """
+    Returns the directory that the tiles of the Deep Zoom image at _dzi_path are saved in.
+    """
+    return os.path.splitext(_dzi_path)[0] + DEEP_ZOOM_FILES_SUFFIX
+
+
+def stack_rows(_top_rows : Optional[Image.Image], _bottom_rows : Image.Image) -> Image.Image:
+    """
+    Returns _bottom_rows placed directly below _top_rows (if there are any) as one image.
+    """
+    if _top_rows is None:
+        return _bottom_rows
+
+    stacked_rows = Image.new(_bottom_rows.mode, (_bottom_rows.size[0], \
+        _top_rows.size[1] + _bottom_rows.size[1]))
+    stacked_rows.paste(_top_rows, (0, 0))
+    stacked_rows.paste(_bottom_rows, (0, _top_rows.size[1]))
+    return stacked_rows
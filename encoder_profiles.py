@@ -0,0 +1,85 @@
+"""Named sets of encoder settings, which trade how long images take to save against their file size.
+
+e.g.,
+    encoder = EncoderSettings(FAST_ENCODER_PROFILE, (("quality", 80),))
+    image_object.save(path, "JPEG", **get_save_options(encoder, "JPEG"))
+"""
+from typing import NamedTuple, Optional, Union
+
+from constants import *
+
+#The Pillow save options of each profile, for each format.
+#Formats which aren't listed are saved with Pillow's defaults.
+ENCODER_PROFILES = {
+    #Quick to save, at the cost of bigger files
+    FAST_ENCODER_PROFILE : {
+        "JPEG" : {"quality" : 85, "optimize" : False, "progressive" : False, \
+            "subsampling" : "4:2:0"},
+        "PNG" : {"compress_level" : 1},
+        "WEBP" : {"quality" : 80, "method" : 0},
+    },
+    #Good quality and reasonably small, without taking much longer
+    BALANCED_ENCODER_PROFILE : {
+        "JPEG" : {"quality" : 90, "optimize" : True, "progressive" : False, \
+            "subsampling" : "4:2:0"},
+        "PNG" : {"compress_level" : 6},
+        "WEBP" : {"quality" : 85, "method" : 4},
+    },
+    #The best quality (and smallest lossless files), however long they take to save
+    ARCHIVE_ENCODER_PROFILE : {
+        "JPEG" : {"quality" : 95, "optimize" : True, "progressive" : True, \
+            "subsampling" : "4:4:4"},
+        "PNG" : {"compress_level" : 9},
+        "WEBP" : {"lossless" : True, "method" : 6},
+    },
+}
+
+
+class EncoderSettings(NamedTuple):
+    """How output images are encoded"""
+    #One of ENCODER_PROFILES, or None for Pillow's defaults
+    profile : Optional[str] = None
+    #(option name, value) pairs which replace the profile's options, for every format
+    #   that uses them (e.g., quality only affects JPEG and WebP)
+    overrides : tuple[tuple[str, Union[int, bool, str]], ...] = ()
+
+
+def get_save_options(_encoder : Optional[EncoderSettings], _format : str) -> dict:
+    """
+    Returns the options to pass to Image.save() for an image saved in _format (e.g., "JPEG").
+    """
+    if _encoder is None:
+        return {}
+
+    save_options = dict(ENCODER_PROFILES.get(_encoder.profile, {}).get(_format, {}))
+    for name, value in _encoder.overrides:
+        if _format in MAP_ENCODER_OPTION_TO_FORMATS[name]:
+            save_options[name] = value
+    return save_options
+
+
+def parse_encoder_overrides(_overrides : str) \
+    -> Optional[tuple[tuple[str, Union[int, bool, str]], ...]]:
+    """
+    Returns the (name, value) pairs in _overrides, e.g., "quality=80,progressive=true",
+        or None if they aren't valid (see MAP_ENCODER_OPTION_TO_VALUES).
+    Values are whole numbers, true/false, or otherwise left as strings (e.g., "4:4:4").
+    """
+    overrides = []
+    for override in _overrides.split(ENCODER_OVERRIDE_SEPARATOR):
+        name, _, value = override.partition("=")
+        if name not in MAP_ENCODER_OPTION_TO_FORMATS or not value:
+            return None
+
+        if value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        elif value.isdigit():
+            value = int(value)
+
+        #e.g., quality=abc, or optimize=1 (which would pass for True, as True == 1)
+        valid_values = MAP_ENCODER_OPTION_TO_VALUES[name]
+        if value not in valid_values or type(value) is not type(valid_values[0]):
+            return None
+        overrides.append((name, value))
+
+    return tuple(overrides)
@@ -0,0 +1,137 @@
+"""Functions for writing output files safely, and copying a file's bytes without decoding it"""
+import contextlib
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    #Not available on Windows, where reflinks are skipped
+    fcntl = None
+
+#ioctl request number for FICLONE, which asks a copy-on-write filesystem
+#   (e.g., btrfs, XFS) to share the source file's blocks with the destination
+FICLONE = 0x40049409
+
+#Largest number of bytes handed to the kernel per copy_file_range/sendfile call
+KERNEL_COPY_CHUNK_SIZE = 1 << 30
+
+
+@contextlib.contextmanager
+def atomic_output(_path : str):
+    """
+    Gives a temporary path to write to instead of _path, which is only moved to _path once
+        writing has finished without an error.
+    This means a crash can never leave a half-written file at _path.
+    The temporary file is hidden, in the same directory, and has the same extension,
+        so that libraries which look at the extension still work.
+
+    e.g.,
+        with atomic_output("out/PICT0001.JPG") as temp_path:
+            image_object.save(temp_path)
+    """
+    directory, name = os.path.split(_path)
+    temp_path = os.path.join(directory, f".{os.getpid()}.{name}")
+    try:
+        yield temp_path
+        os.replace(temp_path, _path)
+    finally:
+        #Either writing failed, or _path was already a hardlink to the same file as
+        #   temp_path (in which case the rename does nothing)
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+
+
+def link_file(_source_path : str, _destination_path : str) -> str:
+    """
+    Makes _destination_path have the same bytes as _source_path as cheaply as possible,
+        preferring a hardlink to the source file, and falling back to copy_file().
+    Returns the name of the method that was used.
+    """
+    with atomic_output(_destination_path) as temp_path:
+        try:
+            os.link(_source_path, temp_path)
+            return "hardlink"
+        except OSError:
+            #e.g., the output directory is on a different filesystem
+            return copy_file_contents(_source_path, temp_path)
+
+
+def copy_file(_source_path : str, _destination_path : str) -> str:
+    """
+    Copies _source_path's bytes into a new, independent file at _destination_path.
+    Tries a reflink first, then a copy made by the kernel, and then a plain copy in Python.
+    Returns the name of the method that was used.
+    """
+    with atomic_output(_destination_path) as temp_path:
+        return copy_file_contents(_source_path, temp_path)
+
+
+def copy_file_contents(_source_path : str, _destination_path : str) -> str:
+    """
+    Does the work of copy_file(), writing straight to _destination_path.
+    """
+    with open(_source_path, "rb") as source_file, open(_destination_path, "wb") as dest_file:
+        if reflink_file(source_file, dest_file):
+            method = "reflink"
+        elif kernel_copy_file(source_file, dest_file):
+            method = "kernel copy"
+        else:
+            shutil.copyfileobj(source_file, dest_file)
+            method = "copy"
+
+    shutil.copystat(_source_path, _destination_path)
+    return method
+
+
+def reflink_file(_source_file, _dest_file) -> bool:
+    """
+    Asks the filesystem to share _source_file's blocks with _dest_file.
+    Returns False if the platform or filesystem doesn't support it.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(_dest_file.fileno(), FICLONE, _source_file.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def kernel_copy_file(_source_file, _dest_file) -> bool:
+    """
+    Copies _source_file into _dest_file without the bytes passing through Python,
+        using copy_file_range, or sendfile if that isn't available.
+    Returns False if neither could be used, in which case nothing has been copied.
+    """
+    source_fd = _source_file.fileno()
+    dest_fd = _dest_file.fileno()
+    num_bytes = os.fstat(source_fd).st_size
+
+    for copy_function in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy_function is None:
+            continue
+
+        offset = 0
+        try:
+            while offset < num_bytes:
+                if copy_function is os.sendfile:
+                    copied = os.sendfile(dest_fd, source_fd, offset, \
+                        min(KERNEL_COPY_CHUNK_SIZE, num_bytes - offset))
+                else:
+                    copied = os.copy_file_range(source_fd, dest_fd, \
+                        min(KERNEL_COPY_CHUNK_SIZE, num_bytes - offset), offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            #Nothing should have been written if the very first call failed,
+            #   so the next method can start from scratch
+            if offset == 0:
+                continue
+            raise
+
+        if offset == num_bytes:
+            return True
+
+    return False
@@ -0,0 +1,62 @@
+"""Finds the image files in a directory (and optionally its subdirectories) in a single pass"""
+import os
+import re
+
+from typing import Iterator
+
+from constants import *
+
+def iter_folder_images(_dir_name : str, _recursive : bool = False) -> Iterator[str]:
+    """
+    Yields the path of every allowable (as defined by IMAGE_EXTENSIONS, in any case)
+        image file in _dir_name, in natural order (see natural_sort_key()).
+    If _recursive is True, the images in subdirectories are yielded too, with each
+        subdirectory's images coming at its place in the natural order.
+    Only the names of the directories currently being walked are held in memory,
+        and hidden files/directories are skipped.
+    """
+    with os.scandir(_dir_name) as entries:
+        #Only the names are kept, rather than the (larger) DirEntry objects
+        names = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                names.append((entry.name, False))
+            elif _recursive and entry.is_dir():
+                names.append((entry.name, True))
+
+    names.sort(key=lambda name: natural_sort_key(name[0]))
+    for name, is_dir in names:
+        if is_dir:
+            yield from iter_folder_images(os.path.join(_dir_name, name, ""), _recursive)
+        else:
+            yield os.path.join(_dir_name, name)
+
+
+def natural_sort_key(_name : str) -> tuple:
+    """
+    Returns a key which sorts names by the value of the numbers in them, rather than
+        character by character, and ignores case.
+    e.g., "IMG_9.jpg" < "IMG_10.jpg" < "img_11.JPG", and "PICT0011.JPG" < "PICT0011b.JPG"
+    """
+    return tuple(int(part) if part.isdigit() else part.lower() \
+        for part in re.split(NUMBERS_REGEX, _name))
+
+
+def count_files_in_directory(_directory : str, _recursive : bool = False) -> int:
+    """
+    Returns how many (non-hidden) files are in _directory, and in its (non-hidden)
+        subdirectories too if _recursive is True, without listing them all at once.
+    """
+    num_files = 0
+    with os.scandir(_directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file():
+                num_files += 1
+            elif _recursive and entry.is_dir(follow_symlinks=False):
+                num_files += count_files_in_directory(entry.path, _recursive)
+
+    return num_files
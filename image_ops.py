@@ -1,15 +1,44 @@
 """A set of functions for manipulating batches of images"""
+import bisect
+import io
 import os
 import re
 import math
 
-from typing import Tuple
+from collections import defaultdict
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
 from PIL import Image
 import PIL.ImageOps
 
 from constants import *
+import instrumentation
+from instrumentation import timed
+from background_io import BackgroundWriter, QueueDepths, prefetch_files
+from batch import JobFailure, default_num_jobs, run_batch
+from deep_zoom import DeepZoomWriter, get_deep_zoom_files_dir
+from encoder_profiles import EncoderSettings, get_save_options
+from file_copy import atomic_output, copy_file, link_file
+from folder_scan import natural_sort_key
+from manifest import Manifest
+from merge_layout import MergeLayout, plan_merge_layout
+from memory_budget import JobMemoryEstimates, MemoryBudget, get_decoded_size
+from metadata_index import ImageMetadata, iter_image_metadata, read_image_metadata
+from negative_engine import NegativeSettings, invert_negative
+from perceptual_hash import find_alternative_takes
+from png_writer import PngStreamWriter
+from thumbnail_cache import ThumbnailCache, get_cached_scale, get_thumbnail_cache_dir
+from tiff_strips import is_tiff_path, transform_tiff
 
-def rename_images(_input_image_paths : list[str], _output_image_dir : str) -> None:
+class RenameError(Exception):
+    """Two images would be given the same new name, so one would overwrite the other"""
+
+
+def rename_images(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _num_jobs : Optional[int] = None, _rename_mode : str = DEFAULT_RENAME_MODE, \
+    _force : bool = False, _encoder : Optional[EncoderSettings] = None, \
+    _planned_renames : Optional[list[Tuple[str, str]]] = None, \
+    _manifest_name : str = MANIFEST_NAME, \
+    _alternatives_mode : str = DEFAULT_ALTERNATIVES_MODE) -> list[JobFailure]:
     """
     Takes a set of images and reindexes them to be sequential, taking into account
         that there might be "alternative takes" for certain images.
@@ -18,106 +47,646 @@ def rename_images(_input_image_paths : list[str], _output_image_dir : str) -> No
         becomes
         [".../PICT0001", ".../PICT0002", ".../PICT0002b", ".../PICT0003"]
 
+    _alternatives_mode decides whether alternative takes are only found by the letter at
+        the end of their names, or also by how they look (see ALTERNATIVES_MODES).
+    _rename_mode decides how the files get their new names (see RENAME_MODES).
+    Only the REENCODE_RENAME_MODE decodes the images (and re-encodes them according to
+        _encoder); the others keep the original bytes.
+    Images which were already renamed by a previous run are skipped, unless _force is True.
+    If _planned_renames (old path, new path) are given, they are used instead of working out
+        the new names from _input_image_paths (e.g., for one shard of a planned batch; see
+        shard_plan.py), and the manifest is kept under _manifest_name.
+
     Saves the re-indexed images in a new directory, defined by RENAMING_SUFFIX
+    Returns the images which could not be renamed.
+    Raises RenameError (before renaming anything) if two images would get the same new name.
     """
-    #Starts at 0 to account for incrementing when seeing a non-alternative
-    #   (the 1st image can never be an alternative take)
-    new_index = 0
+    manifest = Manifest(_output_image_dir, [RENAMING_COMMAND, _rename_mode] + \
+        (get_encoder_arguments(_encoder) if _rename_mode == REENCODE_RENAME_MODE else []), _force, \
+        _manifest_name)
+    if _planned_renames is None:
+        _planned_renames = plan_renames(_input_image_paths, _output_image_dir, \
+            _alternatives_mode == HASH_ALTERNATIVES, _num_jobs)
+    _planned_renames = check_rename_conflicts(_planned_renames)
+    jobs = manifest.remove_up_to_date_jobs(_planned_renames)
 
-    #Get the "base name" for the images - e.g., PICT, DCIM, IMG_, etc.
-    #Assumes that each image has the same base name as the first one.
-    #Also gets the "base index", e.g., 1, 001, 00018, etc.
-    base_name, base_index = get_image_base_name_and_index(_input_image_paths[0])
-    debug(f"Base name ({base_name}) and index({base_index})")
+    #The new names are all decided up front, so the images can be saved in any order
+    if _rename_mode == REENCODE_RENAME_MODE:
+        failures = run_batch(rename_image, ((*job, _encoder) for job in jobs), _num_jobs, \
+            manifest.record_job)
 
-    #Since the first image can't be an alternative take, this lets us
-    #   get the proper index length for all of the images
-    index_length = len(base_index)
+    #Linking or copying is cheap enough that starting up other processes would only slow it down
+    elif _rename_mode == COPY_RENAME_MODE:
+        failures = run_batch(copy_file, jobs, 1, manifest.record_job)
+    else:
+        failures = run_batch(link_file, jobs, 1, manifest.record_job)
 
-    #For each image, rename based on the new indices
+    manifest.save()
+    return failures
+
+
+def plan_renames(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _find_alternatives : bool = False, _num_jobs : Optional[int] = None) \
+    -> Iterator[Tuple[str, str]]:
+    """
+    Works out the new, sequential file path for each image, without touching the files.
+    If _find_alternatives is True, images which look like an earlier image are also
+        made alternative takes of it, which means hashing every image (on _num_jobs
+        processes) before any of them can be planned (see perceptual_hash.py).
+    Yields (old path, new path) pairs, in the same order as _input_image_paths.
+    """
+    alternatives = {}
+    if _find_alternatives:
+        _input_image_paths = list(_input_image_paths)
+        alternatives = find_alternative_takes(_input_image_paths, _num_jobs)
+        print(f"Found {len(alternatives)} images which look like alternative takes")
+
+    planner = RenamePlanner(_output_image_dir)
     for image in _input_image_paths:
-        flag = get_alternative_flag(image)
+        yield image, planner.plan(image, alternatives.get(image))
+
+
+def check_rename_conflicts(_planned_renames : Iterable[Tuple[str, str]]) \
+    -> list[Tuple[str, str]]:
+    """
+    Returns the (old path, new path) pairs of _planned_renames as a list.
+    Raises RenameError if any two images would be given the same new path.
+    """
+    planned_renames = list(_planned_renames)
+    old_paths = {}
+    for old_path, new_path in planned_renames:
+        if new_path in old_paths and old_paths[new_path] != old_path:
+            raise RenameError(f"{old_paths[new_path]} and {old_path} would both be "
+                f"renamed to {new_path}")
+        old_paths[new_path] = old_path
 
-        #increment the index if this was not an alternative-take image
-        if flag == '':
-            new_index += 1
+    return planned_renames
+
+
+class RenamePlanner:
+    """
+    Works out the new, sequential file paths of images given to it in order, remembering
+        the indices it has handed out so far, so that images can be given to it a few at a
+        time (e.g., as they are scanned; see watch_folder.py) and still be numbered as
+        if they had all been given at once.
+    An alternative take which turns up after later images still gets the index of the
+        image before it in natural order (normally the image it's an alternative of), and
+        an image given again (e.g., it was scanned again) keeps its first new path.
+    An image without a letter at the end of its name can also be made an alternative take
+        of an earlier image (e.g., one found by perceptual_hash.find_alternative_takes()),
+        in which case it's given the next letter that image's index hasn't used.
+    An alternative take whose own letter has already been used with its index (e.g., by
+        such an image) is given the next unused letter instead.
+    """
+    def __init__(self, _output_image_dir : str) -> None:
+        self.output_image_dir = _output_image_dir
+        #Starts at 0 to account for incrementing when seeing a non-alternative
+        #   (the 1st image can never be an alternative take)
+        self.new_index = 0
+        self.base_name = self.index_length = None
+        #The natural sort keys, and new indices, of the images which aren't alternative
+        #   takes, in natural order, for any alternative takes which turn up late
+        self.sort_keys = []
+        self.new_indices = []
+        self.new_paths = {}
+        #The new index of each image which isn't an alternative take, and the alternative
+        #   flags used with each new index
+        self.image_indices = {}
+        self.used_flags = defaultdict(set)
+
+    def plan(self, _image_path : str, _alternative_of : Optional[str] = None) -> str:
+        """
+        Returns the new file path for _image_path, the next image in order, as an
+            alternative take of the image at _alternative_of if it's given.
+        """
+        if _image_path in self.new_paths:
+            return self.new_paths[_image_path]
+
+        if self.base_name is None:
+            #Get the "base name" for the images - e.g., PICT, DCIM, IMG_, etc.
+            #Assumes that each image has the same base name as the first one.
+            #Also gets the "base index", e.g., 1, 001, 00018, etc.
+            self.base_name, base_index = get_image_base_name_and_index(_image_path)
+            debug(f"Base name ({self.base_name}) and index({base_index})")
+
+            #Since the first image can't be an alternative take, this lets us
+            #   get the proper index length for all of the images
+            self.index_length = len(base_index)
+
+        flag = get_alternative_flag(_image_path)
+        new_index = None
+        if flag == '' and _alternative_of in self.image_indices:
+            new_index = self.image_indices[_alternative_of]
+            flag = self.get_unused_flag(new_index)
+            #There are too many alternative takes for the letters, so it gets its own index
+            if flag == '':
+                new_index = None
+
+        if new_index is None:
+            sort_key = natural_sort_key(os.path.splitext(_image_path)[0][:-len(flag) or None])
+            position = bisect.bisect_right(self.sort_keys, sort_key)
+
+            #increment the index if this was not an alternative-take image
+            if flag == '':
+                self.new_index += 1
+                new_index = self.image_indices[_image_path] = self.new_index
+                self.sort_keys.insert(position, sort_key)
+                self.new_indices.insert(position, new_index)
+            else:
+                new_index = self.new_indices[position - 1] if position > 0 else self.new_index
+                #Its letter may already have been given to an image found by how it looks
+                if flag in self.used_flags[new_index]:
+                    flag = self.get_unused_flag(new_index)
+                    if flag == '':
+                        raise RenameError(f"Every letter has been used for alternative takes "
+                            f"of index {new_index}, so {_image_path} can't be given one")
+        self.used_flags[new_index].add(flag)
 
         #Create an index padded with a sufficient number of prefixing '0's
-        formatted_index = "0" * (index_length - len(str(new_index))) + str(new_index)
+        formatted_index = "0" * (self.index_length - len(str(new_index))) + str(new_index)
 
         #Get the file name's extension
-        extension = os.path.splitext(image)[1]
+        extension = os.path.splitext(_image_path)[1]
 
         #Create the new file name based off of the current index
-        new_filepath = _output_image_dir + base_name + formatted_index + flag + extension
-        debug(f"Saving {image} to {new_filepath}")
+        new_filepath = self.output_image_dir + self.base_name + formatted_index + flag + extension
+        debug(f"Saving {_image_path} to {new_filepath}")
+        self.new_paths[_image_path] = new_filepath
+        return new_filepath
+
+    def get_unused_flag(self, _new_index : int) -> str:
+        """
+        Returns the first alternative flag (letter) not yet used with _new_index,
+            or '' if they have all been used.
+        """
+        return next((letter for letter in ALTERNATIVE_FLAGS \
+            if letter not in self.used_flags[_new_index]), '')
+
 
-        #Save the image with the updated path name
-        with Image.open(image) as image_object:
-            image_object.save(new_filepath)
+def rename_image(_input_image_path : str, _new_filepath : str, \
+    _encoder : Optional[EncoderSettings] = None) -> None:
+    """
+    Saves a single image with its updated path name, by decoding and re-encoding it.
+    """
+    with load_image(_input_image_path) as image_object:
+        save_image(image_object, _new_filepath, _encoder=_encoder)
+
+
+class PadVariant(NamedTuple):
+    """One of the versions of each image that pad_images() saves"""
+    #The width to shrink the padded image to, or None to keep it at full size
+    width : Optional[int] = None
+    #The padded image's width:height
+    aspect_ratio : Tuple[int,int] = (1, 1)
+    #The file extension to save it with (e.g., ".png"), or None to keep the input's
+    extension : Optional[str] = None
 
 
-def pad_images(_input_image_paths : list[str], _output_image_dir : str, \
-    _pad_colour : tuple[int,int,int]) -> None:
+def pad_images(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _pad_colour : tuple[int,int,int], _num_jobs : Optional[int] = None, \
+    _force : bool = False, _input_image_dir : Optional[str] = None, \
+    _queue_depths : Optional[QueueDepths] = None, _memory_budget : Optional[MemoryBudget] = None, \
+    _variants : Optional[list[PadVariant]] = None, _encoder : Optional[EncoderSettings] = None, \
+    _manifest_name : str = MANIFEST_NAME) -> list[JobFailure]:
     """
     Takes a set of images and pads them to be square by adding pixels in _pad_colour
         to the edges of the two shorter sides.
     Places the additional pixels in such a way that the old image is cented in the new image.
     Does not assume that each image will be the same size.
+    Images which were already padded by a previous run are skipped, unless _force is True.
+    If _input_image_dir is given, images in its subdirectories are saved in the same
+        subdirectories of _output_image_dir (see get_output_path()).
+    If _queue_depths is given, reading and saving the images overlaps with the work on
+        them (see batch.run_batch()).
+    If _memory_budget is given, only as many images are worked on at once as are expected
+        to fit in it.
+    If _variants are given, each image is instead padded to every one of their sizes,
+        aspect ratios and formats, each saved in its own subdirectory (see get_variant_path()).
+        Every image is still only decoded once, however many variants there are.
+    The padded images are encoded according to _encoder (see encoder_profiles.py).
+    The manifest is kept under _manifest_name (e.g., for one shard of a batch).
 
     Saves the padded images in a new directory, defined by PADDING_SUFFIX
+    Returns the images which could not be padded.
     """
-    for image in _input_image_paths:
-        with Image.open(image) as image_object:
+    manifest = Manifest(_output_image_dir, [PADDING_COMMAND, *_pad_colour] + \
+        ([repr(_variants)] if _variants else []) + get_encoder_arguments(_encoder), _force, \
+        _manifest_name, lambda _job: get_variant_paths(_job[1], _job[3]))
+    memory_estimates = JobMemoryEstimates() if _memory_budget is not None else None
+    jobs = manifest.remove_up_to_date_jobs(make_image_jobs(_input_image_paths, \
+        _output_image_dir, _input_image_dir, (_pad_colour, _variants or None, _encoder), \
+        [(PADDING_COMMAND, _pad_colour)], memory_estimates))
 
-            #Rotate the image based on the EXIF data's orientation tag.
-            #Ensures that images taller than they are wide are kept as such when padding
-            image_object = PIL.ImageOps.exif_transpose(image_object)
+    failures = run_batch(pad_image, jobs, _num_jobs, manifest.record_job, _queue_depths, \
+        _memory_budget, memory_estimates.take if memory_estimates else None)
+    manifest.save()
+    return failures
 
-            old_x,old_y = image_object.size
-            bigger_dimension = max(old_x,old_y)
 
-            #Figure out how much extra should be added to each of the four sides
-            x_additive = y_additive = 0
-            if old_x > old_y:
-                y_additive = (old_x - old_y)//2
+def make_image_jobs(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _input_image_dir : Optional[str], _arguments : tuple, _stages : list[tuple], \
+    _memory_estimates : Optional[JobMemoryEstimates] = None) -> Iterator[tuple]:
+    """
+    Yields a job (input path, output path (see get_output_path()), *_arguments,
+        EXIF orientation) for each of _input_image_paths.
+    If _memory_estimates is given, the memory each job is expected to need to put its image
+        through _stages (see estimate_image_memory()) is noted in it.
+    """
+    for metadata in iter_image_metadata(_input_image_paths):
+        if _memory_estimates is not None:
+            _memory_estimates.note(metadata.path, estimate_image_memory(metadata, _stages))
+        yield (metadata.path, get_output_path(metadata.path, _output_image_dir, \
+            _input_image_dir), *_arguments, metadata.orientation)
 
-            elif old_y > old_x:
-                x_additive = (old_y - old_x)//2
 
-            #Create a new, larger image with the requested padding colour,
-            #   and then paste the original image overtop in the correct position
-            new_canvas = Image.new("RGB", (bigger_dimension,bigger_dimension), _pad_colour)
-            new_canvas.paste(image_object, (x_additive, y_additive))
-            new_canvas.save(_output_image_dir + os.path.basename(image))
+def estimate_image_memory(_metadata : ImageMetadata, _stages : list[tuple]) -> int:
+    """
+    Roughly estimates the most memory needed at once to put the image described by _metadata
+        through _stages: its file's contents, the decoded image and a rotated copy of it,
+        and the result of a stage alongside the result of the stage before.
+    """
+    decoded_size = get_decoded_size((_metadata.width, _metadata.height), _metadata.mode)
+    staged_size = get_decoded_size(get_staged_size(_metadata.oriented_size, _stages), "RGB")
+    return _metadata.file_size + 2 * decoded_size + 2 * staged_size
 
 
-def negative_images(_input_image_paths : list[str], _output_image_dir : str) -> None:
+def get_output_path(_input_image_path : str, _output_image_dir : str, \
+    _input_image_dir : Optional[str] = None) -> str:
+    """
+    Returns the path to save the image made from _input_image_path to.
+    This is the same path within _output_image_dir as _input_image_path has within
+        _input_image_dir (creating any subdirectories needed), or just the same
+        file name if _input_image_dir isn't given.
+    """
+    if _input_image_dir is None:
+        return _output_image_dir + os.path.basename(_input_image_path)
+
+    relative_path = os.path.relpath(_input_image_path, _input_image_dir)
+    output_path = os.path.join(_output_image_dir, relative_path)
+    if os.path.dirname(relative_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    return output_path
+
+
+def get_encoder_arguments(_encoder : Optional[EncoderSettings]) -> list:
+    """
+    Returns what to add to a manifest's arguments for _encoder, so that changing it remakes
+        the outputs (nothing for Pillow's defaults, so older manifests still match).
+    """
+    return [] if _encoder is None else [repr(_encoder)]
+
+
+def pad_image(_input_image_path : str, _output_image_path : str, \
+    _pad_colour : tuple[int,int,int], _variants : Optional[list[PadVariant]] = None, \
+    _encoder : Optional[EncoderSettings] = None, _orientation : Optional[int] = None, \
+    _input_data : Optional[bytes] = None, _defer_save : Optional[Callable] = None) -> None:
+    """
+    Pads a single image to be square, and saves it to _output_image_path,
+        or pads it to each of _variants and saves those instead (see get_variant_paths()).
+    _orientation is the image's EXIF orientation, if it is already known.
+    _input_data and _defer_save are passed on to load_image() and save_image().
+    Uncompressed and deflate compressed TIFFs (without _variants) are padded a strip at a time
+        instead (see tiff_strips.transform_tiff()).
+    """
+    if not _variants and transform_tiff(_input_image_path, _output_image_path, \
+        [(PADDING_COMMAND, _pad_colour)]):
+        return
+
+    with load_image(_input_image_path, _input_data) as image_object:
+
+        #Rotate the image based on the EXIF data's orientation tag.
+        #Ensures that images taller than they are wide are kept as such when padding
+        image_object = apply_orientation(image_object, _orientation)
+
+        variants = _variants or [PadVariant()]
+        output_paths = get_variant_paths(_output_image_path, _variants)
+        for variant_index, variant_image in resize_for_variants(image_object, variants):
+            with timed("transform"):
+                new_canvas = pad_image_object(variant_image, _pad_colour, \
+                    variants[variant_index].aspect_ratio)
+
+            output_path = output_paths[variant_index]
+            if _variants:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            save_image(new_canvas, output_path, _defer_save, _encoder)
+
+
+def pad_image_object(_image_object : Image.Image, _pad_colour : tuple[int,int,int], \
+    _aspect_ratio : Tuple[int,int] = (1, 1)) -> Image.Image:
+    """
+    Returns a copy of _image_object which has been padded to be square,
+        or to _aspect_ratio (width, height) if given.
+    """
+    old_x,old_y = _image_object.size
+    new_x,new_y = get_padded_size(_image_object.size, _aspect_ratio)
+
+    #Figure out how much extra should be added to each of the four sides
+    x_additive = (new_x - old_x)//2
+    y_additive = (new_y - old_y)//2
+
+    #Create a new, larger image with the requested padding colour,
+    #   and then paste the original image overtop in the correct position
+    new_canvas = Image.new("RGB", (new_x,new_y), _pad_colour)
+    new_canvas.paste(reduce_to_eight_bits(_image_object), (x_additive, y_additive))
+    return new_canvas
+
+
+def get_padded_size(_size : Tuple[int,int], _aspect_ratio : Tuple[int,int] = (1, 1)) \
+    -> Tuple[int,int]:
+    """
+    Returns the smallest size with _aspect_ratio (width, height) which _size fits inside.
+    """
+    old_x,old_y = _size
+    ratio_x,ratio_y = _aspect_ratio
+    if old_x * ratio_y >= old_y * ratio_x:
+        return old_x, max(old_y, round(old_x * ratio_y / ratio_x))
+    return max(old_x, round(old_y * ratio_x / ratio_y)), old_y
+
+
+def get_variant_size(_size : Tuple[int,int], _variant : PadVariant) -> Tuple[int,int]:
+    """
+    Returns the size an image of _size should be shrunk to, so that once it is padded
+        to _variant's aspect ratio, it is no wider than _variant's width.
+    Images are never enlarged.
+    """
+    padded_x = get_padded_size(_size, _variant.aspect_ratio)[0]
+    if _variant.width is None or _variant.width >= padded_x:
+        return _size
+
+    scale = _variant.width / padded_x
+    return max(1, round(_size[0] * scale)), max(1, round(_size[1] * scale))
+
+
+def resize_for_variants(_image_object : Image.Image, _variants : list[PadVariant]) \
+    -> Iterator[Tuple[int, Image.Image]]:
+    """
+    Yields the index of each of _variants alongside _image_object shrunk to suit it
+        (see get_variant_size()), from the biggest to the smallest.
+    Each image is shrunk from the one before it rather than from _image_object, so every
+        resize after the first works on fewer pixels.
+    Each shrunken image is closed once the next one has been made from it.
+    """
+    variant_sizes = sorted(((get_variant_size(_image_object.size, variant), variant_index) \
+        for variant_index, variant in enumerate(_variants)), \
+        key=lambda _size_and_index: -_size_and_index[0][0])
+
+    previous_image = _image_object
+    for size, variant_index in variant_sizes:
+        if size != previous_image.size:
+            with timed("resize"):
+                resized_image = previous_image.resize(size, Image.Resampling.LANCZOS)
+            if previous_image is not _image_object:
+                previous_image.close()
+            previous_image = resized_image
+        yield variant_index, previous_image
+
+    if previous_image is not _image_object:
+        previous_image.close()
+
+
+def get_variant_paths(_output_image_path : str, _variants : Optional[list[PadVariant]]) \
+    -> list[str]:
+    """
+    Returns the path each of _variants is saved to: a subdirectory, named after the variant's
+        width and aspect ratio (e.g., "1080@4x5" or "full"), of the directory that
+        _output_image_path is in, with the variant's file extension.
+    With no _variants, the image is just saved to _output_image_path.
+    """
+    if not _variants:
+        return [_output_image_path]
+
+    output_dir, file_name = os.path.split(_output_image_path)
+    variant_paths = []
+    for variant in _variants:
+        variant_name = str(variant.width or FULL_SIZE_VARIANT)
+        if variant.aspect_ratio != (1, 1):
+            variant_name += f"{VARIANT_RATIO_SEPARATOR}{variant.aspect_ratio[0]}x" \
+                f"{variant.aspect_ratio[1]}"
+        variant_file_name = file_name if variant.extension is None else \
+            os.path.splitext(file_name)[0] + variant.extension
+        variant_paths.append(os.path.join(output_dir, variant_name, variant_file_name))
+
+    return variant_paths
+
+
+def plan_outputs(_command_name : str, _input_image_paths : Iterable[str], \
+    _output_image_dir : str, _input_image_dir : Optional[str] = None, \
+    _variants : Optional[list[PadVariant]] = None, \
+    _alternatives_mode : str = DEFAULT_ALTERNATIVES_MODE, _num_jobs : Optional[int] = None) \
+    -> Iterator[Tuple[str, list[str]]]:
+    """
+    Yields the input path and output paths of every job that _command_name (rename, pad,
+        neg or a pipeline without a merge) would do for _input_image_paths, without doing them.
+    _input_image_dir, _variants, _alternatives_mode and _num_jobs are as given to the command.
+    """
+    if _command_name == RENAMING_COMMAND:
+        for input_path, output_path in check_rename_conflicts(plan_renames(_input_image_paths, \
+            _output_image_dir, _alternatives_mode == HASH_ALTERNATIVES, _num_jobs)):
+            yield input_path, [output_path]
+        return
+
+    for input_path in _input_image_paths:
+        output_path = get_output_path(input_path, _output_image_dir, _input_image_dir)
+        yield input_path, get_variant_paths(output_path, \
+            _variants if _command_name == PADDING_COMMAND else None)
+
+
+def negative_images(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _num_jobs : Optional[int] = None, _force : bool = False, \
+    _input_image_dir : Optional[str] = None, _queue_depths : Optional[QueueDepths] = None, \
+    _memory_budget : Optional[MemoryBudget] = None, _settings : Optional[NegativeSettings] = None, \
+    _encoder : Optional[EncoderSettings] = None, _manifest_name : str = MANIFEST_NAME) \
+    -> list[JobFailure]:
     """
     Takes a set of images and makes them negative.
+    _settings decide how (see negative_engine.invert_negative()); by default the colours
+        are just inverted. The negatives are encoded according to _encoder.
+    The manifest is kept under _manifest_name (e.g., for one shard of a batch).
+    Images which were already made negative by a previous run are skipped,
+        unless _force is True.
+    If _input_image_dir is given, images in its subdirectories are saved in the same
+        subdirectories of _output_image_dir (see get_output_path()).
+    If _queue_depths is given, reading and saving the images overlaps with the work on
+        them (see batch.run_batch()).
+    If _memory_budget is given, only as many images are worked on at once as are expected
+        to fit in it.
 
     Saves the negative images in a new directory, defined by NEGATIVE_SUFFIX
+    Returns the images which could not be made negative.
     """
-    for image in _input_image_paths:
+    manifest = Manifest(_output_image_dir, [NEGATIVE_COMMAND, repr(_settings)] + \
+        get_encoder_arguments(_encoder), _force, _manifest_name)
+    memory_estimates = JobMemoryEstimates() if _memory_budget is not None else None
+    jobs = manifest.remove_up_to_date_jobs(make_image_jobs(_input_image_paths, \
+        _output_image_dir, _input_image_dir, (_settings, _encoder), \
+        [(NEGATIVE_COMMAND, _settings)], memory_estimates))
+
+    failures = run_batch(negative_image, jobs, _num_jobs, manifest.record_job, _queue_depths, \
+        _memory_budget, memory_estimates.take if memory_estimates else None)
+    manifest.save()
+    return failures
+
+
+def negative_image(_input_image_path : str, _output_image_path : str, \
+    _settings : Optional[NegativeSettings] = None, _encoder : Optional[EncoderSettings] = None, \
+    _orientation : Optional[int] = None, _input_data : Optional[bytes] = None, \
+    _defer_save : Optional[Callable] = None) -> None:
+    """
+    Makes a single image negative according to _settings, and saves it to _output_image_path.
+    _orientation is the image's EXIF orientation, if it is already known.
+    _input_data and _defer_save are passed on to load_image() and save_image().
+    Uncompressed and deflate compressed TIFFs are made negative a strip at a time instead
+        (see tiff_strips.transform_tiff()).
+    """
+    if transform_tiff(_input_image_path, _output_image_path, [(NEGATIVE_COMMAND, _settings)]):
+        return
+
+    with load_image(_input_image_path, _input_data) as image_object:
+
+        #Rotate the image based on the EXIF data's orientation tag.
+        #Ensures that images taller than they are wide are kept as such when padding
+        image_object = apply_orientation(image_object, _orientation)
+
+        #Invert the image to make it negative, then save it.
+        with timed("transform"):
+            image_object = negative_image_object(image_object, _settings)
+        save_image(image_object, _output_image_path, _defer_save, _encoder)
+
+
+def negative_image_object(_image_object : Image.Image, \
+    _settings : Optional[NegativeSettings] = None) -> Image.Image:
+    """
+    Returns a copy of _image_object whose colours have been inverted according to _settings
+        (see negative_engine.invert_negative()).
+    """
+    return invert_negative(_image_object, _settings)
+
+
+def pipeline_images(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _stages : list[tuple], _num_jobs : Optional[int] = None, _force : bool = False, \
+    _input_image_dir : Optional[str] = None, _queue_depths : Optional[QueueDepths] = None, \
+    _memory_budget : Optional[MemoryBudget] = None, _encoder : Optional[EncoderSettings] = None, \
+    _manifest_name : str = MANIFEST_NAME) -> list[JobFailure]:
+    """
+    Takes a set of images and puts each of them through a series of _stages,
+        where each stage is a command name and its arguments (see apply_stages).
+    e.g., [(NEGATIVE_COMMAND, None), (PADDING_COMMAND, BLACK_COLOUR)]
+    Each image is only decoded and encoded once, rather than once per stage,
+        and is encoded according to _encoder.
+    The manifest is kept under _manifest_name (e.g., for one shard of a batch).
+    Images which were already made by a previous run are skipped, unless _force is True.
+    If _input_image_dir is given, images in its subdirectories are saved in the same
+        subdirectories of _output_image_dir (see get_output_path()).
+    If _queue_depths is given, reading and saving the images overlaps with the work on
+        them (see batch.run_batch()).
+    If _memory_budget is given, only as many images are worked on at once as are expected
+        to fit in it.
 
-        with Image.open(image) as image_object:
+    Saves the images in a new directory, defined by PIPELINE_SUFFIX
+    Returns the images which could not be processed.
+    """
+    manifest = Manifest(_output_image_dir, [PIPELINE_COMMAND, repr(_stages)] + \
+        get_encoder_arguments(_encoder), _force, _manifest_name)
+    memory_estimates = JobMemoryEstimates() if _memory_budget is not None else None
+    jobs = manifest.remove_up_to_date_jobs(make_image_jobs(_input_image_paths, \
+        _output_image_dir, _input_image_dir, (_stages, _encoder), _stages, \
+        memory_estimates))
+
+    failures = run_batch(pipeline_image, jobs, _num_jobs, manifest.record_job, _queue_depths, \
+        _memory_budget, memory_estimates.take if memory_estimates else None)
+    manifest.save()
+    return failures
 
-            #Rotate the image based on the EXIF data's orientation tag.
-            #Ensures that images taller than they are wide are kept as such when padding
-            image_object = PIL.ImageOps.exif_transpose(image_object)
 
-            #Invert the image to make it negative, then save it.
-            image_object = PIL.ImageOps.invert(image_object)
-            image_object.save(_output_image_dir + os.path.basename(image))
+def pipeline_image(_input_image_path : str, _output_image_path : str, _stages : list[tuple], \
+    _encoder : Optional[EncoderSettings] = None, _orientation : Optional[int] = None, \
+    _input_data : Optional[bytes] = None, _defer_save : Optional[Callable] = None) -> None:
+    """
+    Puts a single image through all of _stages, and saves it to _output_image_path.
+    _orientation is the image's EXIF orientation, if it is already known.
+    _input_data and _defer_save are passed on to load_image() and save_image().
+    Uncompressed and deflate compressed TIFFs are put through _stages a strip at a time
+        instead, where they can be (see tiff_strips.transform_tiff()).
+    """
+    if transform_tiff(_input_image_path, _output_image_path, _stages):
+        return
 
+    with load_image(_input_image_path, _input_data) as image_object:
+        image_object = apply_orientation(image_object, _orientation)
+        with timed("transform"):
+            image_object = apply_stages(image_object, _stages)
+        save_image(image_object, _output_image_path, _defer_save, _encoder)
+
+
+def apply_stages(_image_object : Image.Image, _stages : list[tuple]) -> Image.Image:
+    """
+    Applies each of the per-image _stages to _image_object in turn, returning the result.
+    Each stage is a tuple of a command name followed by that command's arguments:
+        (NEGATIVE_COMMAND, <negative settings, or None>)
+        (PADDING_COMMAND, <pad colour>)
+    """
+    for stage in _stages:
+        if stage[0] == NEGATIVE_COMMAND:
+            _image_object = negative_image_object(_image_object, *stage[1:])
+        elif stage[0] == PADDING_COMMAND:
+            _image_object = pad_image_object(_image_object, stage[1])
+        else:
+            raise ValueError(f"{stage[0]} can't be used as a pipeline stage")
+
+    return _image_object
+
+
+def get_staged_size(_size : Tuple[int,int], _stages : list[tuple]) -> Tuple[int,int]:
+    """
+    Returns the size an image of _size will be once it has been through _stages,
+        without having to decode it.
+    """
+    for stage in _stages:
+        if stage[0] == PADDING_COMMAND:
+            _size = (max(_size), max(_size))
 
-def merge_images(_input_image_paths : list[str], _output_image_dir : str, \
-    _constraint_amount : int, _constraint_type : Direction, _fill_direction : Direction) -> None:
+    return _size
+
+
+def merge_images(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _constraint_amount : int, _constraint_type : Direction, _fill_direction : Direction, \
+    _band_rows : int = DEFAULT_MERGE_BAND_ROWS, _tile_size : Optional[Tuple[int,int]] = None, \
+    _output_width : Optional[int] = None, _force : bool = False, _stages : list[tuple] = (), \
+    _queue_depths : Optional[QueueDepths] = None, _memory_budget : Optional[MemoryBudget] = None, \
+    _output_format : str = DEFAULT_MERGE_FORMAT, _num_jobs : Optional[int] = None, \
+    _encoder : Optional[EncoderSettings] = None, _thumbnail_cache_size : Optional[int] = None, \
+    _layout : str = DEFAULT_MERGE_LAYOUT) -> None:
     #_num_rows : int, ) -> None:
     """
         _fill_direction determines whether the images are placed column-wise or row-wise.
         _constraint_type determines whether the number of rows or columns has been constrained.
         _constraint_amount is the fixed number of rows or columns given by the user.
+        _band_rows is how many rows of the grid are put together in memory at once.
+        _tile_size (width, height) and _output_width optionally shrink the images to fit
+            inside tiles of that size, or to make the merged image that wide.
+
+    The merged image is built and written out one band of grid rows at a time, so only
+        the images in the current band are ever decoded, however big the grid is.
+    When the images are being shrunk, JPEGs are decoded straight to a reduced size.
+    Nothing is done if a previous run already merged the same images in the same way,
+        unless _force is True.
+    If there are any per-image _stages (see apply_stages), each image is rotated according
+        to its EXIF orientation, and put through the stages before being merged.
+    If _queue_depths is given, the images are read ahead of being pasted, and each band
+        is encoded and written on another thread while the next band is put together.
+    If _memory_budget is given, fewer than _band_rows rows are put together at once
+        if that many wouldn't fit in it.
+    _output_format is either a single PNG, a Deep Zoom pyramid of tiles (see deep_zoom.py)
+        for merges too big to open as one image, whose tiles are saved on _num_jobs threads,
+        or a single JPEG (which, unlike the others, is put together in memory in full).
+    The merged image (or its tiles) are encoded according to _encoder.
+    If _thumbnail_cache_size is given, images which are shrunk to half their size or less
+        are kept in (and taken from) a cache of that many bytes (see thumbnail_cache.py),
+        so merging them again, in any layout, doesn't decode them again.
+    _layout is either a regular grid, a compact grid whose rows and columns are each only as
+        big as their images, or justified rows (or columns) with no space between the images
+        (see merge_layout.py). Compact and justified layouts turn each image the right way
+        up according to its EXIF orientation, as the stages do.
 
     Note that while the user has the option to constrain the number of rows or columns,
         different commands can result in the same file.
@@ -132,16 +701,21 @@ def merge_images(_input_image_paths : list[str], _output_image_dir : str, \
             python photo_tools.py d/ merge 2 row column
         would yield a different image, since here the images are being filled by column.)
     """
-    #Find the largest x/y sizes of all input images to ensure the resulting merged image
-    #   will conform to some amount of regularity
-    image_x_sizes = []
-    image_y_sizes = []
-    for image in _input_image_paths:
-        with Image.open(image) as image_object:
-            image_x_sizes.append(image_object.size[0])
-            image_y_sizes.append(image_object.size[1])
-    largest_x = max(image_x_sizes)
-    largest_y = max(image_y_sizes)
+    #Find the sizes of all input images, which decide where each of them goes
+    #(this only reads the images' headers, or remembers them from a previous run)
+    #Every image's position depends on how many there are, so they are all listed up front
+    images_metadata = read_image_metadata(_input_image_paths)
+    _input_image_paths = [metadata.path for metadata in images_metadata]
+    if _stages or _layout != MERGE_LAYOUT_GRID:
+        image_sizes = [get_staged_size(metadata.oriented_size, _stages) \
+            for metadata in images_metadata]
+        orientations = [metadata.orientation for metadata in images_metadata]
+    else:
+        #Pillow turns TIFFs the right way up as it decodes them, unlike other formats
+        image_sizes = [metadata.oriented_size if is_tiff_path(metadata.path) \
+            else (metadata.width, metadata.height) for metadata in images_metadata]
+        orientations = [1] * len(images_metadata)
+    image_has_alpha = any(metadata.has_alpha for metadata in images_metadata)
 
     #Since the user fixed the number of images and rows, we can decide the number of columns
     if _constraint_type == Direction.ROW:
@@ -156,62 +730,379 @@ def merge_images(_input_image_paths : list[str], _output_image_dir : str, \
     else:
         sys.exit("Merge dimension constraint error")
 
-    #Generate the coordinates for each of the images, based on how many rows/coulmns
-    #   the user specified, and whether the images are being placed filling row by row
-    #   or filling column by column
-    coordinates = generate_image_coordinates(_fill_direction, len(_input_image_paths), \
-        num_rows, num_columns, largest_x, largest_y)
-
-    #Set up the new image, whose dimensions accommodate all input images (and maybe a
-    #   bit of extra blank space, depending on how evenly the images fit)
-    with Image.new("RGBA", (largest_x * num_columns, largest_y * num_rows), \
-        WHITE_COLOUR_ALPHA) as new_canvas:
-
-        #Paste all of the input images to the new canvas
-        image_count = 0
-        for image in _input_image_paths:
-            with Image.open(image) as image_object:
-                new_canvas.paste(image_object, coordinates[image_count])
-                image_count += 1
-
-        #Once all the images have been pasted in, then save the image.
-        new_canvas.save(f"{_output_image_dir}({num_rows}x{num_columns})_"
-            f"{direction_to_string(_fill_direction)}-merged.PNG")
-
-
-def generate_image_coordinates(direction : Direction, _num_images : int, \
-    _num_rows : int, _num_cols : int, _x : int, _y : int) -> list[Tuple[int,int]]:
-    """
-    Generates coordinates for a grid where either:
-        i) a column is filled to a specified number of rows before moving on to the next column, or
-        ii) a row is filled to a specified number of columns before moving on to the next row.
-    """
-    coordinates = []
-    image_counter = 0
-    if direction == Direction.COLUMN:
-        column_counter = 0
-        #using a "do-while" loop to get the increment in just before the final mod check
-        #    (this avoids havging the column counter increment on the first run when 0 % 0 == 0)
-        while image_counter < _num_images:
-            coordinates.append( (column_counter * _x, (image_counter % _num_rows) * _y) )
-            #Every _num_rows images, we move on to the next column
-            image_counter += 1
-            if image_counter % _num_rows == 0:
-                column_counter += 1
-
-    elif direction == Direction.ROW:
-        row_counter = 0
-        while image_counter < _num_images:
-            coordinates.append( ((image_counter % _num_cols) * _x, row_counter * _y) )
-            #Every _num_cols images, we move on to the next row
-            image_counter += 1
-            if image_counter % _num_cols == 0:
-                row_counter += 1
+    #Work out where each of the images goes (and how much it's shrunk by), based on how many
+    #   rows/columns the user specified, and whether the images are being placed filling
+    #   row by row or filling column by column
+    layout = plan_merge_layout(_layout, image_sizes, _fill_direction, num_rows, num_columns, \
+        _tile_size, _output_width)
+    debug(f"Merging into a {layout.size[0]}x{layout.size[1]} {_layout} layout")
+
+    #Only keep an alpha channel if one of the images actually needs it (and it can be saved)
+    if image_has_alpha and _output_format != MERGE_FORMAT_JPEG:
+        canvas_mode, background_colour = "RGBA", WHITE_COLOUR_ALPHA
+    else:
+        canvas_mode, background_colour = "RGB", WHITE_COLOUR
+
+    if _memory_budget is not None:
+        _band_rows = fit_merge_band_rows(_memory_budget, _band_rows, images_metadata, layout, \
+            get_decoded_size((layout.size[0], 1), canvas_mode), _queue_depths)
+
+    #Sort the images into the bands of rows that they will be pasted into
+    bands = layout.get_bands(_band_rows)
+    band_images = [[] for _ in bands]
+    for image, orientation, scale, box, band_index in zip(_input_image_paths, orientations, \
+        layout.scales.tolist(), layout.boxes.tolist(), \
+        layout.get_band_indices(_band_rows).tolist()):
+        band_images[band_index].append((image, orientation, scale, box))
 
+    #Other layouts of the same images are kept alongside the grid, to compare them
+    layout_suffix = "" if _layout == MERGE_LAYOUT_GRID else f"-{_layout}"
+    merged_path = f"{_output_image_dir}({num_rows}x{num_columns})_" \
+        f"{direction_to_string(_fill_direction)}{layout_suffix}-merged" \
+        f"{MAP_MERGE_FORMAT_TO_EXTENSION[_output_format]}"
+    manifest = Manifest(_output_image_dir, [MERGE_COMMAND, _layout, list(layout.size), \
+        canvas_mode, layout.boxes.tolist(), repr(_stages)] + get_encoder_arguments(_encoder), \
+        _force)
+    if manifest.is_up_to_date(merged_path, _input_image_paths):
+        print(f"Skipping {merged_path}, which is already up to date")
+        return
+
+    thumbnail_cache = None
+    if _thumbnail_cache_size and \
+        any(get_cached_scale(scale) is not None for scale in layout.scales.tolist()):
+        thumbnail_cache = ThumbnailCache(get_thumbnail_cache_dir(), _thumbnail_cache_size)
+
+    #The new image's dimensions accommodate all input images (and maybe a bit of
+    #   extra blank space, depending on how evenly the images fit)
+    #Images are read in the order they are pasted, i.e., band by band
+    pasting_order = [image for images in band_images for image in images]
+    if _queue_depths is not None:
+        #The files of images which are already in the cache don't need to be read
+        cached_images = set() if thumbnail_cache is None else {image \
+            for image, orientation, scale, _ in pasting_order \
+            if get_cached_scale(scale) is not None and \
+            thumbnail_cache.contains(image, get_cached_scale(scale), orientation)}
+        #The images are always read in this process
+        read_images = prefetch_files(pasting_order, _queue_depths.get_read_ahead(1), \
+            lambda _image_path: _image_path not in cached_images)
     else:
-        sys.exit("Coordinate direction error")
+        read_images = ((image, None) for image in pasting_order)
+
+    #Only one band is written while the next is put together, as bands can be very big.
+    #The writer thread is the innermost context, so it finishes before the file is closed
+    with atomic_output(merged_path) as temp_path, open_merge_writer(_output_format, \
+        temp_path, merged_path, layout.size, canvas_mode, _num_jobs, _encoder) as writer, \
+        BackgroundWriter(1, 1) as band_writer:
+
+        try:
+            for band_index, ((band_top, band_bottom), images) in \
+                enumerate(zip(bands, band_images)):
+                #Paste this band's images onto a canvas just big enough for the band,
+                #   then write it out before moving on to the next one
+                band_canvas = Image.new(canvas_mode, (layout.size[0], band_bottom - band_top), \
+                    background_colour)
+                for _ in images:
+                    (image, orientation, scale, (x, y, width, height)), input_data = \
+                        next(read_images)
+                    if isinstance(input_data, OSError):
+                        raise input_data
+                    #Without stages, each image is shrunk straight to the size of its box
+                    with open_merge_image(image, scale, orientation, input_data, \
+                        thumbnail_cache, None if _stages else (width, height)) as image_object:
+                        with timed("transform"):
+                            merged_image = apply_stages(reduce_to_eight_bits(image_object), \
+                                _stages)
+                            #The stages can leave an image a pixel out from the size of its box
+                            if merged_image.size != (width, height):
+                                merged_image = merged_image.resize((width, height), \
+                                    Image.Resampling.LANCZOS)
+                            band_canvas.paste(merged_image, (x, y - band_top))
+
+                if _queue_depths is None:
+                    write_band(writer, band_canvas)
+                else:
+                    band_writer.submit(band_index, write_band, writer, band_canvas)
+
+                #Stop as soon as writing a band has gone wrong
+                for _, future in band_writer.take_finished():
+                    future.result()
+            for _, future in band_writer.take_finished(_wait=True):
+                future.result()
+        finally:
+            read_images.close()
+            if thumbnail_cache is not None:
+                thumbnail_cache.close()
+
+    manifest.record(merged_path, _input_image_paths)
+    manifest.save()
+
+
+def fit_merge_band_rows(_memory_budget : MemoryBudget, _band_rows : int, \
+    _images_metadata : list[ImageMetadata], _layout : MergeLayout, _pixel_row_bytes : int, \
+    _queue_depths : Optional[QueueDepths] = None) -> int:
+    """
+    Returns the most rows of _layout (up to _band_rows) that merge_images() can put together
+        at once while staying within _memory_budget, given that each row of pixels of the
+        merged image takes _pixel_row_bytes.
+    Besides the band being put together, the memory needed is that of the band being
+        written (if that is done in the background), the files read ahead, and the biggest
+        image being decoded and shrunk by its scale in _layout.
+    JPEGs are decoded at no more than twice the size they are shrunk to (see open_scaled_image()).
+    """
+    image_bytes = max(int(get_decoded_size((metadata.width, metadata.height), metadata.mode) \
+        * min(1.0, 2 * scale)**2) \
+        for metadata, scale in zip(_images_metadata, _layout.scales.tolist()))
+    read_ahead_bytes = 0
+    if _queue_depths is not None:
+        read_ahead_bytes = _queue_depths.get_read_ahead(1) * \
+            max(metadata.file_size for metadata in _images_metadata)
+    other_bytes = 2 * image_bytes + read_ahead_bytes
+    bands_held = 2 if _queue_depths is not None else 1
+    get_band_bytes = lambda _rows: bands_held * _layout.get_max_band_height(_rows) * \
+        _pixel_row_bytes
+
+    band_rows = _band_rows
+    while band_rows > 1 and get_band_bytes(band_rows) + other_bytes > _memory_budget.max_bytes:
+        band_rows -= 1
+
+    if band_rows < _band_rows:
+        print(f"Merging {band_rows} grid rows at a time (rather than {_band_rows}) "
+            f"to stay within the memory limit")
+    if get_band_bytes(band_rows) + other_bytes > _memory_budget.max_bytes:
+        print("Warning: merging a single grid row at a time may still use more memory "
+            "than the limit allows; try --tile-size or --output-width to shrink the images")
+    return band_rows
+
+
+class CanvasWriter:
+    """
+    Pastes the bands of a merged image onto one canvas, which is saved (in the format given
+        by _path's extension) once every band has been written.
+    Used for formats which can't be written a few rows at a time.
+    """
+    def __init__(self, _path : str, _size : Tuple[int,int], _mode : str, \
+        _encoder : Optional[EncoderSettings] = None) -> None:
+        self.path = _path
+        self.canvas = Image.new(_mode, _size)
+        self.encoder = _encoder
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        with self.canvas:
+            if _exception_type is None:
+                if self.rows_written != self.canvas.size[1]:
+                    raise ValueError(f"Only {self.rows_written} of the merged image's "
+                        f"{self.canvas.size[1]} rows were written")
+                save_image(self.canvas, self.path, _encoder=self.encoder)
+
+    def write_rows(self, _band : Image.Image) -> None:
+        """
+        Pastes _band onto the canvas, directly below any rows that have already been written.
+        """
+        self.canvas.paste(_band, (0, self.rows_written))
+        self.rows_written += _band.size[1]
+
+
+def open_merge_writer(_output_format : str, _temp_path : str, _merged_path : str, \
+    _size : Tuple[int,int], _mode : str, _num_jobs : Optional[int] = None, \
+    _encoder : Optional[EncoderSettings] = None) \
+    -> Union[PngStreamWriter, DeepZoomWriter, CanvasWriter]:
+    """
+    Returns a writer which the merged image's bands are written to, in _output_format,
+        encoded according to _encoder.
+    The merged image itself is written to _temp_path (see atomic_output()), and a Deep Zoom
+        image's tiles are saved alongside _merged_path.
+    """
+    if _output_format == MERGE_FORMAT_DEEP_ZOOM:
+        return DeepZoomWriter(_temp_path, get_deep_zoom_files_dir(_merged_path), _size, _mode, \
+            lambda _tile, _tile_path: save_image(_tile, _tile_path, _encoder=_encoder), \
+            _num_jobs or default_num_jobs())
+    if _output_format == MERGE_FORMAT_JPEG:
+        return CanvasWriter(_temp_path, _size, _mode, _encoder)
+    return PngStreamWriter(_temp_path, _size, _mode, \
+        get_save_options(_encoder, "PNG").get("compress_level", DEFAULT_PNG_COMPRESS_LEVEL))
+
+
+def write_band(_writer : Union[PngStreamWriter, DeepZoomWriter, CanvasWriter], \
+    _band_canvas : Image.Image) -> None:
+    """
+    Writes out (and then closes) one band of a merged image.
+    """
+    with _band_canvas, timed("encode"):
+        _writer.write_rows(_band_canvas)
 
-    return coordinates
+
+def load_image(_image_path : str, _input_data : Optional[bytes] = None) -> Image.Image:
+    """
+    Opens and fully decodes the image at _image_path.
+    If the file has already been read (see background_io.prefetch_files()), its contents
+        can be given as _input_data, and are decoded instead.
+    """
+    with timed("decode"):
+        image_object = open_image(_image_path, _input_data)
+        image_object.load()
+    count_input_bytes(_image_path, _input_data)
+
+    return image_object
+
+
+def open_image(_image_path : str, _input_data : Optional[bytes] = None) -> Image.Image:
+    """
+    Opens (without decoding) the image at _image_path, or its contents in _input_data if given.
+    """
+    if _input_data is None:
+        return Image.open(_image_path)
+
+    try:
+        return Image.open(io.BytesIO(_input_data))
+    except PIL.UnidentifiedImageError:
+        #Name the file, rather than the in-memory copy of it
+        raise PIL.UnidentifiedImageError(f"cannot identify image file {_image_path!r}") from None
+
+
+def count_input_bytes(_image_path : str, _input_data : Optional[bytes] = None) -> None:
+    """
+    Adds the size of _image_path (or of its already-read _input_data) to the bytes read,
+        if they are being counted.
+    """
+    if instrumentation.ENABLED:
+        instrumentation.count_bytes("in", os.path.getsize(_image_path) \
+            if _input_data is None else len(_input_data))
+
+
+def save_image(_image_object : Image.Image, _output_image_path : str, \
+    _defer_save : Optional[Callable] = None, _encoder : Optional[EncoderSettings] = None) -> None:
+    """
+    Encodes _image_object in the format given by _output_image_path's extension, with the
+        options given by _encoder (or Pillow's defaults), then writes it to _output_image_path
+        (see atomic_output()).
+    If _defer_save is given, this is handed to it to be done later instead
+        (e.g., on a writer thread; see batch.run_overlapped_jobs()).
+    """
+    if _defer_save is not None:
+        _defer_save(save_image, _image_object, _output_image_path, None, _encoder)
+        return
+
+    with timed("encode"):
+        encoded_image = io.BytesIO()
+        image_format = Image.registered_extensions()[ \
+            os.path.splitext(_output_image_path)[1].lower()]
+        _image_object.save(encoded_image, image_format, \
+            **get_save_options(_encoder, image_format))
+
+    with timed("write"), atomic_output(_output_image_path) as temp_path:
+        with open(temp_path, "wb") as output_file:
+            output_file.write(encoded_image.getbuffer())
+    instrumentation.count_bytes("out", encoded_image.tell())
+
+
+def apply_orientation(_image_object : Image.Image, _orientation : Optional[int] = None) \
+    -> Image.Image:
+    """
+    Rotates/flips _image_object according to its EXIF orientation.
+    If _orientation is already known to be 1 (i.e., upright), then the image is returned
+        as it is, rather than being copied.
+    """
+    if _orientation == 1:
+        return _image_object
+    with timed("exif_transpose"):
+        return PIL.ImageOps.exif_transpose(_image_object)
+
+
+def reduce_to_eight_bits(_image_object : Image.Image) -> Image.Image:
+    """
+    Returns an 8-bit greyscale copy of _image_object if it is a 16-bit greyscale image
+        (which Pillow clips, rather than scales, when converting it to 8 bits),
+        or otherwise _image_object itself.
+    """
+    if _image_object.mode not in SIXTEEN_BIT_MODES and not _image_object.mode.startswith("I;16"):
+        return _image_object
+    return _image_object.convert("I").point(lambda _value: _value / 257).convert("L")
+
+
+def open_merge_image(_image_path : str, _scale : float, _orientation : Optional[int], \
+    _input_data : Optional[bytes], _thumbnail_cache : Optional[ThumbnailCache], \
+    _size : Optional[Tuple[int,int]] = None) -> Image.Image:
+    """
+    Returns _image_path rotated and shrunk by _scale (see open_scaled_image()), or to
+        exactly _size (width, height) if given.
+    If _thumbnail_cache is given and the image is being shrunk enough to be kept in it,
+        its cached copy (see thumbnail_cache.get_cached_scale()) is shrunk the rest of the
+        way instead, decoding the image and caching that copy first if there isn't one.
+    """
+    cached_scale = get_cached_scale(_scale)
+    if _thumbnail_cache is None or cached_scale is None:
+        return decode_scaled_image(_image_path, _scale, _orientation, _input_data, _size)[0]
+
+    with timed("decode"):
+        cached = _thumbnail_cache.load(_image_path, cached_scale, _orientation)
+    if cached is None:
+        cached = decode_scaled_image(_image_path, cached_scale, _orientation, _input_data)
+        _thumbnail_cache.store(_image_path, cached_scale, _orientation, *cached)
+
+    cached_image, full_size = cached
+    with cached_image, timed("resize"):
+        return cached_image.resize(_size or get_scaled_size(full_size, _scale), \
+            Image.Resampling.LANCZOS)
+
+
+def open_scaled_image(_image_path : str, _scale : float, _orientation : Optional[int] = 1, \
+    _input_data : Optional[bytes] = None) -> Image.Image:
+    """
+    Opens _image_path (or its already-read _input_data), rotates it according to
+        _orientation (see apply_orientation), and shrinks it by _scale.
+    JPEGs are decoded straight to the nearest reduced size (1/2, 1/4 or 1/8) which is still
+        at least as big as needed, so only that much smaller image has to be resized.
+    """
+    return decode_scaled_image(_image_path, _scale, _orientation, _input_data)[0]
+
+
+def decode_scaled_image(_image_path : str, _scale : float, _orientation : Optional[int] = 1, \
+    _input_data : Optional[bytes] = None, _size : Optional[Tuple[int,int]] = None) \
+    -> tuple[Image.Image, Tuple[int,int]]:
+    """
+    Does the work of open_scaled_image(), returning the shrunken image along with the
+        (width, height) the image has at full size once rotated.
+    If _size is given, the rotated image is shrunk to exactly that (width, height), which
+        should be about its size shrunk by _scale.
+    """
+    if _scale >= 1:
+        image_object = apply_orientation(load_image(_image_path, _input_data), _orientation)
+        full_size = image_object.size
+        if _size is not None and _size != full_size:
+            with image_object, timed("resize"):
+                image_object = image_object.resize(_size, Image.Resampling.LANCZOS)
+        return image_object, full_size
+
+    with timed("decode"):
+        image_object = open_image(_image_path, _input_data)
+        full_size = image_object.size
+        new_size = get_scaled_size(full_size, _scale)
+
+        #Has no effect on formats other than JPEG
+        image_object.draft(image_object.mode, new_size)
+        image_object.load()
+    count_input_bytes(_image_path, _input_data)
+
+    with image_object:
+        oriented_image = apply_orientation(image_object, _orientation)
+
+        #The width and height swap over if the image was turned on its side
+        if oriented_image.size != image_object.size:
+            new_size = (new_size[1], new_size[0])
+            full_size = (full_size[1], full_size[0])
+        with timed("resize"):
+            return oriented_image.resize(_size or new_size, Image.Resampling.LANCZOS), full_size
+
+
+def get_scaled_size(_size : Tuple[int,int], _scale : float) -> Tuple[int,int]:
+    """
+    Returns the size of an image of _size once it has been shrunk by _scale.
+    """
+    return max(1, round(_size[0] * _scale)), max(1, round(_size[1] * _scale))
 
 
 def get_alternative_flag(_image_path : str) -> str:
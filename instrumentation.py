@@ -0,0 +1,155 @@
+"""Times each stage of the work done on every image, and reports on where the time went.
+
+Timing is off until enable() is called, and costs next to nothing while it is off.
+
+e.g.,
+    with timed("decode"):
+        image_object.load()
+"""
+import json
+import sys
+import threading
+import time
+
+from typing import Optional
+
+#Whether stages are currently being timed
+ENABLED = False
+
+#Durations (in seconds) of every timed stage, by stage name
+stage_durations = {}
+
+#Total bytes read from input files and written to output files
+byte_counts = {"in" : 0, "out" : 0}
+#Bytes can be counted from the reader and writer threads at the same time
+byte_counts_lock = threading.Lock()
+
+class StageTimer:
+    """Adds the time spent inside a "with" block to a stage's durations"""
+    def __init__(self, _stage_name : str) -> None:
+        self.stage_name = _stage_name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        stage_durations.setdefault(self.stage_name, []).append( \
+            time.perf_counter() - self.start_time)
+
+
+class NullTimer:
+    """Stands in for a StageTimer when timing is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        pass
+
+#Shared, so that nothing has to be created when timing is off
+NULL_TIMER = NullTimer()
+
+
+def enable(_enabled : bool = True) -> None:
+    """
+    Turns timing on (or off).
+    """
+    global ENABLED #pylint: disable=global-statement
+    ENABLED = _enabled
+
+
+def timed(_stage_name : str):
+    """
+    Returns a context manager which times its block as part of _stage_name.
+    """
+    if ENABLED:
+        return StageTimer(_stage_name)
+    return NULL_TIMER
+
+
+def count_bytes(_direction : str, _num_bytes : int) -> None:
+    """
+    Adds _num_bytes to the bytes read ("in") or written ("out").
+    """
+    if ENABLED:
+        with byte_counts_lock:
+            byte_counts[_direction] += _num_bytes
+
+
+def take_records() -> Optional[tuple[dict, dict]]:
+    """
+    Returns everything recorded so far, and forgets it.
+    Used to send a worker process's records back to the main process.
+    Returns None if timing is off.
+    """
+    if not ENABLED:
+        return None
+
+    records = (dict(stage_durations), dict(byte_counts))
+    reset()
+    return records
+
+
+def reset() -> None:
+    """
+    Forgets everything recorded so far, e.g., before each job run by a long-lived process.
+    """
+    stage_durations.clear()
+    with byte_counts_lock:
+        byte_counts.update({"in" : 0, "out" : 0})
+
+
+def add_records(_records : Optional[tuple[dict, dict]]) -> None:
+    """
+    Adds the records taken from another process (see take_records()) to this process's records.
+    """
+    if _records is None:
+        return
+
+    durations, counts = _records
+    for stage_name, stage_times in durations.items():
+        stage_durations.setdefault(stage_name, []).extend(stage_times)
+    for direction, num_bytes in counts.items():
+        byte_counts[direction] += num_bytes
+
+
+def get_percentile(_sorted_values : list[float], _percentile : float) -> float:
+    """
+    Returns the value _percentile percent of the way through _sorted_values.
+    """
+    return _sorted_values[min(len(_sorted_values) - 1, int(len(_sorted_values) * _percentile / 100))]
+
+
+def make_report(_wall_time : float) -> dict:
+    """
+    Summarises every stage's durations (count, total, p50, p95, max, all in seconds),
+        along with the bytes read and written, and the run's total time.
+    """
+    stages = {}
+    for stage_name, stage_times in stage_durations.items():
+        sorted_times = sorted(stage_times)
+        stages[stage_name] = {
+            "count" : len(sorted_times),
+            "total" : sum(sorted_times),
+            "p50" : get_percentile(sorted_times, 50),
+            "p95" : get_percentile(sorted_times, 95),
+            "max" : sorted_times[-1],
+        }
+
+    return {"wall_time" : _wall_time, "bytes_in" : byte_counts["in"], \
+        "bytes_out" : byte_counts["out"], "stages" : stages}
+
+
+def write_report(_report_path : str, _wall_time : float) -> None:
+    """
+    Writes the report (see make_report()) as JSON to _report_path, or to stderr
+        if _report_path is "-".
+    """
+    report = make_report(_wall_time)
+    if _report_path == "-":
+        json.dump(report, sys.stderr, indent=4)
+        sys.stderr.write("\n")
+    else:
+        with open(_report_path, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=4)
@@ -0,0 +1,125 @@
+"""Keeps track of which output files are up to date, so that re-running a command can skip them"""
+import json
+import os
+import time
+
+from typing import Callable, Iterable, Iterator, Optional
+
+from constants import *
+from file_copy import atomic_output
+
+class Manifest:
+    """
+    A record, kept in an output directory, of which inputs (and which of their sizes and
+        modification times) each output file was made from, and with which arguments.
+
+    e.g.,
+        manifest = Manifest("scans_(padded)/", ["pad", 0, 0, 0])
+        jobs = manifest.remove_up_to_date_jobs(jobs)
+        ...
+        manifest.record(output_path, [input_path])
+        manifest.save()
+
+    A job can make more than one output file, in which case _get_output_paths should
+        return all of them for a job; by default, a job's output is its second item.
+    """
+    def __init__(self, _output_image_dir : str, _arguments : list, _force : bool = False, \
+        _manifest_name : str = MANIFEST_NAME, \
+        _get_output_paths : Optional[Callable[[tuple], list[str]]] = None) -> None:
+        self.output_image_dir = _output_image_dir
+        self.path = os.path.join(_output_image_dir, _manifest_name)
+        self.arguments = _arguments
+        self.force = _force
+        self.last_saved = time.monotonic()
+        self.entries = load_manifest_entries(self.path)
+        self.get_output_paths = _get_output_paths or (lambda _job: [_job[1]])
+
+    def is_up_to_date(self, _output_path : str, _input_paths : list[str]) -> bool:
+        """
+        Returns True if _output_path exists and was made from exactly the current
+            versions of _input_paths, with the same arguments.
+        """
+        entry = self.entries.get(self.get_key(_output_path))
+        return not self.force and entry is not None and \
+            entry["arguments"] == self.arguments and \
+            entry["inputs"] == get_input_stats(_input_paths) and \
+            os.path.exists(_output_path)
+
+    def remove_up_to_date_jobs(self, _jobs : Iterable[tuple]) -> Iterator[tuple]:
+        """
+        Yields the jobs (tuples of input path, output path, and then any other arguments)
+            any of whose outputs need to be made again, as they are taken from _jobs.
+        """
+        num_skipped = 0
+        for job in _jobs:
+            if all(self.is_up_to_date(output_path, [job[0]]) \
+                for output_path in self.get_output_paths(job)):
+                num_skipped += 1
+            else:
+                yield job
+
+        if num_skipped:
+            print(f"Skipped {num_skipped} files which were already up to date")
+
+    def record(self, _output_path : str, _input_paths : list[str]) -> None:
+        """
+        Notes that _output_path has just been made from _input_paths.
+        The manifest is saved every so often, so that little is lost if the run is interrupted.
+        """
+        self.entries[self.get_key(_output_path)] = {
+            "inputs" : get_input_stats(_input_paths),
+            "arguments" : self.arguments,
+        }
+        if time.monotonic() - self.last_saved > MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def get_key(self, _output_path : str) -> str:
+        """
+        Returns the name that _output_path is recorded under, i.e., its path within
+            the output directory.
+        """
+        return os.path.relpath(_output_path, self.output_image_dir)
+
+    def record_job(self, _job : tuple) -> None:
+        """
+        Notes that a job (a tuple of input path, output path, ...) has finished successfully.
+        """
+        for output_path in self.get_output_paths(_job):
+            self.record(output_path, [_job[0]])
+
+    def save(self) -> None:
+        """
+        Writes the manifest to its output directory.
+        """
+        with atomic_output(self.path) as temp_path:
+            with open(temp_path, "w", encoding="utf-8") as manifest_file:
+                json.dump({"version" : MANIFEST_VERSION, "entries" : self.entries}, manifest_file)
+        self.last_saved = time.monotonic()
+
+
+def load_manifest_entries(_manifest_path : str) -> dict:
+    """
+    Returns the entries of the manifest at _manifest_path, or no entries if there isn't
+        a (readable, current) manifest there.
+    """
+    try:
+        with open(_manifest_path, encoding="utf-8") as manifest_file:
+            contents = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+    if contents.get("version") != MANIFEST_VERSION:
+        return {}
+    return contents["entries"]
+
+
+def get_input_stats(_input_paths : list[str]) -> list[list]:
+    """
+    Returns the path, size and modification time of each of _input_paths, which together
+        stand in for the files' contents.
+    """
+    stats = []
+    for input_path in _input_paths:
+        file_stats = os.stat(input_path)
+        stats.append([input_path, file_stats.st_size, file_stats.st_mtime_ns])
+    return stats
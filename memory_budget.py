@@ -0,0 +1,90 @@
+"""Keeps the total memory needed by the images being worked on at once within a budget"""
+import re
+
+from collections import deque
+from typing import Optional
+
+from constants import *
+
+class MemoryBudget:
+    """
+    Keeps track of how much memory the jobs which have been started (and not yet finished)
+        are expected to need, so that no more are started than fit in _max_bytes.
+    A job which needs more than the whole budget is still started, but only once nothing
+        else is running.
+
+    e.g.,
+        budget = MemoryBudget(4 * 1024**3)
+        if budget.fits(job_bytes):
+            budget.take(job_bytes)
+            ...
+            budget.give_back(job_bytes)
+    """
+    def __init__(self, _max_bytes : int) -> None:
+        self.max_bytes = _max_bytes
+        self.bytes_in_use = 0
+
+    def fits(self, _num_bytes : int) -> bool:
+        """
+        Returns True if a job needing _num_bytes can be started now.
+        """
+        return self.bytes_in_use == 0 or self.bytes_in_use + _num_bytes <= self.max_bytes
+
+    def take(self, _num_bytes : int) -> None:
+        """
+        Notes that a job needing _num_bytes has been started.
+        """
+        self.bytes_in_use += _num_bytes
+
+    def give_back(self, _num_bytes : int) -> None:
+        """
+        Notes that a job needing _num_bytes has finished.
+        """
+        self.bytes_in_use -= _num_bytes
+
+
+class JobMemoryEstimates:
+    """
+    Remembers how much memory each job (by its input path) is expected to need, from when
+        the job is made until it is started.
+    Jobs have to be started in the order they were noted in, although some can be left out
+        (e.g., ones whose outputs are already up to date), so only the jobs which have been
+        noted but not yet reached are ever remembered.
+    Can be noted in one thread (e.g., the reader thread) and taken in another.
+    """
+    def __init__(self) -> None:
+        self.estimates = deque()
+
+    def note(self, _input_path : str, _num_bytes : int) -> None:
+        """
+        Remembers that the job for _input_path is expected to need _num_bytes.
+        """
+        self.estimates.append((_input_path, _num_bytes))
+
+    def take(self, _job : tuple) -> int:
+        """
+        Returns (and forgets) how much memory _job is expected to need, also forgetting any
+            jobs noted before it, which must have been left out.
+        """
+        while True:
+            input_path, num_bytes = self.estimates.popleft()
+            if input_path == _job[0]:
+                return num_bytes
+
+
+def get_decoded_size(_size : tuple[int,int], _mode : str) -> int:
+    """
+    Returns how many bytes an image of _size and _mode takes up once it has been decoded.
+    """
+    return _size[0] * _size[1] * DECODED_BYTES_PER_PIXEL.get(_mode, MAX_DECODED_BYTES_PER_PIXEL)
+
+
+def parse_memory_size(_memory_size : str) -> Optional[int]:
+    """
+    Returns the number of bytes in _memory_size, e.g., "4G", "512M" or "1.5GB",
+        or None if it isn't a valid size.
+    """
+    match = re.search(MEMORY_SIZE_REGEX, _memory_size.upper())
+    if match is None or float(match.group(1)) <= 0:
+        return None
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
@@ -0,0 +1,254 @@
+"""Works out where each image goes in a merged image, for all of the images at once.
+
+There are three layouts:
+    grid: every image gets a cell as big as the biggest image, so the grid is regular
+        (but a roll which mixes portrait and landscape images is mostly white space).
+    compact: each column of the grid is as wide as its widest image, and each row as tall as
+        its tallest, so no more space is left around the images than their order needs.
+    justified: like a photo gallery, the images in each row are shrunk to the same height so
+        that every row is exactly as wide as the merged image, leaving no space at all.
+        The rows are split where they come out the most even, which also makes the merged
+        image as small as it can be. Filling column by column makes justified columns instead.
+Images are always placed in the order they're given, and never enlarged.
+
+e.g.,
+    layout = plan_merge_layout(MERGE_LAYOUT_JUSTIFIED, [(4000, 3000), (3000, 4000), ...],
+        Direction.ROW, 2, 4, _output_width=2000)
+    for (x, y, width, height), scale in zip(layout.boxes.tolist(), layout.scales.tolist()):
+        ...shrink the image to width x height, and paste it at (x, y)
+"""
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from constants import *
+
+class MergeLayout(NamedTuple):
+    """
+    Where each image goes in a merged image of (width, height) size.
+    boxes holds the (x, y, width, height) that each image is shrunk to and pasted at, in the
+        order the images were given, and scales how much each image is shrunk by to get there.
+    row_tops holds the top of each of the layout's rows (i.e., every height which no image
+        crosses), followed by the merged image's height, so that the merged image can be put
+        together a few rows at a time.
+    """
+    size : Tuple[int,int]
+    boxes : np.ndarray
+    scales : np.ndarray
+    row_tops : np.ndarray
+
+    def get_bands(self, _band_rows : int) -> list[Tuple[int,int]]:
+        """
+        Returns the (top, bottom) of each band of (up to) _band_rows rows, from top to bottom.
+        """
+        band_edges = np.append(self.row_tops[:-1][::_band_rows], self.row_tops[-1]).tolist()
+        return list(zip(band_edges[:-1], band_edges[1:]))
+
+    def get_band_indices(self, _band_rows : int) -> np.ndarray:
+        """
+        Returns the index of the band (see get_bands()) that each image is pasted into.
+        """
+        return np.searchsorted(self.row_tops[:-1][::_band_rows], self.boxes[:, 1], \
+            side="right") - 1
+
+    def get_max_band_height(self, _band_rows : int) -> int:
+        """
+        Returns the height of the tallest band of (up to) _band_rows rows.
+        """
+        return max((bottom - top for top, bottom in self.get_bands(_band_rows)), default=0)
+
+
+def plan_merge_layout(_layout : str, _sizes : list[Tuple[int,int]], _fill_direction : Direction, \
+    _num_rows : int, _num_columns : int, _tile_size : Optional[Tuple[int,int]] = None, \
+    _output_width : Optional[int] = None) -> MergeLayout:
+    """
+    Lays out images of _sizes (in order) in a _num_rows x _num_columns merged image, as
+        either a grid, a compact grid or justified rows (see above), filled row by row or
+        column by column according to _fill_direction.
+    The images are shrunk so that each fits inside _tile_size, and/or so that the merged
+        image is no wider than _output_width.
+    """
+    #Images whose headers can't be read have no size (and fail once they're decoded)
+    sizes = np.maximum(1, np.array(_sizes, dtype=np.int64).reshape(-1, 2))
+    if _layout == MERGE_LAYOUT_JUSTIFIED:
+        return layout_justified(sizes, _fill_direction, \
+            _num_rows if _fill_direction == Direction.ROW else _num_columns, \
+            _tile_size, _output_width)
+
+    rows, columns = get_grid_cells(_fill_direction, len(sizes), _num_rows, _num_columns)
+    if _layout == MERGE_LAYOUT_COMPACT:
+        return layout_compact(sizes, rows, columns, _num_rows, _num_columns, _tile_size, \
+            _output_width)
+    return layout_grid(sizes, rows, columns, _num_rows, _num_columns, _tile_size, _output_width)
+
+
+def get_grid_cells(_fill_direction : Direction, _num_images : int, _num_rows : int, \
+    _num_columns : int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the row and the column of each image in a grid where either:
+        i) a column is filled to _num_rows images before moving on to the next column, or
+        ii) a row is filled to _num_columns images before moving on to the next row.
+    """
+    image_indices = np.arange(_num_images)
+    if _fill_direction == Direction.COLUMN:
+        return image_indices % _num_rows, image_indices // _num_rows
+    if _fill_direction == Direction.ROW:
+        return image_indices // _num_columns, image_indices % _num_columns
+
+    sys.exit("Coordinate direction error")
+
+
+def get_merge_scale(_largest_size : Tuple[int,int], _merged_width : int, \
+    _tile_size : Optional[Tuple[int,int]] = None, _output_width : Optional[int] = None) -> float:
+    """
+    Works out how much the merged images should be shrunk by, so that every image (the
+        biggest of which is _largest_size) fits inside _tile_size, and/or the merged image,
+        which is _merged_width wide at full size, is no wider than _output_width.
+    Images are never enlarged, so the result is at most 1.
+    """
+    scale = 1.0
+    if _tile_size is not None:
+        scale = min(scale, _tile_size[0] / _largest_size[0], _tile_size[1] / _largest_size[1])
+    if _output_width is not None:
+        scale = min(scale, _output_width / _merged_width)
+
+    return float(scale)
+
+
+def scale_sizes(_sizes : np.ndarray, _scale : float) -> np.ndarray:
+    """
+    Returns _sizes once they have been shrunk by _scale (and rounded, as Pillow would).
+    """
+    return np.maximum(1, np.round(_sizes * _scale)).astype(np.int64)
+
+
+def layout_grid(_sizes : np.ndarray, _rows : np.ndarray, _columns : np.ndarray, \
+    _num_rows : int, _num_columns : int, _tile_size : Optional[Tuple[int,int]] = None, \
+    _output_width : Optional[int] = None) -> MergeLayout:
+    """
+    Lays out images of _sizes in the given _rows and _columns of a grid whose cells are all
+        as big as the biggest image, each image in the top left of its cell.
+    Every image is shrunk by the same amount (if at all), so the grid stays regular.
+    """
+    largest_size = _sizes.max(axis=0)
+    scale = get_merge_scale(largest_size, largest_size[0] * _num_columns, _tile_size, \
+        _output_width)
+    tile_x, tile_y = scale_sizes(largest_size, scale).tolist()
+
+    boxes = np.column_stack([_columns * tile_x, _rows * tile_y, scale_sizes(_sizes, scale)])
+    return MergeLayout((tile_x * _num_columns, tile_y * _num_rows), boxes, \
+        np.full(len(_sizes), scale), np.arange(_num_rows + 1) * tile_y)
+
+
+def layout_compact(_sizes : np.ndarray, _rows : np.ndarray, _columns : np.ndarray, \
+    _num_rows : int, _num_columns : int, _tile_size : Optional[Tuple[int,int]] = None, \
+    _output_width : Optional[int] = None) -> MergeLayout:
+    """
+    Lays out images of _sizes in the given _rows and _columns of a grid whose columns are
+        each as wide as their widest image, and whose rows are each as tall as their tallest,
+        each image in the top left of its cell. Rows and columns with no images are left out.
+    Every image is shrunk by the same amount (if at all), as in a grid.
+    """
+    scale = get_merge_scale(_sizes.max(axis=0), get_line_sizes(_columns, _sizes[:, 0], \
+        _num_columns).sum(), _tile_size, _output_width)
+    box_sizes = scale_sizes(_sizes, scale)
+
+    column_lefts = np.concatenate([[0], np.cumsum(get_line_sizes(_columns, box_sizes[:, 0], \
+        _num_columns))])
+    row_tops = np.concatenate([[0], np.cumsum(get_line_sizes(_rows, box_sizes[:, 1], \
+        _num_rows))])
+
+    boxes = np.column_stack([column_lefts[_columns], row_tops[_rows], box_sizes])
+    return MergeLayout((int(column_lefts[-1]), int(row_tops[-1])), boxes, \
+        np.full(len(_sizes), scale), np.unique(row_tops))
+
+
+def get_line_sizes(_lines : np.ndarray, _image_sizes : np.ndarray, _num_lines : int) \
+    -> np.ndarray:
+    """
+    Returns the biggest of _image_sizes in each of the _num_lines rows (or columns), given
+        which of them each image is in. Lines with no images have a size of 0.
+    """
+    line_sizes = np.zeros(_num_lines, dtype=np.int64)
+    np.maximum.at(line_sizes, _lines, _image_sizes)
+    return line_sizes
+
+
+def layout_justified(_sizes : np.ndarray, _fill_direction : Direction, _num_lines : int, \
+    _tile_size : Optional[Tuple[int,int]] = None, _output_width : Optional[int] = None) \
+    -> MergeLayout:
+    """
+    Lays out images of _sizes in _num_lines justified rows (or, if _fill_direction is
+        Direction.COLUMN, justified columns) of the same length (see justify_lines()).
+    Justified columns run the whole height of the merged image, so it is put together
+        in one band.
+    """
+    if _fill_direction == Direction.COLUMN:
+        #Columns are laid out as rows of the images turned on their sides, then turned back
+        boxes, _, (length, thickness) = justify_lines(_sizes[:, ::-1], _num_lines, \
+            None if _tile_size is None else _tile_size[::-1], _max_thickness=_output_width)
+        boxes, size, row_tops = boxes[:, [1, 0, 3, 2]], (thickness, length), np.array([0, length])
+    else:
+        boxes, row_tops, size = justify_lines(_sizes, _num_lines, _tile_size, \
+            _max_length=_output_width)
+
+    #Each image is shrunk at least enough to fill its box
+    scales = np.maximum(boxes[:, 2] / _sizes[:, 0], boxes[:, 3] / _sizes[:, 1])
+    return MergeLayout(size, boxes, scales, row_tops)
+
+
+def justify_lines(_sizes : np.ndarray, _num_lines : int, \
+    _tile_size : Optional[Tuple[int,int]] = None, _max_length : Optional[float] = None, \
+    _max_thickness : Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, Tuple[int,int]]:
+    """
+    Splits images of _sizes (in order) into _num_lines rows, and shrinks the images in each
+        row to the same height, so that every row is the same length.
+    The rows are made as long as they can be without enlarging any image, or making any
+        bigger than _tile_size, so that they are no longer than _max_length, and so that
+        all of the rows together are no taller than _max_thickness.
+    Returns the (x, y, width, height) of each image, the top of each row followed by the
+        bottom of the last, and the (width, height) the rows take up.
+    """
+    num_images = len(_sizes)
+    num_lines = max(1, min(_num_lines, num_images))
+    aspect_ratios = _sizes[:, 0] / _sizes[:, 1]
+    cumulative_ratios = np.concatenate([[0.0], np.cumsum(aspect_ratios)])
+
+    #A row's height is its length over the sum of its images' aspect ratios, so the rows are
+    #   as even (and the merged image as small) as they can be when each row's sum is the same
+    targets = cumulative_ratios[-1] * np.arange(1, num_lines) / num_lines
+    breaks = np.clip(np.searchsorted(cumulative_ratios, targets), 1, num_images)
+    #Break before whichever image brings the row closer to its share
+    breaks -= targets - cumulative_ratios[breaks - 1] < cumulative_ratios[breaks] - targets
+    #Every row holds at least one image
+    line_numbers = np.arange(1, num_lines)
+    breaks = np.clip(breaks, line_numbers, num_images - num_lines + line_numbers)
+    breaks = np.maximum.accumulate(breaks - line_numbers) + line_numbers
+
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [num_images]])
+    lines = np.repeat(np.arange(num_lines), ends - starts)
+    line_ratios = cumulative_ratios[ends] - cumulative_ratios[starts]
+
+    #Each image limits how long its row can be before it would be enlarged (or outgrow a tile)
+    max_heights = _sizes[:, 1].astype(np.float64)
+    if _tile_size is not None:
+        max_heights = np.minimum(max_heights, \
+            np.minimum(_tile_size[1], _tile_size[0] / aspect_ratios))
+    length = float(np.min(line_ratios * np.minimum.reduceat(max_heights, starts)))
+    if _max_length is not None:
+        length = min(length, _max_length)
+    if _max_thickness is not None:
+        length = min(length, _max_thickness / float(np.sum(1 / line_ratios)))
+
+    line_heights = np.maximum(1, np.round(length / line_ratios)).astype(np.int64)
+    line_tops = np.concatenate([[0], np.cumsum(line_heights)])
+    #Each image's edges are rounded from where they fall along its row, so the images in
+    #   a row meet exactly, and the last one ends exactly at the end of the row
+    line_starts = cumulative_ratios[starts][lines]
+    lefts = np.round(length * (cumulative_ratios[:-1] - line_starts) / line_ratios[lines])
+    rights = np.round(length * (cumulative_ratios[1:] - line_starts) / line_ratios[lines])
+
+    boxes = np.column_stack([lefts, line_tops[lines], np.maximum(1, rights - lefts), \
+        line_heights[lines]]).astype(np.int64)
+    return boxes, line_tops, (round(length), int(line_tops[-1]))
@@ -0,0 +1,171 @@
+"""Reads image headers (never pixel data), and remembers them in an index next to the image folder"""
+import os
+import sqlite3
+
+from typing import Iterable, Iterator, NamedTuple, Optional
+from PIL import Image
+
+from constants import *
+from instrumentation import timed
+
+class ImageMetadata(NamedTuple):
+    """Everything about an image that can be known from its file's header"""
+    path : str
+    file_size : int
+    mtime_ns : int
+    width : int
+    height : int
+    mode : str
+    orientation : Optional[int]     #None if the header couldn't be read
+    has_alpha : bool
+
+    @property
+    def oriented_size(self) -> tuple[int,int]:
+        """
+        The image's (width, height) once it has been rotated according to its EXIF orientation.
+        """
+        if self.orientation in TRANSPOSED_ORIENTATIONS:
+            return self.height, self.width
+        return self.width, self.height
+
+
+def get_index_path(_image_dir : str) -> str:
+    """
+    Returns the path of the index for the images in _image_dir, which sits next to the
+        directory in the same way as the output directories do.
+    e.g., "scans/" --> "scans_(index).sqlite"
+    """
+    return os.path.normpath(_image_dir) + INDEX_SUFFIX
+
+
+def read_image_metadata(_input_image_paths : Iterable[str]) -> list[ImageMetadata]:
+    """
+    Returns the metadata for each of _input_image_paths, in the same order.
+    """
+    return list(iter_image_metadata(_input_image_paths))
+
+
+def iter_image_metadata(_input_image_paths : Iterable[str]) -> Iterator[ImageMetadata]:
+    """
+    Yields the metadata for each of _input_image_paths, in the same order, as the paths
+        are taken from _input_image_paths (which can be a generator).
+    Only images whose size or modification time changed since the last run (or which
+        haven't been seen before) have their headers read; the rest come from the index.
+    """
+    #Each directory has its own index, and only the current directory's is kept open
+    directory_index = None
+    try:
+        for image in _input_image_paths:
+            image_dir = os.path.dirname(image)
+            if directory_index is None or directory_index.image_dir != image_dir:
+                if directory_index is not None:
+                    directory_index.close()
+                directory_index = DirectoryIndex(image_dir)
+
+            with timed("metadata"):
+                metadata = directory_index.get_metadata(image)
+            yield metadata
+    finally:
+        if directory_index is not None:
+            directory_index.close()
+
+
+class DirectoryIndex:
+    """
+    The index of the images in one directory, which is read from and added to
+        as the directory's images are looked up.
+    Images are still looked up if the index can't be used (e.g., on a read-only share).
+    """
+    def __init__(self, _image_dir : str) -> None:
+        self.image_dir = _image_dir
+        self.connection = open_index(get_index_path(_image_dir))
+        self.changed_rows = []
+        self.num_headers_read = 0
+        self.num_images = 0
+
+    def get_metadata(self, _image_path : str) -> ImageMetadata:
+        """
+        Returns the metadata for _image_path, only reading its header if it isn't in the
+            index, or has changed since it was indexed.
+        """
+        file_stats = os.stat(_image_path)
+        name = os.path.basename(_image_path)
+        row = None
+        if self.connection is not None:
+            row = self.connection.execute("SELECT name, file_size, mtime_ns, width, height, "
+                "mode, orientation, has_alpha FROM images WHERE name = ?", (name,)).fetchone()
+        self.num_images += 1
+
+        #Only trust the index if the file hasn't changed since it was indexed
+        if row is None or row[1] != file_stats.st_size or row[2] != file_stats.st_mtime_ns:
+            self.num_headers_read += 1
+            try:
+                row = (name, file_stats.st_size, file_stats.st_mtime_ns) + \
+                    read_image_header(_image_path)
+                self.changed_rows.append(row)
+                if len(self.changed_rows) >= INDEX_WRITE_BATCH_SIZE:
+                    self.write_changes()
+            except OSError as error:
+                #Leave it to whatever opens the image to report the problem
+                debug(f"Couldn't read the header of {_image_path} ({error})")
+                row = (name, file_stats.st_size, file_stats.st_mtime_ns, 0, 0, "", None, False)
+
+        return ImageMetadata(_image_path, *row[1:7], bool(row[7]))
+
+    def write_changes(self) -> None:
+        """
+        Saves the headers which have been read since the last save.
+        """
+        if self.connection is not None and self.changed_rows:
+            try:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO images VALUES "
+                        "(?,?,?,?,?,?,?,?)", self.changed_rows)
+            except sqlite3.Error as error:
+                debug(f"Couldn't update the index for {self.image_dir} ({error})")
+        self.changed_rows = []
+
+    def close(self) -> None:
+        """
+        Saves any remaining changes, and closes the index.
+        """
+        self.write_changes()
+        if self.connection is not None:
+            self.connection.close()
+        debug(f"Read {self.num_headers_read} of {self.num_images} image headers "
+            f"in {self.image_dir}")
+
+
+def read_image_header(_image_path : str) -> tuple[int, int, str, int, bool]:
+    """
+    Reads (width, height, mode, EXIF orientation, whether it has alpha) from an image's
+        header, without decoding any of its pixels.
+    """
+    with Image.open(_image_path) as image_object:
+        orientation = image_object.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        has_alpha = image_object.mode in ALPHA_MODES or "transparency" in image_object.info
+        width, height = image_object.size
+        #Pillow reports a TIFF's size as it will be once turned the right way up
+        if image_object.format == "TIFF" and orientation in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        return width, height, image_object.mode, orientation, has_alpha
+
+
+def open_index(_index_path : str) -> Optional[sqlite3.Connection]:
+    """
+    Opens (creating if necessary) the index at _index_path.
+    Returns None if it can't be opened, in which case every header will be read.
+    """
+    connection = None
+    try:
+        connection = sqlite3.connect(_index_path)
+        connection.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, "
+            "file_size INTEGER, mtime_ns INTEGER, width INTEGER, height INTEGER, "
+            "mode TEXT, orientation INTEGER, has_alpha INTEGER)")
+    except sqlite3.Error as error:
+        debug(f"Not using the index at {_index_path} ({error})")
+        if connection is not None:
+            connection.close()
+        return None
+
+    return connection
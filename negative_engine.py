@@ -0,0 +1,209 @@
+"""Turns scanned film negatives into positives, optionally removing colour negative film's orange mask.
+
+Every output value depends only on the input value in the same channel, so each channel's
+    whole correction (film base, levels and gamma) is worked out once, with NumPy, as a
+    lookup table, and the corrections come at no extra cost per pixel over plain inversion,
+    apart from sampling the image for --film-base auto.
+With more than one core, the tables are applied to strips of rows in parallel on a pool of
+    threads (Pillow and NumPy let go of the GIL while looking the values up), so the
+    inversion itself is faster than PIL.ImageOps.invert() by about the number of cores,
+    and each thread only ever holds a strip of about NEGATIVE_STRIP_BYTES on top of the
+    output. With just the one core, 8-bit images are looked up in a single Image.point().
+16-bit greyscale images are looked up with NumPy, always a strip of rows at a time.
+    Pillow has no 16-bit RGB mode, so 16-bit RGB scans are only kept 16-bit when they are
+    TIFFs that tiff_strips.py can read; otherwise Pillow has already reduced them to 8 bits.
+
+e.g.,
+    positive = invert_negative(negative, NegativeSettings(AUTO_FILM_BASE, 1.0))
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from constants import *
+from batch import default_num_threads
+
+class NegativeSettings(NamedTuple):
+    """How a negative is turned into a positive"""
+    #The colour of unexposed film (e.g., (220, 140, 90) for an orange mask), AUTO_FILM_BASE
+    #   to sample it from each image, or None to just invert the values
+    film_base : Union[tuple[int, ...], str, None] = None
+    #Above 1 brightens the mid-tones of the positive, below 1 darkens them
+    gamma : float = 1.0
+
+
+def invert_negative(_image_object : Image.Image, _settings : Optional[NegativeSettings] = None, \
+    _num_threads : Optional[int] = None) -> Image.Image:
+    """
+    Returns a positive copy of the negative _image_object, worked out on _num_threads threads
+        (see apply_tables_in_strips()).
+    Alpha channels are kept as they are, and 16-bit greyscale images stay 16-bit.
+    With the default _settings this is the same as PIL.ImageOps.invert().
+    If there is a film base colour, each channel is divided by it (which removes the orange
+        mask), inverted, and then stretched so that its darkest and brightest values
+        (ignoring NEGATIVE_LEVELS_CLIP percent at either end) fill the whole range.
+    """
+    if _settings is None:
+        _settings = NegativeSettings()
+
+    #Modes which have no direct equivalent in NumPy (e.g., palettes) are turned into RGB first
+    if _image_object.mode.startswith("I;16") and _image_object.mode not in SIXTEEN_BIT_MODES:
+        _image_object = _image_object.convert("I")
+    elif _image_object.mode not in NEGATIVE_MODES:
+        _image_object = _image_object.convert("RGBA" if _image_object.mode in ALPHA_MODES or \
+            "transparency" in _image_object.info else "RGB")
+
+    max_value = SIXTEEN_BIT_MAX if _image_object.mode in SIXTEEN_BIT_MODES else EIGHT_BIT_MAX
+    num_colour_bands = len(_image_object.getbands()) - \
+        (1 if _image_object.mode in ALPHA_MODES else 0)
+
+    #The film base and levels are both sampled from the same shrunken copy of the image
+    sample = None
+    if _settings.film_base is not None:
+        sample = get_sample(_image_object, num_colour_bands)
+
+    tables = make_negative_tables(sample, _settings, num_colour_bands, max_value)
+    return apply_tables_in_strips(_image_object, tables, _num_threads)
+
+
+def make_negative_tables(_sample : Optional[np.ndarray], _settings : NegativeSettings, \
+    _num_colour_bands : int, _max_value : int) -> list[np.ndarray]:
+    """
+    Returns a lookup table for each colour channel (see make_lookup_tables()) which turns
+        a negative into a positive according to _settings.
+    _sample is a shrunken copy of the negative's colour channels (see get_sample()),
+        which is only needed if there is a film base colour.
+    """
+    film_base = get_film_base(_sample, _settings.film_base, _num_colour_bands, _max_value)
+    levels = None if _sample is None else sample_levels(_sample, film_base, _max_value)
+    return make_lookup_tables(_max_value, film_base, levels, _settings.gamma)
+
+
+def get_film_base(_sample : Optional[np.ndarray], _film_base : Union[tuple[int, ...], str, None], \
+    _num_colour_bands : int, _max_value : int) -> np.ndarray:
+    """
+    Returns the film base colour for each colour channel, on a scale of 0 to _max_value.
+    _film_base can be sampled from the image (AUTO_FILM_BASE, see get_sample()), given as 8-bit
+        values (one per channel, or a single one for all of them), or None for plain inversion.
+    """
+    if _film_base is None:
+        return np.full(_num_colour_bands, _max_value, dtype=np.float64)
+    if _film_base == AUTO_FILM_BASE:
+        return sample_film_base(_sample)
+
+    film_base = np.array(_film_base, dtype=np.float64) * _max_value / EIGHT_BIT_MAX
+    if len(film_base) != _num_colour_bands:
+        #e.g., an RGB film base for a greyscale scan
+        film_base = np.full(_num_colour_bands, film_base.mean())
+    return np.maximum(film_base, 1)
+
+
+def get_sample(_image_object : Image.Image, _num_colour_bands : int) -> np.ndarray:
+    """
+    Returns a shrunken copy of _image_object's colour channels, with NEGATIVE_SAMPLE_PIXELS
+        or fewer pixels, as an array of shape (pixels, channels).
+    """
+    factor = max(1, int((_image_object.width * _image_object.height / \
+        NEGATIVE_SAMPLE_PIXELS) ** 0.5))
+    sample = _image_object.convert("I") if _image_object.mode == "I;16" else _image_object
+    if factor > 1:
+        #Averaging blocks of pixels also smooths out the film grain
+        sample = sample.reduce(factor)
+    sample_array = np.asarray(sample).reshape(sample.height * sample.width, -1)
+    return sample_array[:, :_num_colour_bands].astype(np.float64)
+
+
+def sample_film_base(_sample : np.ndarray) -> np.ndarray:
+    """
+    Estimates the film base colour as the brightest (i.e., least exposed) colour in each
+        channel of _sample, such as the unexposed border between frames.
+    """
+    film_base = np.percentile(_sample, 100 - NEGATIVE_LEVELS_CLIP, axis=0)
+    return np.maximum(film_base, 1)
+
+
+def sample_levels(_sample : np.ndarray, _film_base : np.ndarray, _max_value : int) -> np.ndarray:
+    """
+    Returns the (darkest, brightest) value of each channel of _sample once it has been
+        divided by _film_base and inverted, on a scale of 0 to 1.
+    """
+    inverted = 1 - np.clip(_sample / _film_base, 0, 1)
+    levels = np.percentile(inverted, [NEGATIVE_LEVELS_CLIP, 100 - NEGATIVE_LEVELS_CLIP], axis=0)
+
+    #Don't stretch a channel which is (nearly) flat
+    levels[1] = np.maximum(levels[1], levels[0] + 1 / _max_value)
+    return levels.T
+
+
+def make_lookup_tables(_max_value : int, _film_base : np.ndarray, \
+    _levels : Optional[np.ndarray], _gamma : float) -> list[np.ndarray]:
+    """
+    Returns a table for each colour channel, giving the positive value for every possible
+        negative value from 0 to _max_value.
+    """
+    values = np.arange(_max_value + 1, dtype=np.float64)
+    dtype = np.uint8 if _max_value == EIGHT_BIT_MAX else np.uint16
+    tables = []
+    for band_index, film_base in enumerate(_film_base):
+        positive = 1 - np.clip(values / film_base, 0, 1)
+        if _levels is not None:
+            darkest, brightest = _levels[band_index]
+            positive = np.clip((positive - darkest) / (brightest - darkest), 0, 1)
+        if _gamma != 1:
+            positive **= 1 / _gamma
+        tables.append(np.rint(positive * _max_value).astype(dtype))
+
+    return tables
+
+
+def apply_tables_in_strips(_image_object : Image.Image, _tables : list[np.ndarray], \
+    _num_threads : Optional[int] = None) -> Image.Image:
+    """
+    Returns a copy of _image_object with the values of each colour channel looked up in its
+        table in _tables, and any alpha channel kept as it is.
+    The image is split into strips of about NEGATIVE_STRIP_BYTES, which are looked up on
+        _num_threads threads (defaulting to batch.default_num_threads()) and pasted into
+        the copy as they're finished.
+    8-bit images on a single thread are looked up in one go instead, which is quicker
+        than going through them a strip at a time.
+    """
+    if _num_threads is None:
+        _num_threads = default_num_threads()
+
+    if _image_object.mode in SIXTEEN_BIT_MODES:
+        #Pillow can't look up 16-bit values itself, so they're looked up with NumPy
+        #   (clipping any 32-bit values outside the table)
+        def look_up(_strip : Image.Image) -> Image.Image:
+            values = np.take(_tables[0], np.asarray(_strip), mode="clip")
+            return Image.fromarray(values.astype(np.int32) if _strip.mode == "I" else values)
+    else:
+        #Alpha channels are looked up in an unchanging table
+        alpha_tables = [np.arange(EIGHT_BIT_MAX + 1)] * (len(_image_object.getbands()) - \
+            len(_tables))
+        lookup_table = np.concatenate([*_tables, *alpha_tables]).tolist()
+        if _num_threads == 1:
+            return _image_object.point(lookup_table)
+        look_up = lambda _strip: _strip.point(lookup_table)
+
+    positive = Image.new(_image_object.mode, _image_object.size)
+    row_bytes = max(1, _image_object.width * len(_image_object.getbands()) * \
+        (2 if _image_object.mode in SIXTEEN_BIT_MODES else 1))
+    strip_rows = max(1, NEGATIVE_STRIP_BYTES // row_bytes)
+    boxes = [(0, top, _image_object.width, min(top + strip_rows, _image_object.height)) \
+        for top in range(0, _image_object.height, strip_rows)]
+
+    def look_up_strip(_box : tuple[int,int,int,int]) -> None:
+        #Each strip is pasted into its own rows, so the threads never write to the same place
+        positive.paste(look_up(_image_object.crop(_box)), _box)
+
+    if _num_threads == 1 or len(boxes) <= 1:
+        for box in boxes:
+            look_up_strip(box)
+    else:
+        with ThreadPoolExecutor(min(_num_threads, len(boxes))) as executor:
+            for _ in executor.map(look_up_strip, boxes):
+                pass
+
+    return positive
@@ -0,0 +1,322 @@
+"""Perceptual hashes, which are (nearly) the same for images that look the same, such as two scans
+    of one negative with different exposures, or a re-encoded copy of a scan.
+
+Each image is decoded at a reduced size (JPEGs are only decoded at 1/8 of their size, or
+    smaller), shrunk to a tiny greyscale thumbnail, and hashed along with a batch of others
+    in NumPy:
+    the DCT hash records which of the thumbnail's lowest frequencies are above their median,
+    the difference hash records which of its pixels are brighter than the one to their left.
+The hashes are kept in each directory's index (see metadata_index.py), so only new or changed
+    images are hashed again, and similar images are found by multi-index hashing, rather than
+    by comparing every pair of images.
+
+e.g.,
+    alternatives = find_alternative_takes(["scans/PICT0006.JPG", "scans/PICT0009.JPG"])
+"""
+import os
+import sqlite3
+
+from collections import defaultdict
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+import PIL.ImageOps
+
+from constants import *
+from batch import default_num_jobs, open_process_pool
+from instrumentation import timed
+from metadata_index import get_index_path, open_index
+
+#How many rows of a group of similar-looking images are compared with the rest of it at once
+COMPARE_BLOCK_ROWS = 1024
+
+#Hashes are unsigned, but SQLite only stores signed 64-bit integers
+SIGNED_OFFSET = 1 << 64
+MAX_SIGNED = (1 << 63) - 1
+
+class ImageHashes(NamedTuple):
+    """The perceptual hashes of an image, as 64-bit unsigned integers"""
+    dct_hash : int
+    difference_hash : int
+
+
+def get_dct_matrix(_size : int) -> np.ndarray:
+    """
+    Returns the (orthonormal) DCT-II matrix which transforms a column of _size values.
+    """
+    positions = np.arange(_size)
+    matrix = np.cos(np.pi * (2 * positions[None, :] + 1) * positions[:, None] / (2 * _size))
+    matrix *= np.sqrt(2 / _size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT_MATRIX = get_dct_matrix(HASH_IMAGE_SIZE)
+
+
+def get_averaging_matrix(_in_size : int, _out_size : int) -> np.ndarray:
+    """
+    Returns the (_in_size, _out_size) matrix which shrinks a row of _in_size values to
+        _out_size values, each the average of the (parts of the) values it covers.
+    """
+    edges = np.linspace(0, _in_size, _out_size + 1)
+    starts = np.arange(_in_size)[:, None]
+    overlaps = np.clip(np.minimum(starts + 1, edges[None, 1:]) - \
+        np.maximum(starts, edges[None, :-1]), 0, None)
+    return overlaps / overlaps.sum(axis=0)
+
+#Shrink a thumbnail to the difference hash's 9 columns and 8 rows (giving 8 x 8 differences)
+ROW_AVERAGING_MATRIX = get_averaging_matrix(HASH_IMAGE_SIZE, 8).T
+COLUMN_AVERAGING_MATRIX = get_averaging_matrix(HASH_IMAGE_SIZE, 9)
+
+
+def load_thumbnail(_image_path : str) -> np.ndarray:
+    """
+    Returns _image_path as a HASH_IMAGE_SIZE x HASH_IMAGE_SIZE greyscale array, the right way
+        up according to its EXIF orientation.
+    """
+    with timed("decode"), Image.open(_image_path) as image_object:
+        #Lets JPEGs skip most of the decoding work, by scaling down in the DCT domain
+        image_object.draft("L", (HASH_IMAGE_SIZE * 2, HASH_IMAGE_SIZE * 2))
+        if image_object.mode.startswith("I;16"):
+            #Scaled down to 8 bits, rather than clipped
+            image_object = image_object.convert("I").point(lambda _value: _value / 257)
+        thumbnail = PIL.ImageOps.exif_transpose(image_object.convert("L"))
+        thumbnail = thumbnail.resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.BOX)
+        return np.asarray(thumbnail, dtype=np.float64)
+
+
+def hash_images(_image_paths : list[str]) -> list[Optional[ImageHashes]]:
+    """
+    Returns the hashes of each of _image_paths, or None for any which couldn't be decoded.
+    The images are hashed together, so that NumPy does the work for all of them at once.
+    """
+    thumbnails = []
+    hashed_positions = []
+    for position, image_path in enumerate(_image_paths):
+        try:
+            thumbnails.append(load_thumbnail(image_path))
+            hashed_positions.append(position)
+        except (OSError, ValueError) as error:
+            debug(f"Couldn't hash {image_path} ({error})")
+
+    hashes = [None] * len(_image_paths)
+    if not thumbnails:
+        return hashes
+
+    with timed("transform"):
+        thumbnails = np.stack(thumbnails)
+
+        #The DCT hash ignores the (0, 0) frequency, which is just the overall brightness
+        frequencies = (DCT_MATRIX @ thumbnails @ DCT_MATRIX.T)[:, :HASH_FREQUENCIES, \
+            :HASH_FREQUENCIES].reshape(len(thumbnails), -1)
+        medians = np.median(frequencies[:, 1:], axis=1)
+        dct_hashes = pack_bits(frequencies > medians[:, None])
+
+        #The difference hash compares neighbouring pixels of an even smaller thumbnail
+        small = ROW_AVERAGING_MATRIX @ thumbnails @ COLUMN_AVERAGING_MATRIX
+        difference_hashes = pack_bits((small[:, :, 1:] > small[:, :, :-1]).reshape( \
+            len(thumbnails), -1))
+
+    for position, dct_hash, difference_hash in zip(hashed_positions, dct_hashes, \
+        difference_hashes):
+        hashes[position] = ImageHashes(int(dct_hash), int(difference_hash))
+    return hashes
+
+
+def pack_bits(_bits : np.ndarray) -> np.ndarray:
+    """
+    Returns each row of 64 booleans in _bits as a 64-bit unsigned integer.
+    """
+    return np.packbits(_bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def count_bits(_values : np.ndarray) -> np.ndarray:
+    """
+    Returns how many bits are set in each of the 64-bit unsigned _values.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(_values)
+    #Older versions of NumPy have to count the bits a byte at a time
+    byte_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+    return byte_counts[_values.view(np.uint8).reshape(*_values.shape, 8)].sum(axis=-1)
+
+
+def read_image_hashes(_image_paths : list[str], _num_jobs : Optional[int] = None) \
+    -> list[Optional[ImageHashes]]:
+    """
+    Returns the hashes of each of _image_paths (or None for any that can't be decoded),
+        hashing the images which aren't in their directory's index (or which have changed
+        since they were indexed) on _num_jobs processes, and adding them to the index.
+    """
+    if _num_jobs is None:
+        _num_jobs = default_num_jobs()
+
+    hashes = [None] * len(_image_paths)
+    positions_by_dir = defaultdict(list)
+    for position, image_path in enumerate(_image_paths):
+        positions_by_dir[os.path.dirname(image_path)].append(position)
+
+    for image_dir, positions in positions_by_dir.items():
+        connection = open_hash_index(get_index_path(image_dir))
+        indexed_rows = {}
+        if connection is not None:
+            indexed_rows = {row[0] : row[1:] for row in connection.execute( \
+                "SELECT name, file_size, mtime_ns, dct_hash, difference_hash FROM hashes")}
+
+        #Only trust the index if the file hasn't changed since it was indexed
+        unhashed = []
+        for position in positions:
+            file_stats = os.stat(_image_paths[position])
+            row = indexed_rows.get(os.path.basename(_image_paths[position]))
+            if row is not None and row[:2] == (file_stats.st_size, file_stats.st_mtime_ns):
+                hashes[position] = ImageHashes(row[2] % SIGNED_OFFSET, row[3] % SIGNED_OFFSET)
+            else:
+                unhashed.append((position, file_stats))
+
+        batches = [unhashed[start:start + HASH_BATCH_SIZE] \
+            for start in range(0, len(unhashed), HASH_BATCH_SIZE)]
+        batch_paths = [[_image_paths[position] for position, _ in batch] for batch in batches]
+        if _num_jobs == 1 or len(batches) <= 1:
+            batch_hashes = map(hash_images, batch_paths)
+        else:
+            with open_process_pool(_num_jobs) as executor:
+                batch_hashes = list(executor.map(hash_images, batch_paths))
+
+        new_rows = []
+        for batch, image_hashes in zip(batches, batch_hashes):
+            for (position, file_stats), image_hash in zip(batch, image_hashes):
+                hashes[position] = image_hash
+                if image_hash is not None:
+                    new_rows.append((os.path.basename(_image_paths[position]), \
+                        file_stats.st_size, file_stats.st_mtime_ns, \
+                        to_signed(image_hash.dct_hash), to_signed(image_hash.difference_hash)))
+        write_hashes(connection, new_rows, image_dir)
+        debug(f"Hashed {len(unhashed)} of {len(positions)} images in {image_dir}")
+
+    return hashes
+
+
+def to_signed(_hash : int) -> int:
+    """
+    Returns the 64-bit unsigned _hash as the signed integer with the same bits.
+    """
+    return _hash - SIGNED_OFFSET if _hash > MAX_SIGNED else _hash
+
+
+def open_hash_index(_index_path : str) -> Optional[sqlite3.Connection]:
+    """
+    Opens (creating if necessary) the index at _index_path, with a table for the hashes.
+    Returns None if it can't be opened, in which case every image will be hashed.
+    """
+    connection = open_index(_index_path)
+    if connection is None:
+        return None
+    try:
+        connection.execute("CREATE TABLE IF NOT EXISTS hashes (name TEXT PRIMARY KEY, "
+            "file_size INTEGER, mtime_ns INTEGER, dct_hash INTEGER, difference_hash INTEGER)")
+    except sqlite3.Error as error:
+        debug(f"Not using the index at {_index_path} for hashes ({error})")
+        connection.close()
+        return None
+
+    return connection
+
+
+def write_hashes(_connection : Optional[sqlite3.Connection], _rows : list[tuple], \
+    _image_dir : str) -> None:
+    """
+    Saves the (name, file size, modification time, hashes) _rows to the index, and closes it.
+    """
+    if _connection is None:
+        return
+    try:
+        with _connection:
+            _connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?)", _rows)
+    except sqlite3.Error as error:
+        debug(f"Couldn't update the hashes in the index for {_image_dir} ({error})")
+    _connection.close()
+
+
+def find_similar_pairs(_dct_hashes : np.ndarray, _difference_hashes : np.ndarray, \
+    _max_dct_distance : int = DUPLICATE_PHASH_DISTANCE, \
+    _max_difference_distance : int = DUPLICATE_DHASH_DISTANCE) -> np.ndarray:
+    """
+    Returns every (i, j) pair, with i < j, of images whose DCT hashes differ in at most
+        _max_dct_distance bits and whose difference hashes differ in at most
+        _max_difference_distance bits, sorted by j and then i.
+    The DCT hashes are split into _max_dct_distance + 1 chunks of bits, and two hashes that
+        close together must have at least one chunk the same, so only images which share a
+        chunk are compared (i.e., multi-index hashing).
+    """
+    chunk_bounds = np.linspace(0, 64, _max_dct_distance + 2).astype(int)
+    found_pairs = [np.empty((0, 2), dtype=np.int64)]
+    for start, end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        chunks = (_dct_hashes >> np.uint64(start)) & np.uint64((1 << int(end - start)) - 1)
+        order = np.argsort(chunks, kind="stable")
+        sorted_chunks = chunks[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_chunks[1:] != sorted_chunks[:-1]])
+        group_ends = np.r_[group_starts[1:], len(chunks)]
+        for group_start, group_end in zip(group_starts, group_ends):
+            if group_end - group_start > 1:
+                found_pairs.append(compare_group(np.sort(order[group_start:group_end]), \
+                    _dct_hashes, _difference_hashes, _max_dct_distance, \
+                    _max_difference_distance))
+
+    pairs = np.unique(np.concatenate(found_pairs), axis=0)
+    return pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+
+
+def compare_group(_group : np.ndarray, _dct_hashes : np.ndarray, \
+    _difference_hashes : np.ndarray, _max_dct_distance : int, \
+    _max_difference_distance : int) -> np.ndarray:
+    """
+    Returns the (i, j) pairs, with i < j, of the images in _group (an ascending array of
+        image positions) whose hashes are close enough together.
+    """
+    group_pairs = [np.empty((0, 2), dtype=np.int64)]
+    for row_start in range(0, len(_group), COMPARE_BLOCK_ROWS):
+        rows = _group[row_start:row_start + COMPARE_BLOCK_ROWS]
+        columns = _group[row_start + 1:]
+        close = (count_bits(_dct_hashes[rows][:, None] ^ _dct_hashes[columns][None, :]) \
+            <= _max_dct_distance) & (count_bits(_difference_hashes[rows][:, None] ^ \
+            _difference_hashes[columns][None, :]) <= _max_difference_distance)
+
+        #Each image is only paired with the images after it in the group
+        close &= np.arange(len(rows))[:, None] <= np.arange(len(columns))[None, :]
+        row_positions, column_positions = np.nonzero(close)
+        group_pairs.append(np.stack([rows[row_positions], columns[column_positions]], axis=1))
+
+    return np.concatenate(group_pairs)
+
+
+def find_alternative_takes(_image_paths : Iterable[str], _num_jobs : Optional[int] = None) \
+    -> dict[str, str]:
+    """
+    Returns a dictionary mapping each of _image_paths which looks like an earlier one
+        (e.g., a second scan of the same negative) to the earlier image it looks most like,
+        out of those which aren't alternative takes themselves.
+    """
+    _image_paths = list(_image_paths)
+    hashes = read_image_hashes(_image_paths, _num_jobs)
+    hashed_positions = [position for position, image_hash in enumerate(hashes) \
+        if image_hash is not None]
+    dct_hashes = np.array([hashes[position].dct_hash for position in hashed_positions], \
+        dtype=np.uint64)
+    difference_hashes = np.array([hashes[position].difference_hash \
+        for position in hashed_positions], dtype=np.uint64)
+
+    #Each image is an alternative take of the most similar earlier image which isn't itself
+    #   an alternative take (or the earliest of those which are as similar as each other)
+    pairs = find_similar_pairs(dct_hashes, difference_hashes)
+    distances = count_bits(dct_hashes[pairs[:, 0]] ^ dct_hashes[pairs[:, 1]]) + \
+        count_bits(difference_hashes[pairs[:, 0]] ^ difference_hashes[pairs[:, 1]])
+    alternatives = {}
+    for earlier, later in pairs[np.lexsort((pairs[:, 0], distances, pairs[:, 1]))]:
+        earlier_path = _image_paths[hashed_positions[earlier]]
+        later_path = _image_paths[hashed_positions[later]]
+        if later_path not in alternatives and earlier_path not in alternatives:
+            debug(f"{later_path} looks like an alternative take of {earlier_path}")
+            alternatives[later_path] = earlier_path
+
+    return alternatives
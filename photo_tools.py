@@ -11,46 +11,246 @@ Should be run as
 
 
 Current limitations
-    Only operates on .JPGs/.PNGs
+    Only operates on .JPGs/.PNGs/.TIFs
     RGB vs RGBA images
 """
 
-import glob
+import cProfile
 import sys
 import re
 import os
+import time
+
+from typing import Iterable, Optional, Tuple
+from PIL import Image
 
 from constants import *
+import constants
+import instrumentation
 
 #File containing the actual image operations
-from image_ops import rename_images, pad_images, negative_images, merge_images
+from image_ops import rename_images, pad_images, negative_images, merge_images, \
+    pipeline_images, plan_outputs, PadVariant, RenameError, RenamePlanner
+import batch
+from background_io import QueueDepths
+from encoder_profiles import EncoderSettings, parse_encoder_overrides
+from batch import JobFailure, default_num_jobs
+from folder_scan import iter_folder_images, count_files_in_directory
+from memory_budget import MemoryBudget, parse_memory_size
+from negative_engine import NegativeSettings
+from shard_plan import PlanError, check_planned_outputs, collect_shards, get_shard, \
+    get_shard_manifest_name, load_plan, write_plan
+from watch_folder import watch_folder
+
+
+def extract_options(_arguments : list[str]) -> Tuple[list[str], dict[str, str]]:
+    """
+    Separates any "--name value" (or "--name=value") options from the rest of the arguments.
+    Returns the remaining arguments in their original order, and a dictionary
+        mapping each option's name to its value.
+    Flag options (FLAG_OPTIONS) don't take a value, and are mapped to "true".
+    """
+    remaining_arguments = []
+    options = {}
+    i = 0
+    while i < len(_arguments):
+        if _arguments[i].startswith("--"):
+            name, _, value = _arguments[i].partition("=")
+            if name not in VALID_OPTIONS:
+                raise UsageError(Error.INVALID_OPTION, name)
+
+            if name in FLAG_OPTIONS:
+                value = "true"
+
+            #The value is the next argument if it wasn't attached with an '='
+            elif not value:
+                if i + 1 >= len(_arguments):
+                    raise UsageError(Error.INVALID_OPTION, name)
+                i += 1
+                value = _arguments[i]
+            options[name] = value
+        else:
+            remaining_arguments.append(_arguments[i])
+        i += 1
+
+    return remaining_arguments, options
+
+
+def get_integer_option(_options : dict[str, str], _option_name : str, \
+    _default : Optional[int] = None) -> Optional[int]:
+    """
+    Returns the positive integer given for _option_name, or _default if it wasn't given.
+    """
+    if _option_name not in _options:
+        return _default
+    if not re.search(ONLY_INTEGERS_REGEX, _options[_option_name]) or \
+        int(_options[_option_name]) < 1:
+        raise UsageError(Error.INVALID_OPTION, f"{_option_name} {_options[_option_name]}")
+    return int(_options[_option_name])
+
+
+def get_size_option(_options : dict[str, str], _option_name : str) \
+    -> Optional[Tuple[int,int]]:
+    """
+    Returns the (width, height) given for _option_name as "<width>x<height>" (or just
+        "<width>" for a square), or None if it wasn't given.
+    """
+    if _option_name not in _options:
+        return None
+    match = re.search(IMAGE_SIZE_REGEX, _options[_option_name])
+    if match is None or int(match.group(1)) < 1 or int(match.group(2) or 1) < 1:
+        raise UsageError(Error.INVALID_OPTION, f"{_option_name} {_options[_option_name]}")
+    return int(match.group(1)), int(match.group(2) or match.group(1))
+
+
+def get_memory_option(_options : dict[str, str], _option_name : str) \
+    -> Optional[MemoryBudget]:
+    """
+    Returns a budget of the amount of memory given for _option_name (e.g., "4G"),
+        or None if it wasn't given.
+    """
+    if _option_name not in _options:
+        return None
+    max_bytes = parse_memory_size(_options[_option_name])
+    if max_bytes is None:
+        raise UsageError(Error.INVALID_OPTION, f"{_option_name} {_options[_option_name]}")
+    return MemoryBudget(max_bytes)
+
+
+def get_thumbnail_cache_size(_options : dict[str, str]) -> Optional[int]:
+    """
+    Returns how many bytes the thumbnail cache can take up, given as a size (e.g., "1G")
+        for THUMBNAIL_CACHE_OPTION, or None if it was turned off.
+    """
+    cache_size = _options.get(THUMBNAIL_CACHE_OPTION)
+    if cache_size is None:
+        return DEFAULT_THUMBNAIL_CACHE_SIZE
+    if cache_size.lower() == THUMBNAIL_CACHE_OFF:
+        return None
+    max_bytes = parse_memory_size(cache_size)
+    if max_bytes is None:
+        raise UsageError(Error.INVALID_OPTION, f"{THUMBNAIL_CACHE_OPTION} {cache_size}")
+    return max_bytes
+
+
+def get_negative_settings(_options : dict[str, str]) -> Optional[NegativeSettings]:
+    """
+    Returns how negatives should be made, given the FILM_BASE_OPTION ("auto", or an 8-bit
+        "R,G,B" colour or single grey value) and GAMMA_OPTION, or None if neither was given.
+    """
+    if FILM_BASE_OPTION not in _options and GAMMA_OPTION not in _options:
+        return None
+
+    film_base = _options.get(FILM_BASE_OPTION)
+    if film_base is not None and film_base != AUTO_FILM_BASE:
+        values = film_base.split(",")
+        if len(values) not in (1, 3) or \
+            not all(re.search(ONLY_INTEGERS_REGEX, value) for value in values) or \
+            not all(0 < int(value) <= EIGHT_BIT_MAX for value in values):
+            raise UsageError(Error.INVALID_OPTION, f"{FILM_BASE_OPTION} {film_base}")
+        film_base = tuple(int(value) for value in values)
+
+    try:
+        gamma = float(_options.get(GAMMA_OPTION, 1))
+    except ValueError:
+        gamma = 0
+    if not gamma > 0:
+        raise UsageError(Error.INVALID_OPTION, f"{GAMMA_OPTION} {_options[GAMMA_OPTION]}")
 
+    return NegativeSettings(film_base, gamma)
 
-#Takes a directory name and returns all of the image files contained within.
-#
-#Parameters: String; specifies the directory in which to look
-#Return value: List of strings; each a filepath
-def get_folder_images(_dir_name : str) -> list[str]:
+
+def get_encoder_settings(_options : dict[str, str]) -> Optional[EncoderSettings]:
     """
-    Takes a directory name and returns a list of strings for all of the allowable
-        (as defined by IMAGE_SUFFIXES) image files contained within.
+    Returns how output images should be encoded, given the ENCODER_PROFILE_OPTION and
+        any ENCODER_OPTIONS_OPTION overrides, or None (for Pillow's defaults) if neither was given.
     """
-    file_names = []
-    for ext in IMAGE_SUFFIXES:
-        file_names += glob.glob(_dir_name+ext)
-    return file_names
+    if ENCODER_PROFILE_OPTION not in _options and ENCODER_OPTIONS_OPTION not in _options:
+        return None
+
+    profile = _options.get(ENCODER_PROFILE_OPTION)
+    if profile is not None and profile not in ENCODER_PROFILE_NAMES:
+        raise UsageError(Error.INVALID_OPTION, f"{ENCODER_PROFILE_OPTION} {profile}")
+
+    overrides = ()
+    if ENCODER_OPTIONS_OPTION in _options:
+        overrides = parse_encoder_overrides(_options[ENCODER_OPTIONS_OPTION])
+        if overrides is None:
+            raise UsageError(Error.INVALID_OPTION, \
+                f"{ENCODER_OPTIONS_OPTION} {_options[ENCODER_OPTIONS_OPTION]}")
+
+    return EncoderSettings(profile, overrides)
+
+
+def get_pad_variants(_options : dict[str, str]) -> Optional[list[PadVariant]]:
+    """
+    Returns the variants of each padded image given for VARIANTS_OPTION, such as
+        "full,2048,1080@4x5.jpg" (i.e., a width or "full", an optional aspect ratio,
+        and an optional file format), or None if it wasn't given.
+    """
+    if VARIANTS_OPTION not in _options:
+        return None
+
+    variants = []
+    for variant_string in _options[VARIANTS_OPTION].split(PAD_VARIANT_SEPARATOR):
+        match = re.search(PAD_VARIANT_REGEX, variant_string.lower())
+        if match is None or \
+            (match.group(1) != FULL_SIZE_VARIANT and int(match.group(1)) < 1) or \
+            int(match.group(2) or 1) < 1 or int(match.group(3) or 1) < 1 or \
+            (match.group(4) and match.group(4) not in Image.registered_extensions()):
+            raise UsageError(Error.INVALID_OPTION, f"{VARIANTS_OPTION} {variant_string}")
+
+        width, ratio_x, ratio_y, extension = match.groups()
+        variants.append(PadVariant(None if width == FULL_SIZE_VARIANT else int(width), \
+            (int(ratio_x), int(ratio_y)) if ratio_x else (1, 1), extension))
+
+    return variants
+
+
+def get_alternatives_mode(_options : dict[str, str]) -> str:
+    """
+    Returns how rename finds alternative takes, given for ALTERNATIVES_OPTION.
+    """
+    alternatives_mode = _options.get(ALTERNATIVES_OPTION, DEFAULT_ALTERNATIVES_MODE)
+    if alternatives_mode not in ALTERNATIVES_MODES:
+        raise UsageError(Error.INVALID_OPTION, f"{ALTERNATIVES_OPTION} {alternatives_mode}")
+    return alternatives_mode
+
+
+def get_shard_option(_options : dict[str, str]) -> Optional[Tuple[int,int]]:
+    """
+    Returns the (shard number, number of shards) given for SHARD_OPTION as "<i>/<N>",
+        or None if it wasn't given.
+    """
+    if SHARD_OPTION not in _options:
+        return None
+    match = re.search(SHARD_REGEX, _options[SHARD_OPTION])
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise UsageError(Error.INVALID_OPTION, f"{SHARD_OPTION} {_options[SHARD_OPTION]}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def is_shardable(_command_name : str, _auxilliary_arguments : list[str]) -> bool:
+    """
+    Returns True if the jobs of _command_name can be planned and split into shards,
+        i.e., each image has its own outputs (so not merges, or pipelines ending in one).
+    """
+    if _command_name == PIPELINE_COMMAND:
+        return get_pipeline_stages(_auxilliary_arguments[0])[1] is None
+    return _command_name in SHARDABLE_COMMANDS
 
 
 def ensure_dir(_dir_to_test : str) -> bool:
     """
     Ensures that either _dir_to_test is already a directory, or that it can be created.
-    Exits from the program if it does not exist and cannot be created.
+    Raises NotADirectoryError if it does not exist and cannot be created.
     """
     if not os.path.isdir(_dir_to_test):
         try:
             os.mkdir(_dir_to_test)
         except OSError:
-            sys.exit("Directory does not exist, and could not create it.")
+            raise NotADirectoryError("Directory does not exist, and could not create it.") \
+                from None
 
     return True
 
@@ -69,135 +269,409 @@ def inform_user_before_operation(_input_image_dir : str, _output_image_dir : str
     elif _command_name == NEGATIVE_COMMAND:
         print(f"Turning files from {_input_image_dir} negative and "
             f"putting them in {_output_image_dir}")
+    elif _command_name == PIPELINE_COMMAND:
+        print(f"Putting files from {_input_image_dir} through a pipeline and "
+            f"putting them in {_output_image_dir}")
     elif _command_name == MERGE_COMMAND:
         print(f"Merging files from {_input_image_dir} and "
             f"putting them in {_output_image_dir} (assumes images are the same size)")
+    elif _command_name == PLAN_COMMAND:
+        print(f"Planning the jobs for files from {_input_image_dir}, "
+            f"and saving the plan in {_output_image_dir}")
+    elif _command_name == COLLECT_COMMAND:
+        print(f"Collecting the shards' manifests in {_output_image_dir}")
 
 
-def get_num_files_in_directory(_directory : str) -> int:
+def get_num_files_in_directory(_directory : str, _recursive : bool = False) -> int:
     """
-    Takes a directory path and returns an integer indicating how many files are therein contained.
+    Takes a directory path and returns an integer indicating how many files are therein contained
+        (including those in its subdirectories, if _recursive is True).
     """
-    return len(glob.glob(_directory+'*'))
+    return count_files_in_directory(_directory, _recursive)
 
 
 def inform_user_after_operation(_input_image_dir : str, _output_image_dir : str, \
-    _command_name : str, _num_previous_files) -> None:
+    _command_name : str, _num_previous_files, _failures : list[JobFailure] = None) -> None:
     """
     Informs the user about the success of their operation, and details how many
         files were created as a result of their operation request.
     Takes into account any files that were previously in the output directory.
+    Lists any input files which couldn't be processed.
     """
     num_old_files = get_num_files_in_directory(_input_image_dir)
-    num_new_files = get_num_files_in_directory(_output_image_dir) - _num_previous_files
-    print(f"{_command_name} successful: {num_old_files} files in {_input_image_dir} "
+    #Outputs can be saved in subdirectories (e.g., one for each of pad's --variants)
+    num_new_files = get_num_files_in_directory(_output_image_dir, True) - _num_previous_files
+    if _failures:
+        print(f"{_command_name} finished with {len(_failures)} failures:")
+        for failure in _failures:
+            print(f"    {failure.input_path} ({failure.message})")
+    else:
+        print(f"{_command_name} successful: ", end="")
+    print(f"{num_old_files} files in {_input_image_dir} "
         f"have been copied over to {num_new_files} files in {_output_image_dir}")
 
 
-def choose_image_command(_input_image_paths : list[str], _output_image_dir : str, \
-    _command_name : str, _auxilliary_arguments : [str] = None) -> None:
+def get_pad_colour(_colour_name : Optional[str]) -> tuple[int,int,int]:
+    """
+    Maps the colour name given to the pad command to the colour to pad with.
+    """
+    if _colour_name == "black":
+        padding_colour = BLACK_COLOUR
+    elif _colour_name == "white":
+        padding_colour = WHITE_COLOUR
+    else:
+        padding_colour = DEFAULT_PAD_COLOUR
+
+    return padding_colour
+
+
+def get_merge_arguments(_auxilliary_arguments : list[str]) -> Tuple[int, Direction, Direction]:
+    """
+    Checks the arguments given to the merge command, and returns the number of rows/columns,
+        the direction which was constrained, and the fill direction.
+    """
+    #Check to make the number of rows/columns supplied are an integer, and that
+    #   the user specified whether the grid is filled row-wise or column-wise
+    if len(_auxilliary_arguments) >= 3 and \
+        re.search(ONLY_INTEGERS_REGEX, _auxilliary_arguments[0]) and \
+        Direction.string_to_value(_auxilliary_arguments[1]) and \
+        Direction.string_to_value(_auxilliary_arguments[2]):
+
+        #The user has constrained either the number of rows or columns
+        constrained = int(_auxilliary_arguments[0])
+
+        return constrained, Direction.string_to_value(_auxilliary_arguments[1]), \
+            Direction.string_to_value(_auxilliary_arguments[2])
+
+    raise UsageError(Error.WRONG_MERGE_ARGUMENTS)
+
+
+def is_pipeline(_command : str) -> bool:
+    """
+    Returns True if _command is a series of commands rather than a single command,
+        e.g., "neg,pad:black,merge:2:row:row".
+    """
+    return PIPELINE_STAGE_SEPARATOR in _command or PIPELINE_ARGUMENT_SEPARATOR in _command
+
+
+def get_pipeline_stages(_pipeline : str, _negative_settings : Optional[NegativeSettings] = None) \
+    -> Tuple[list[tuple], Optional[tuple]]:
+    """
+    Takes a series of commands, such as "neg,pad:black,merge:2:row:row", and returns
+        the per-image stages (see image_ops.apply_stages), along with the merge
+        arguments if the pipeline ends by merging the images (or None if it doesn't).
+    Any negative stages use _negative_settings.
+    """
+    stages = []
+    merge_arguments = None
+    stage_strings = _pipeline.split(PIPELINE_STAGE_SEPARATOR)
+    for stage_index, stage_string in enumerate(stage_strings):
+        command_name, *stage_arguments = stage_string.split(PIPELINE_ARGUMENT_SEPARATOR)
+
+        if command_name == NEGATIVE_COMMAND and not stage_arguments:
+            stages.append((NEGATIVE_COMMAND, _negative_settings))
+        elif command_name == PADDING_COMMAND and len(stage_arguments) <= 1:
+            stages.append((PADDING_COMMAND, \
+                get_pad_colour(stage_arguments[0] if stage_arguments else None)))
+
+        #Merging turns all of the images into one, so it can only be the final stage
+        elif command_name == MERGE_COMMAND and stage_index == len(stage_strings) - 1:
+            merge_arguments = get_merge_arguments(stage_arguments)
+        else:
+            raise UsageError(Error.WRONG_PIPELINE_ARGUMENTS, stage_string)
+
+    return stages, merge_arguments
+
+
+def choose_image_command(_input_image_paths : Iterable[str], _output_image_dir : str, \
+    _command_name : str, _auxilliary_arguments : [str] = None, \
+    _options : dict[str, str] = None, _input_image_dir : Optional[str] = None, \
+    _rename_planner : Optional[RenamePlanner] = None) -> list[JobFailure]:
     """
     The "switch-case" for all possible image commands.
-    Error-handling should have been performed before this function was called.
+    Error-handling should have been performed before this function was called,
+        apart from checking the options, which raises UsageError if any are wrong.
+    _input_image_dir, if given, is where _input_image_paths were found, so that images
+        from its subdirectories can be saved in matching subdirectories.
+    _rename_planner, if given, numbers renamed images on from those it has already numbered
+        (e.g., for each batch of watched images).
+    Returns the input images which could not be processed.
     """
+    if _options is None:
+        _options = {}
+    #None lets the batch decide how many processes to use
+    num_jobs = get_integer_option(_options, JOBS_OPTION)
+    force = FORCE_OPTION in _options
+    #Without --read-ahead, the batch decides whether to read ahead (see QueueDepths)
+    queue_depths = QueueDepths(get_integer_option(_options, READ_AHEAD_OPTION), \
+        get_integer_option(_options, WRITER_THREADS_OPTION, DEFAULT_WRITER_THREADS), \
+        get_integer_option(_options, WRITE_QUEUE_OPTION, DEFAULT_WRITE_QUEUE))
+    memory_budget = get_memory_option(_options, MAX_MEMORY_OPTION)
+    negative_settings = get_negative_settings(_options)
+    merge_format = _options.get(MERGE_FORMAT_OPTION, DEFAULT_MERGE_FORMAT)
+    if merge_format not in MERGE_FORMATS:
+        raise UsageError(Error.INVALID_OPTION, f"{MERGE_FORMAT_OPTION} {merge_format}")
+    merge_layout = _options.get(MERGE_LAYOUT_OPTION, DEFAULT_MERGE_LAYOUT)
+    if merge_layout not in MERGE_LAYOUTS:
+        raise UsageError(Error.INVALID_OPTION, f"{MERGE_LAYOUT_OPTION} {merge_layout}")
+    encoder = get_encoder_settings(_options)
+    failures = []
+
+    #Only this shard's slice of the planned jobs is done, keeping its own manifest
+    shard = get_shard_option(_options)
+    planned_jobs = None
+    manifest_name = MANIFEST_NAME
+    if shard is not None:
+        if not is_shardable(_command_name, _auxilliary_arguments):
+            raise UsageError(Error.INVALID_OPTION, f"{SHARD_OPTION} with {_command_name}")
+        planned_jobs = get_shard(load_plan(_input_image_dir, _output_image_dir, \
+            [_command_name, *(_auxilliary_arguments or [])], _options), *shard)
+        _input_image_paths = [input_path for input_path, _ in planned_jobs]
+        #Renames are given their planned paths, but the other commands work out their
+        #   outputs again, which have to be where the plan (and so collect) expects them
+        if _command_name != RENAMING_COMMAND:
+            check_planned_outputs(planned_jobs, plan_outputs(_command_name, \
+                _input_image_paths, _output_image_dir, _input_image_dir, \
+                get_pad_variants(_options)))
+        manifest_name = get_shard_manifest_name(*shard)
+        print(f"Working on shard {shard[0]} of {shard[1]} ({len(planned_jobs)} images)")
 
     #The files are in the proper order, but their file names aren't sequential
     if _command_name == RENAMING_COMMAND:
-        rename_images(_input_image_paths, _output_image_dir)
+        rename_mode = _options.get(RENAME_MODE_OPTION, DEFAULT_RENAME_MODE)
+        if rename_mode not in RENAME_MODES:
+            raise UsageError(Error.INVALID_OPTION, f"{RENAME_MODE_OPTION} {rename_mode}")
+        alternatives_mode = get_alternatives_mode(_options)
+        planned_renames = None
+        if planned_jobs is not None:
+            planned_renames = [(input_path, output_paths[0]) \
+                for input_path, output_paths in planned_jobs]
+        elif _rename_planner is not None:
+            planned_renames = [(input_path, _rename_planner.plan(input_path)) \
+                for input_path in _input_image_paths]
+        failures = rename_images(_input_image_paths, _output_image_dir, num_jobs, rename_mode, \
+            force, encoder, planned_renames, manifest_name, alternatives_mode)
 
     #The images need to be squared off with padding
     elif _command_name == PADDING_COMMAND:
-        if _auxilliary_arguments[0] == "black":
-            padding_colour = BLACK_COLOUR
-        elif _auxilliary_arguments[0] == "white":
-            padding_colour = WHITE_COLOUR
-        else:
-            padding_colour = DEFAULT_PAD_COLOUR
-        pad_images(_input_image_paths, _output_image_dir, padding_colour)
+        padding_colour = get_pad_colour(_auxilliary_arguments[0] if _auxilliary_arguments \
+            else None)
+        failures = pad_images(_input_image_paths, _output_image_dir, padding_colour, num_jobs, \
+            force, _input_image_dir, queue_depths, memory_budget, get_pad_variants(_options), \
+            encoder, manifest_name)
 
 
     #The images need to have their colours inverted
     elif _command_name == NEGATIVE_COMMAND:
-        negative_images(_input_image_paths, _output_image_dir)
+        failures = negative_images(_input_image_paths, _output_image_dir, num_jobs, force, \
+            _input_image_dir, queue_depths, memory_budget, negative_settings, encoder, \
+            manifest_name)
 
 
     #The images will be merged into one image, with a specified number of rows
     elif _command_name == MERGE_COMMAND:
         print(_auxilliary_arguments)
-        assert len(_auxilliary_arguments) >= 3
-
-        #Check to make the number of rows/columns supplied are an integer, and that
-        #   the user specified whether the grid is filled row-wise or column-wise
-        if re.search(ONLY_INTEGERS_REGEX, _auxilliary_arguments[0]) and \
-            Direction.string_to_value(_auxilliary_arguments[1]) and \
-            Direction.string_to_value(_auxilliary_arguments[2]):
-
-            #The user has constrained either the number of rows or columns
-            constrained = int(_auxilliary_arguments[0])
-
-            merge_images(_input_image_paths, _output_image_dir, constrained, \
-                Direction.string_to_value(_auxilliary_arguments[1]), \
-                Direction.string_to_value(_auxilliary_arguments[2]))
+        merge_images(_input_image_paths, _output_image_dir, \
+            *get_merge_arguments(_auxilliary_arguments), \
+            get_integer_option(_options, BAND_ROWS_OPTION, DEFAULT_MERGE_BAND_ROWS), \
+            get_size_option(_options, TILE_SIZE_OPTION), \
+            get_integer_option(_options, OUTPUT_WIDTH_OPTION), force, \
+            _queue_depths=queue_depths, _memory_budget=memory_budget, \
+            _output_format=merge_format, _num_jobs=num_jobs, _encoder=encoder, \
+            _thumbnail_cache_size=get_thumbnail_cache_size(_options), _layout=merge_layout)
+
+
+    #The images will go through several of the above commands, one after the other
+    elif _command_name == PIPELINE_COMMAND:
+        stages, merge_arguments = get_pipeline_stages(_auxilliary_arguments[0], \
+            negative_settings)
+        if merge_arguments is None:
+            failures = pipeline_images(_input_image_paths, _output_image_dir, stages, num_jobs, \
+                force, _input_image_dir, queue_depths, memory_budget, encoder, manifest_name)
         else:
-            print_help(Error.WRONG_MERGE_ARGUMENTS)
+            merge_images(_input_image_paths, _output_image_dir, *merge_arguments, \
+                get_integer_option(_options, BAND_ROWS_OPTION, DEFAULT_MERGE_BAND_ROWS), \
+                get_size_option(_options, TILE_SIZE_OPTION), \
+                get_integer_option(_options, OUTPUT_WIDTH_OPTION), force, stages, \
+                queue_depths, memory_budget, merge_format, num_jobs, encoder, \
+                get_thumbnail_cache_size(_options), merge_layout)
+
+    #Every job of a (sharded) command is worked out up front, and saved for the shards to share
+    elif _command_name == PLAN_COMMAND:
+        planned_command, *planned_arguments = _auxilliary_arguments
+        if not is_shardable(planned_command, planned_arguments):
+            raise UsageError(Error.INVALID_COMMAND, planned_command)
+        num_planned_jobs = write_plan(_input_image_dir, _output_image_dir, \
+            _auxilliary_arguments, _options, plan_outputs(planned_command, _input_image_paths, \
+            _output_image_dir, _input_image_dir, get_pad_variants(_options), \
+            get_alternatives_mode(_options), num_jobs))
+        print(f"Planned {num_planned_jobs} jobs for {' '.join(_auxilliary_arguments)}")
+
+    #The shards have all finished, and their manifests are put together
+    elif _command_name == COLLECT_COMMAND:
+        failures = collect_shards(_input_image_dir, _output_image_dir, _auxilliary_arguments)
 
     else:
         print("Error: Incorrect command supplied")
         assert False #should never get here - commandName was already validated
 
-if __name__ == "__main__":
-    #Ensure the user supplied a correct command word and number of arguments
-    if len(sys.argv) < 2:
-        print_help(Error.TOO_FEW_ARGUMENTS)
+    return failures
 
-    elif not sys.argv[2] in VALID_COMMANDS:
-        print_help(Error.INVALID_COMMAND, sys.argv[2])
-
-    elif not len(sys.argv) >= MAP_COMMAND_TO_NUM_ARGS[sys.argv[2]]:
-        print_help(Error.WRONG_NUM_ARGUMENTS, sys.argv[2])
-
-    else:
-        #Get the input file paths and make sure there aren't too many
-        inputImageDir = sys.argv[1]
-
-        #add a trailing slash to the input directory if one wasn't given
-        if not inputImageDir[-1] == '/':
-            inputImageDir += '/'
-
-        #Make sure there aren't too many images to process
-        inputImagePaths = get_folder_images(inputImageDir)
-
-        debug(f"Image paths:\n{inputImagePaths}")
-
-
-        if len(inputImagePaths) > MAX_FILES:
-            print_help(Error.TOO_MANY_FILES, len(inputImagePaths))
+def watch_images(_input_image_dir : str, _output_image_dir : str, _command_name : str, \
+    _auxilliary_arguments : Optional[list[str]], _options : dict[str, str]) -> list[JobFailure]:
+    """
+    Does _command_name (see choose_image_command()) to the images in _input_image_dir as
+        they arrive, a batch at a time, until interrupted (see watch_folder.py).
+    Renamed images are taken in order, and numbered on from the images before them,
+        so they are numbered the same as if they had been renamed all at once.
+    Returns the input images which could not be processed.
+    """
+    if SHARD_OPTION in _options or not is_shardable(_command_name, _auxilliary_arguments):
+        raise UsageError(Error.INVALID_OPTION, f"{WATCH_OPTION} with {_command_name}")
+    #Finding alternative takes by how they look compares every image with every other
+    if get_alternatives_mode(_options) == HASH_ALTERNATIVES:
+        raise UsageError(Error.INVALID_OPTION, f"{WATCH_OPTION} with {ALTERNATIVES_OPTION} "
+            f"{HASH_ALTERNATIVES}")
+
+    rename_planner = None
+    if _command_name == RENAMING_COMMAND:
+        rename_planner = RenamePlanner(_output_image_dir)
+    max_batch = get_integer_option(_options, JOBS_OPTION, default_num_jobs()) * \
+        WATCH_IMAGES_PER_PROCESS
+
+    #Every batch reuses the same worker processes, rather than starting its own
+    pools_were_warm = batch.KEEP_POOLS_WARM
+    batch.keep_pools_warm()
+    try:
+        return watch_folder(_input_image_dir, lambda _image_paths: choose_image_command( \
+            _image_paths, _output_image_dir, _command_name, _auxilliary_arguments, _options, \
+            _input_image_dir, rename_planner), max_batch, RECURSIVE_OPTION in _options, \
+            rename_planner is not None)
+    finally:
+        if not pools_were_warm:
+            batch.keep_pools_warm(False)
+
+
+def run_command(_arguments : list[str], _working_dir : Optional[str] = None) -> list[JobFailure]:
+    """
+    Runs one of the commands, given the same _arguments as on the command line (without
+        "photo_tools.py"), e.g., run_command(["scans/", "pad", "black", "--jobs", "4"]).
+    Relative paths (the directory, and any report files) are found from _working_dir
+        if it's given, rather than the current directory.
+    Returns the input images which could not be processed.
+    Raises UsageError if the arguments are wrong, PlanError if a shard's plan is missing
+        or doesn't match, RenameError if two images would be renamed to the same name,
+        and NotADirectoryError if the output directory can't be made.
+    """
+    #Pull out any options (e.g., --jobs 4), leaving just the positional arguments
+    arguments, options = extract_options(_arguments)
+    if _working_dir is not None:
+        arguments[:1] = [os.path.join(_working_dir, argument) for argument in arguments[:1]]
+        for option_name in (STATS_OPTION, CPROFILE_OPTION):
+            #(a --stats report to "-" goes to stderr instead)
+            if option_name in options and options[option_name] != "-":
+                options[option_name] = os.path.join(_working_dir, options[option_name])
+
+    #Print debugging information and/or time every stage of the work, if asked to
+    constants.DEBUG = DEBUG_OPTION in options
+    #Each run reports on its own work only, even if earlier ones ran in this process
+    instrumentation.reset()
+    instrumentation.enable(STATS_OPTION in options)
+
+    #A series of commands (e.g., neg,pad:black) is given to the pipeline command
+    if len(arguments) > 1 and is_pipeline(arguments[1]):
+        arguments.insert(1, PIPELINE_COMMAND)
+    #plan and collect are followed by the command they are for, which can also be a pipeline
+    if len(arguments) > 2 and arguments[1] in SHARDING_COMMANDS and is_pipeline(arguments[2]):
+        arguments.insert(2, PIPELINE_COMMAND)
 
+    #Ensure the user supplied a correct command word and number of arguments
+    #(the number of arguments needed counts "photo_tools.py" as one of them)
+    if len(arguments) < 2:
+        raise UsageError(Error.TOO_FEW_ARGUMENTS)
+
+    if not arguments[1] in VALID_COMMANDS:
+        raise UsageError(Error.INVALID_COMMAND, arguments[1])
+
+    if not len(arguments) + 1 >= MAP_COMMAND_TO_NUM_ARGS[arguments[1]]:
+        raise UsageError(Error.WRONG_NUM_ARGUMENTS, arguments[1])
+
+    if arguments[1] in SHARDING_COMMANDS and arguments[2] not in SHARDABLE_COMMANDS:
+        raise UsageError(Error.INVALID_COMMAND, arguments[2])
+
+    if arguments[1] in SHARDING_COMMANDS and \
+        not len(arguments) >= MAP_COMMAND_TO_NUM_ARGS[arguments[2]]:
+        raise UsageError(Error.WRONG_NUM_ARGUMENTS, arguments[2])
+
+    #Check the encoder settings before anything is made (they're read again for the command)
+    get_encoder_settings(options)
+
+    #Get the input directory
+    inputImageDir = arguments[0]
+
+    #add a trailing slash to the input directory if one wasn't given
+    if not inputImageDir[-1] == '/':
+        inputImageDir += '/'
+
+    #The images are found as they are needed, so there's no limit on how many there can be
+    inputImagePaths = iter_folder_images(inputImageDir, RECURSIVE_OPTION in options)
+
+    #Define the output directory based on the input directory's name
+    #Don't capture the directory-slash before adding the relevant suffix
+    #(plan and collect use the directory of the command they are for)
+    outputCommand = arguments[2] if arguments[1] in SHARDING_COMMANDS else arguments[1]
+    outputImageDir = inputImageDir[:-1] + MAP_COMMAND_TO_SUFFIX[outputCommand]
+
+    #Make sure we can write to the directory
+    ensure_dir(outputImageDir)
+
+    #Get the number of files already in the output image directory
+    num_previous_files = get_num_files_in_directory(outputImageDir, True)
+
+    #Inform the user what is going to happen to the images
+    inform_user_before_operation(inputImageDir, outputImageDir, arguments[1])
+
+    #Now that we have prepared everything, we can start performing the
+    #   actual requested function
+    start_time = time.perf_counter()
+    profiler = cProfile.Profile() if CPROFILE_OPTION in options else None
+    if profiler is not None:
+        profiler.enable()
+
+    #Send over the auxilliary argument if one is given
+    try:
+        if WATCH_OPTION in options:
+            failures = watch_images(inputImageDir, outputImageDir, arguments[1], \
+                arguments[2:], options)
+        elif len(arguments) > 2:
+            failures = choose_image_command(inputImagePaths, outputImageDir, arguments[1], \
+                arguments[2:], options, inputImageDir)
         else:
+            failures = choose_image_command(inputImagePaths, outputImageDir, arguments[1], \
+                _options=options, _input_image_dir=inputImageDir)
+    finally:
+        #Only the main process is profiled, so use --jobs 1 to profile the image work itself
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options[CPROFILE_OPTION])
+    if STATS_OPTION in options:
+        instrumentation.write_report(options[STATS_OPTION], \
+            time.perf_counter() - start_time)
+
+    #Inform the user what happened to the images
+    inform_user_after_operation(inputImageDir, outputImageDir, arguments[1], \
+        num_previous_files, failures)
+
+    #TODO incorporate auxilliary arguments into inform_user functions?
+    return failures
 
-            #Define the output directory based on the input directory's name
-            #Don't capture the directory-slash before adding the relevant suffix
-            outputImageDir = inputImageDir[:-1] + MAP_COMMAND_TO_SUFFIX[sys.argv[2]]
-
-            #Make sure we can write to the directory
-            ensure_dir(outputImageDir)
-
-            #Get the number of files already in the output image directory
-            num_previous_files = get_num_files_in_directory(outputImageDir)
-
-            #Inform the user what is going to happen to the images
-            inform_user_before_operation(inputImageDir, outputImageDir, sys.argv[2])
-
-            #Now that we have prepared everything, we can start performing the
-            #   actual requested function
-            #Send over the auxilliary argument if one is given
-            if len(sys.argv) > 3:
-                choose_image_command(inputImagePaths, outputImageDir, sys.argv[2], sys.argv[3:])
-            else:
-                choose_image_command(inputImagePaths, outputImageDir, sys.argv[2])
-
-            #Inform the user what happened to the images
-            inform_user_after_operation(inputImageDir, outputImageDir, sys.argv[2], \
-                num_previous_files)
-
-            #TODO incorporate auxilliary arguments into inform_user functions?
+if __name__ == "__main__":
+    try:
+        run_command(sys.argv[1:])
+    except UsageError as error:
+        print_help(error.error_code, error.extra_arg)
+    except (PlanError, RenameError) as error:
+        #e.g., a shard was run before its batch was planned
+        sys.exit(f"Error: {error}")
+    except NotADirectoryError as error:
+        sys.exit(str(error))
@@ -0,0 +1,147 @@
+"""Writes a PNG file a few rows at a time, so the whole image never has to be in memory"""
+import struct
+import zlib
+
+from PIL import Image, ImageChops
+
+#PNG colour types for each of the image modes that can be written
+MAP_MODE_TO_PNG_COLOUR_TYPE = {
+    "L" : 0,
+    "RGB" : 2,
+    "LA" : 4,
+    "RGBA" : 6,
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+#The "Sub" filter stores each byte as the difference from the same channel of the pixel
+#   to its left, which compresses photographs much better than the raw bytes
+PNG_SUB_FILTER = b"\x01"
+
+#How many rows of a band are filtered at once
+FILTER_CHUNK_ROWS = 64
+
+#How many compressed bytes to collect before writing them out as an IDAT chunk
+IDAT_CHUNK_SIZE = 1 << 20
+
+class PngStreamWriter:
+    """
+    Writes an 8-bit PNG of a known size, with its rows supplied in order as a series
+        of images ("bands") which are as wide as the PNG.
+    Only the band being written and the compressor's state are kept in memory.
+    If anything goes wrong, the file is closed without being finished.
+
+    e.g.,
+        with PngStreamWriter("out.png", (100, 200), "RGB") as writer:
+            writer.write_rows(top_half)
+            writer.write_rows(bottom_half)
+    """
+    def __init__(self, _path : str, _size : tuple[int,int], _mode : str, \
+        _compress_level : int = 6) -> None:
+        if _mode not in MAP_MODE_TO_PNG_COLOUR_TYPE:
+            raise ValueError(f"Can't stream a PNG in {_mode} mode")
+
+        self.size = _size
+        self.mode = _mode
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(_compress_level)
+        self.pending_data = []
+        self.pending_size = 0
+
+        self.file = open(_path, "wb") #pylint: disable=consider-using-with
+        self.file.write(PNG_SIGNATURE)
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", _size[0], _size[1], 8, \
+            MAP_MODE_TO_PNG_COLOUR_TYPE[_mode], 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close(_exception_type is None)
+
+    def write_rows(self, _band : Image.Image) -> None:
+        """
+        Filters, compresses and writes out all of the rows in _band, which are placed
+            directly below any rows that have already been written.
+        """
+        if _band.mode != self.mode or _band.size[0] != self.size[0]:
+            raise ValueError(f"Band of {_band.mode} {_band.size} doesn't fit a "
+                f"{self.mode} PNG of {self.size}")
+        if self.rows_written + _band.size[1] > self.size[1]:
+            raise ValueError("Too many rows have been written to the PNG")
+
+        #Filter the band a few rows at a time, so the filtered copies stay small
+        width, height = _band.size
+        for chunk_top in range(0, height, FILTER_CHUNK_ROWS):
+            chunk_height = min(FILTER_CHUNK_ROWS, height - chunk_top)
+            with _band.crop((0, chunk_top, width, chunk_top + chunk_height)) as chunk:
+                filtered_rows = memoryview(sub_filter(chunk))
+
+            #Every row in a PNG starts with a byte saying which filter it uses
+            row_length = len(filtered_rows) // chunk_height
+            for row in range(chunk_height):
+                self.compress(PNG_SUB_FILTER)
+                self.compress(filtered_rows[row * row_length : (row + 1) * row_length])
+
+        self.rows_written += height
+
+    def compress(self, _data : bytes) -> None:
+        """
+        Compresses _data, writing out an IDAT chunk whenever enough has built up.
+        """
+        compressed_data = self.compressor.compress(_data)
+        if compressed_data:
+            self.pending_data.append(compressed_data)
+            self.pending_size += len(compressed_data)
+            if self.pending_size >= IDAT_CHUNK_SIZE:
+                self.flush_data()
+
+    def flush_data(self) -> None:
+        """
+        Writes all of the compressed data collected so far as a single IDAT chunk.
+        """
+        if self.pending_size:
+            self.write_chunk(b"IDAT", b"".join(self.pending_data))
+            self.pending_data = []
+            self.pending_size = 0
+
+    def write_chunk(self, _chunk_type : bytes, _data : bytes) -> None:
+        """
+        Writes a PNG chunk: its length, type, data and checksum.
+        """
+        self.file.write(struct.pack(">I", len(_data)))
+        self.file.write(_chunk_type)
+        self.file.write(_data)
+        self.file.write(struct.pack(">I", zlib.crc32(_data, zlib.crc32(_chunk_type))))
+
+    def close(self, _finish : bool = True) -> None:
+        """
+        Finishes the PNG and closes its file.
+        If _finish is False, the file is just closed (e.g., after an error).
+        """
+        if self.file.closed:
+            return
+        try:
+            if _finish:
+                if self.rows_written != self.size[1]:
+                    raise ValueError(f"Only {self.rows_written} of the PNG's "
+                        f"{self.size[1]} rows were written")
+                self.pending_data.append(self.compressor.flush())
+                self.pending_size += len(self.pending_data[-1])
+                self.flush_data()
+                self.write_chunk(b"IEND", b"")
+        finally:
+            self.file.close()
+
+
+def sub_filter(_image : Image.Image) -> bytes:
+    """
+    Returns the bytes of _image with the PNG "Sub" filter applied to every row.
+    """
+    #Shift the image one pixel to the right, so that subtracting it from the image
+    #   gives each pixel's difference from its left neighbour
+    width, height = _image.size
+    with Image.new(_image.mode, _image.size) as shifted_image:
+        if width > 1:
+            shifted_image.paste(_image.crop((0, 0, width - 1, height)), (1, 0))
+        return ImageChops.subtract_modulo(_image, shifted_image).tobytes()
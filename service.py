@@ -0,0 +1,159 @@
+"""Keeps photo_tools running between batches, with its worker processes already started.
+
+Scripts which run many small batches (e.g., one folder per roll of film) otherwise pay for
+    starting Python, importing Pillow and NumPy, and starting every worker process,
+    each time they run photo_tools.py.
+
+Should be run as
+    "python service.py [--port 8765] [--jobs N]"
+and then sent jobs (from any directory) with the same arguments as photo_tools.py, e.g.,
+    "python service_client.py scans/ pad black --jobs 4"
+or from Python with service_client.submit_job().
+
+Jobs are run one at a time, in the order they arrive, and everything a job prints is
+    streamed back to the client which sent it, as JSON lines, while it runs.
+"""
+import argparse
+import contextlib
+import io
+import json
+import signal
+import sys
+import traceback
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Optional
+
+from constants import *
+import batch
+from batch import default_num_jobs, describe_error
+from image_ops import RenameError
+from photo_tools import run_command
+from shard_plan import PlanError
+
+class OutputStreamer(io.TextIOBase):
+    """
+    Stands in for stdout while a job runs, passing each whole line printed to _send_line.
+    """
+    def __init__(self, _send_line : Callable[[str], None]) -> None:
+        super().__init__()
+        self.send_line = _send_line
+        self.partial_line = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, _text : str) -> int:
+        *lines, self.partial_line = (self.partial_line + _text).split("\n")
+        for line in lines:
+            self.send_line(line)
+        return len(_text)
+
+    def finish(self) -> None:
+        """
+        Sends the last line, if it didn't end with a newline.
+        """
+        if self.partial_line:
+            self.send_line(self.partial_line)
+            self.partial_line = ""
+
+
+def run_requested_job(_arguments : list[str], _working_dir : Optional[str], \
+    _send_message : Callable[[dict], None]) -> dict:
+    """
+    Runs photo_tools with _arguments (see photo_tools.run_command()), sending each line
+        it prints to _send_message as {"output" : line}.
+    Returns the message which ends the job: {"failures" : [[input path, reason], ...]},
+        or {"error" : description} if the job couldn't be run.
+    A job going wrong is only reported to its client, so the service keeps running.
+    """
+    streamer = OutputStreamer(lambda _line: _send_message({"output" : _line}))
+    try:
+        with contextlib.redirect_stdout(streamer):
+            try:
+                failures = run_command(_arguments, _working_dir)
+            finally:
+                streamer.finish()
+    except (UsageError, PlanError, RenameError, NotADirectoryError) as error:
+        return {"error" : str(error)}
+    except Exception as error: #pylint: disable=broad-except
+        traceback.print_exc()
+        return {"error" : describe_error(error)}
+
+    return {"failures" : [list(failure) for failure in failures]}
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    Runs each job POSTed to SERVICE_JOBS_PATH as {"arguments" : [...], "working_dir" : ...},
+        and streams back its output, one JSON message per line.
+    """
+    def do_POST(self) -> None: #pylint: disable=invalid-name
+        """
+        Runs the job in the request, if it is one.
+        """
+        if self.path != SERVICE_JOBS_PATH:
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            arguments = [str(argument) for argument in request["arguments"]]
+            working_dir = request.get("working_dir")
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, 'Expected {"arguments" : [...], "working_dir" : ...}')
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.client_connected = True
+        print(f"Running {' '.join(arguments)}", file=sys.stderr)
+        self.send_message(run_requested_job(arguments, working_dir, self.send_message))
+
+    def send_message(self, _message : dict) -> None:
+        """
+        Sends _message to the client, unless it has gone away (in which case the job
+            carries on regardless, so its outputs and manifest are still finished).
+        """
+        if not self.client_connected:
+            return
+        try:
+            self.wfile.write(json.dumps(_message).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except OSError:
+            self.client_connected = False
+
+
+def serve(_port : int, _num_jobs : int) -> None:
+    """
+    Runs jobs sent to _port until interrupted, keeping the worker processes of every
+        batch running for the next one, starting with a pool of _num_jobs processes.
+    """
+    batch.keep_pools_warm()
+    try:
+        #Start the usual number of processes now, so the first job doesn't wait for them
+        if _num_jobs > 1:
+            with batch.open_process_pool(_num_jobs) as executor:
+                list(executor.map(int, range(_num_jobs)))
+
+        #Jobs are handled one at a time, as each one already uses every core
+        with HTTPServer((SERVICE_HOST, _port), JobRequestHandler) as server:
+            print(f"Waiting for jobs on {SERVICE_HOST}:{_port}", file=sys.stderr)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batch.keep_pools_warm(False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs photo_tools jobs sent by service_client.py")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVICE_PORT, \
+        help="the port to listen on (only from this machine)")
+    parser.add_argument("--jobs", type=int, default=default_num_jobs(), \
+        help="how many worker processes to start straight away")
+    parsed = parser.parse_args()
+
+    #Stopping the service with kill also shuts down its worker processes
+    signal.signal(signal.SIGTERM, lambda _signal_number, _frame: sys.exit(0))
+    serve(parsed.port, parsed.jobs)
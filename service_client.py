@@ -0,0 +1,77 @@
+"""Sends a job to a running service.py, and prints what it prints while it runs.
+
+Should be run as
+    "python service_client.py [--port 8765] <the same arguments as photo_tools.py>"
+e.g.,
+    "python service_client.py scans/ pad black --jobs 4"
+
+Pillow and NumPy aren't imported, so the client itself starts quickly.
+"""
+import http.client
+import json
+import os
+import sys
+
+from typing import Callable, Optional
+
+from constants import *
+from batch import JobFailure
+
+class ServiceError(Exception):
+    """The service couldn't be reached, or it couldn't run the job"""
+
+
+def submit_job(_arguments : list[str], _port : int = DEFAULT_SERVICE_PORT, \
+    _on_output : Optional[Callable[[str], None]] = print, \
+    _working_dir : Optional[str] = None) -> list[JobFailure]:
+    """
+    Has the service listening on _port run photo_tools with _arguments (the same as on the
+        command line, without "photo_tools.py"), and waits for it to finish.
+    Each line that the job prints is passed to _on_output as soon as it is printed.
+    Relative paths in _arguments are found from _working_dir (the current directory
+        if it isn't given), rather than wherever the service was started.
+    Returns the input images which could not be processed.
+    Raises ServiceError if the service can't be reached, or the job couldn't be run
+        (e.g., the arguments were wrong).
+    """
+    request = json.dumps({"arguments" : list(_arguments), \
+        "working_dir" : os.path.abspath(_working_dir or os.getcwd())})
+    connection = http.client.HTTPConnection(SERVICE_HOST, _port)
+    try:
+        try:
+            connection.request("POST", SERVICE_JOBS_PATH, request, \
+                {"Content-Type" : "application/json"})
+            response = connection.getresponse()
+        except OSError as error:
+            raise ServiceError(f"Couldn't reach a service on port {_port} ({error}), "
+                "start one with 'python service.py'") from None
+        if response.status != 200:
+            raise ServiceError(f"The service refused the job ({response.status} {response.reason})")
+
+        #The job's output is streamed back one message per line, ending with its result
+        for line in response:
+            message = json.loads(line)
+            if "output" in message:
+                if _on_output is not None:
+                    _on_output(message["output"])
+            elif "error" in message:
+                raise ServiceError(message["error"])
+            else:
+                return [JobFailure(*failure) for failure in message["failures"]]
+    finally:
+        connection.close()
+
+    raise ServiceError("The service stopped before the job finished")
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    port = DEFAULT_SERVICE_PORT
+    if arguments[:1] == ["--port"] and len(arguments) > 1:
+        port = int(arguments[1])
+        arguments = arguments[2:]
+
+    try:
+        submit_job(arguments, port)
+    except ServiceError as error:
+        sys.exit(f"Error: {error}")
@@ -0,0 +1,154 @@
+"""Splits one batch across several machines, which share the same input and output directories.
+
+A plan, listing every job's input and output files, is made once up front (so that things
+    which depend on the whole batch, like rename's new indices, are decided in one place),
+    and saved in the output directory.
+Each machine then works on its own slice ("shard") of the planned jobs, keeping its own
+    manifest, and the shards' manifests are finally collected into the usual one.
+
+e.g.,
+    python photo_tools.py scans/ plan rename
+    python photo_tools.py scans/ rename --shard 1/2     (on one machine)
+    python photo_tools.py scans/ rename --shard 2/2     (on another)
+    python photo_tools.py scans/ collect rename
+"""
+import glob
+import json
+import os
+
+from typing import Iterable, Optional
+
+from constants import *
+from batch import JobFailure
+from file_copy import atomic_output
+from manifest import Manifest, load_manifest_entries
+
+class PlanError(Exception):
+    """The plan needed to run a shard is missing, or was made for something else"""
+
+
+def write_plan(_input_image_dir : str, _output_image_dir : str, _command : list[str], \
+    _options : dict[str, str], _planned_jobs : Iterable[tuple[str, list[str]]]) -> int:
+    """
+    Saves the (input path, output paths) of every one of _planned_jobs in _output_image_dir,
+        along with the _command (its name and arguments) they are for, and those of its
+        _options which change its outputs (see get_planned_options()).
+    Paths are saved relative to the input and output directories, so the plan still works
+        where the shared directories are found somewhere else.
+    Returns the number of jobs planned.
+    """
+    jobs = [[os.path.relpath(input_path, _input_image_dir), \
+        [os.path.relpath(output_path, _output_image_dir) for output_path in output_paths]] \
+        for input_path, output_paths in _planned_jobs]
+
+    with atomic_output(os.path.join(_output_image_dir, PLAN_NAME)) as temp_path:
+        with open(temp_path, "w", encoding="utf-8") as plan_file:
+            json.dump({"version" : PLAN_VERSION, "command" : _command, \
+                "options" : get_planned_options(_options), "jobs" : jobs}, plan_file)
+    return len(jobs)
+
+
+def load_plan(_input_image_dir : str, _output_image_dir : str, _command : list[str], \
+    _options : Optional[dict[str, str]] = None) -> list[tuple[str, list[str]]]:
+    """
+    Returns the (input path, output paths) of every job planned in _output_image_dir.
+    Raises PlanError if there isn't a (current) plan for _command there, or if _options
+        (if given) change the outputs differently from the options the plan was made with.
+    """
+    plan_path = os.path.join(_output_image_dir, PLAN_NAME)
+    try:
+        with open(plan_path, encoding="utf-8") as plan_file:
+            plan = json.load(plan_file)
+    except (OSError, ValueError) as error:
+        raise PlanError(f"There is no readable plan at {plan_path} ({error})") from None
+
+    if plan.get("version") != PLAN_VERSION or plan["command"] != _command:
+        raise PlanError(f"The plan at {plan_path} was made for {' '.join(plan['command'])}, "
+            f"not {' '.join(_command)}")
+    if _options is not None and plan["options"] != get_planned_options(_options):
+        raise PlanError(f"The plan at {plan_path} was made with the options "
+            f"{format_options(plan['options'])}, "
+            f"not {format_options(get_planned_options(_options))}")
+
+    return [(os.path.join(_input_image_dir, input_path), \
+        [os.path.join(_output_image_dir, output_path) for output_path in output_paths]) \
+        for input_path, output_paths in plan["jobs"]]
+
+
+def get_planned_options(_options : dict[str, str]) -> dict[str, str]:
+    """
+    Returns those of _options which change a command's outputs (PLANNED_OPTIONS).
+    """
+    return {name : value for name, value in _options.items() if name in PLANNED_OPTIONS}
+
+
+def format_options(_options : dict[str, str]) -> str:
+    """
+    Returns _options as they would be given on the command line, or "(none)".
+    """
+    return " ".join(name if name in FLAG_OPTIONS else f"{name} {value}" \
+        for name, value in sorted(_options.items())) or "(none)"
+
+
+def check_planned_outputs(_planned_jobs : list[tuple[str, list[str]]], \
+    _outputs : Iterable[tuple[str, list[str]]]) -> None:
+    """
+    Raises PlanError if any of _planned_jobs would be saved somewhere other than the output
+        paths it was planned with, where _outputs are the (input path, output paths) that
+        the command works out for the same input paths, in the same order.
+    """
+    for (input_path, planned_paths), (_, output_paths) in zip(_planned_jobs, _outputs):
+        if [os.path.normpath(path) for path in planned_paths] != \
+            [os.path.normpath(path) for path in output_paths]:
+            raise PlanError(f"{input_path} was planned to be saved as "
+                f"{', '.join(planned_paths)}, but would be saved as {', '.join(output_paths)}")
+
+
+def get_shard(_planned_jobs : list, _shard_number : int, _num_shards : int) -> list:
+    """
+    Returns the _shard_number'th (counting from 1) of _num_shards slices of _planned_jobs.
+    Each slice is a run of neighbouring jobs, and the slices are as close to the same size
+        as they can be, so every machine gets the same slice however many times it's run.
+    """
+    start = len(_planned_jobs) * (_shard_number - 1) // _num_shards
+    end = len(_planned_jobs) * _shard_number // _num_shards
+    return _planned_jobs[start:end]
+
+
+def get_shard_manifest_name(_shard_number : int, _num_shards : int) -> str:
+    """
+    Returns the name of the manifest kept by one shard (see manifest.Manifest).
+    """
+    return SHARD_MANIFEST_NAME.format(_shard_number, _num_shards)
+
+
+def collect_shards(_input_image_dir : str, _output_image_dir : str, _command : list[str]) \
+    -> list[JobFailure]:
+    """
+    Adds the entries of every shard's manifest in _output_image_dir to its usual manifest
+        (and then removes the shards' manifests), so that later runs without --shard
+        know which outputs are up to date.
+    Returns the planned jobs which no shard has finished, i.e., whose outputs are missing
+        or aren't in any of the manifests.
+    Raises PlanError if there isn't a plan for _command in _output_image_dir.
+    """
+    planned_jobs = load_plan(_input_image_dir, _output_image_dir, _command)
+
+    manifest = Manifest(_output_image_dir, [])
+    shard_manifest_paths = sorted(glob.glob(os.path.join(glob.escape(_output_image_dir), \
+        get_shard_manifest_name("*", "*"))))
+    for shard_manifest_path in shard_manifest_paths:
+        manifest.entries.update(load_manifest_entries(shard_manifest_path))
+
+    failures = []
+    for input_path, output_paths in planned_jobs:
+        if not all(manifest.get_key(output_path) in manifest.entries and \
+            os.path.exists(output_path) for output_path in output_paths):
+            failures.append(JobFailure(input_path, "not finished by any shard"))
+
+    manifest.save()
+    for shard_manifest_path in shard_manifest_paths:
+        os.unlink(shard_manifest_path)
+    print(f"Collected {len(shard_manifest_paths)} shard manifests, covering "
+        f"{len(planned_jobs) - len(failures)} of {len(planned_jobs)} planned jobs")
+    return failures
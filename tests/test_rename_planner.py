@@ -0,0 +1,72 @@
+"""Tests that renaming never gives two images the same new name (see image_ops.RenamePlanner).
+
+e.g.,
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import *
+from image_ops import RenameError, RenamePlanner, check_rename_conflicts, rename_images
+
+class RenamePlannerTest(unittest.TestCase):
+    """The new names given to images, including alternative takes"""
+    def test_alternative_take_after_one_found_by_hash(self):
+        #PICT0007 looks like PICT0006 so takes the letter 'b', which PICT0009b would also take
+        planner = RenamePlanner("renamed/")
+        new_paths = [planner.plan("scans/PICT0006.JPG"), \
+            planner.plan("scans/PICT0007.JPG", "scans/PICT0006.JPG"), \
+            planner.plan("scans/PICT0009b.JPG"), planner.plan("scans/PICT0012.JPG")]
+
+        self.assertEqual(new_paths, ["renamed/PICT0001.JPG", "renamed/PICT0001b.JPG", \
+            "renamed/PICT0001c.JPG", "renamed/PICT0002.JPG"])
+
+    def test_alternative_take_before_one_found_by_hash(self):
+        planner = RenamePlanner("renamed/")
+        new_paths = [planner.plan("scans/PICT0006.JPG"), planner.plan("scans/PICT0006b.JPG"), \
+            planner.plan("scans/PICT0007.JPG", "scans/PICT0006.JPG")]
+
+        self.assertEqual(new_paths, ["renamed/PICT0001.JPG", "renamed/PICT0001b.JPG", \
+            "renamed/PICT0001c.JPG"])
+
+    def test_conflicting_renames_are_refused(self):
+        with self.assertRaises(RenameError):
+            check_rename_conflicts([("scans/PICT0007.JPG", "renamed/PICT0001b.JPG"), \
+                ("scans/PICT0009b.JPG", "renamed/PICT0001b.JPG")])
+
+    def test_rename_images_keeps_every_image(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_dir = os.path.join(temp_dir, "scans")
+            output_dir = os.path.join(temp_dir, "renamed") + os.sep
+            conflict_dir = os.path.join(temp_dir, "conflict") + os.sep
+            for directory in [input_dir, output_dir, conflict_dir]:
+                os.mkdir(directory)
+            input_paths = [os.path.join(input_dir, name) for name in \
+                ["PICT0006.JPG", "PICT0007.JPG", "PICT0009b.JPG", "PICT0012.JPG"]]
+            for seed, input_path in zip([1, 1, 2, 3], input_paths):
+                Image.effect_mandelbrot((64, 48), (-2 + seed / 4, -1, 1, 1), 100 * seed) \
+                    .convert("RGB").save(input_path)
+
+            #PICT0007 is a copy of PICT0006, so it's found to be an alternative take by its hash
+            failures = rename_images(input_paths, output_dir, 1, COPY_RENAME_MODE, \
+                _alternatives_mode=HASH_ALTERNATIVES)
+
+            self.assertEqual(failures, [])
+            self.assertEqual(sorted(os.listdir(output_dir)), sorted(["PICT0001.JPG", \
+                "PICT0001b.JPG", "PICT0001c.JPG", "PICT0002.JPG", MANIFEST_NAME]))
+
+            with self.assertRaises(RenameError):
+                rename_images(input_paths[1:3], conflict_dir, 1, COPY_RENAME_MODE, \
+                    _planned_renames=[(input_paths[1], conflict_dir + "PICT0001b.JPG"), \
+                    (input_paths[2], conflict_dir + "PICT0001b.JPG")])
+            self.assertFalse(os.path.exists(conflict_dir + "PICT0001b.JPG"))
+
+
+if __name__ == "__main__":
+    unittest.main()
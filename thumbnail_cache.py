@@ -0,0 +1,225 @@
+"""Keeps decoded, shrunken copies of images on disk, so that merging the same images again
+    (e.g., trying out different layouts for a roll) doesn't have to decode them all again.
+
+Each image is kept at the power-of-two fraction of its full size (1/2, 1/4, 1/8, ...) just
+    above the size it's needed at, as uncompressed pixels, and is shrunk the rest of the way
+    from there. So every merge which shrinks the images to between 1/4 and 1/2 of their size
+    (whatever its layout, tile size or width) shares the same copies.
+Copies are found by their image's path, file size and modification time, so an image which
+    has changed is decoded again.
+Once the copies take up more than the cache's size limit, the ones which were used least
+    recently are removed.
+
+e.g.,
+    cache = ThumbnailCache(get_thumbnail_cache_dir(), 1 << 30)
+    cached = cache.load("scans/PICT0001.JPG", 0.25, 1)
+    if cached is None:
+        ...decode it, and cache.store() it
+    cache.close()
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+from typing import Optional
+
+from PIL import Image
+
+from constants import *
+from file_copy import atomic_output
+
+def get_thumbnail_cache_dir() -> str:
+    """
+    Returns the directory the cache is kept in, within the user's cache directory
+        ($XDG_CACHE_HOME, or ~/.cache).
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), \
+        ".cache")
+    return os.path.join(cache_home, THUMBNAIL_CACHE_DIR_NAME)
+
+
+def get_cached_scale(_scale : float) -> Optional[float]:
+    """
+    Returns the scale an image which is being shrunk by _scale is kept in the cache at:
+        the smallest power-of-two fraction (1/2, 1/4, ...) which is at least _scale.
+    Returns None if the image isn't being shrunk to half its size or less, as a copy
+        that big would take about as long to read as the image itself.
+    """
+    if _scale > 0.5:
+        return None
+    return 2.0 ** -math.floor(math.log2(1 / _scale))
+
+
+class ThumbnailCache:
+    """
+    Shrunken copies of images kept in _cache_dir, taking up at most about _max_bytes.
+    Each copy's pixels are kept in a file of their own, and an index records what each
+        copy is, how big it is, and when it was last used.
+    If the cache can't be used (e.g., the directory can't be written to), nothing is
+        found in it, and nothing is kept.
+    """
+    def __init__(self, _cache_dir : str, _max_bytes : int) -> None:
+        self.cache_dir = _cache_dir
+        self.max_bytes = _max_bytes
+        #When each copy that has been used or added since the index was last updated was used
+        self.used_keys = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self.connection = None
+        try:
+            os.makedirs(_cache_dir, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(_cache_dir, THUMBNAIL_CACHE_INDEX_NAME), \
+                timeout=THUMBNAIL_CACHE_LOCK_TIMEOUT)
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS thumbnails (key TEXT PRIMARY "
+                    "KEY, mode TEXT, width INTEGER, height INTEGER, full_width INTEGER, "
+                    "full_height INTEGER, file_size INTEGER, last_used REAL)")
+            self.total_bytes = self.connection.execute( \
+                "SELECT COALESCE(SUM(file_size), 0) FROM thumbnails").fetchone()[0]
+        except (OSError, sqlite3.Error) as error:
+            debug(f"Not using the thumbnail cache in {_cache_dir} ({error})")
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close()
+
+    def get_key(self, _image_path : str, _scale : float, _orientation : Optional[int]) -> str:
+        """
+        Returns the name of the copy of _image_path, shrunk by _scale and rotated according
+            to _orientation, as it is now (i.e., its current file size and modification time).
+        """
+        file_stats = os.stat(_image_path)
+        return hashlib.sha1(f"{os.path.abspath(_image_path)}\0{file_stats.st_size}\0"
+            f"{file_stats.st_mtime_ns}\0{_scale!r}\0{_orientation}".encode("utf-8")).hexdigest()
+
+    def get_path(self, _key : str) -> str:
+        """
+        Returns the path of the file holding the pixels of the copy named _key.
+        """
+        return os.path.join(self.cache_dir, _key + THUMBNAIL_CACHE_EXTENSION)
+
+    def contains(self, _image_path : str, _scale : float, _orientation : Optional[int]) -> bool:
+        """
+        Returns True if there is an up to date copy of _image_path (see get_key()).
+        """
+        if self.connection is None:
+            return False
+        try:
+            return self.connection.execute("SELECT 1 FROM thumbnails WHERE key = ?", \
+                (self.get_key(_image_path, _scale, _orientation),)).fetchone() is not None
+        except (OSError, sqlite3.Error):
+            return False
+
+    def load(self, _image_path : str, _scale : float, _orientation : Optional[int]) \
+        -> Optional[tuple[Image.Image, tuple[int,int]]]:
+        """
+        Returns the copy of _image_path (see get_key()), along with the (width, height) the
+            image has at full size once rotated, or None if there isn't an up to date copy.
+        """
+        if self.connection is None:
+            return None
+        try:
+            key = self.get_key(_image_path, _scale, _orientation)
+            row = self.connection.execute("SELECT mode, width, height, full_width, full_height "
+                "FROM thumbnails WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                with open(self.get_path(key), "rb") as cached_file:
+                    image_object = Image.frombytes(row[0], (row[1], row[2]), cached_file.read())
+                self.used_keys[key] = time.time()
+                self.num_hits += 1
+                return image_object, (row[3], row[4])
+        except (OSError, ValueError, sqlite3.Error) as error:
+            #e.g., the file was removed, or another merge is still writing it
+            debug(f"Couldn't load the cached copy of {_image_path} ({error})")
+
+        self.num_misses += 1
+        return None
+
+    def store(self, _image_path : str, _scale : float, _orientation : Optional[int], \
+        _image_object : Image.Image, _full_size : tuple[int,int]) -> None:
+        """
+        Keeps _image_object as the copy of _image_path (see get_key()), whose (width, height)
+            at full size once rotated is _full_size, removing the least recently used
+            copies if the cache has grown too big.
+        Images in modes which can't be stored as plain pixels (e.g., with a palette) aren't kept.
+        """
+        if self.connection is None or _image_object.mode not in THUMBNAIL_CACHE_MODES:
+            return
+        try:
+            key = self.get_key(_image_path, _scale, _orientation)
+            pixels = _image_object.tobytes()
+            with atomic_output(self.get_path(key)) as temp_path:
+                with open(temp_path, "wb") as cached_file:
+                    cached_file.write(pixels)
+            with self.connection:
+                #A copy which is stored again replaces the old one, rather than adding to it
+                replaced = self.connection.execute("SELECT file_size FROM thumbnails "
+                    "WHERE key = ?", (key,)).fetchone()
+                self.connection.execute("INSERT OR REPLACE INTO thumbnails VALUES "
+                    "(?,?,?,?,?,?,?,?)", (key, _image_object.mode, *_image_object.size, \
+                    *_full_size, len(pixels), time.time()))
+            self.total_bytes += len(pixels) - (0 if replaced is None else replaced[0])
+        except (OSError, sqlite3.Error) as error:
+            debug(f"Couldn't cache a copy of {_image_path} ({error})")
+            return
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used copies until the cache is within its size limit.
+        """
+        self.save_used_keys()
+        try:
+            self.total_bytes = self.connection.execute( \
+                "SELECT COALESCE(SUM(file_size), 0) FROM thumbnails").fetchone()[0]
+            evicted_keys = []
+            for key, file_size in self.connection.execute("SELECT key, file_size FROM "
+                "thumbnails ORDER BY last_used"):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted_keys.append((key,))
+                self.total_bytes -= file_size
+
+            with self.connection:
+                self.connection.executemany("DELETE FROM thumbnails WHERE key = ?", evicted_keys)
+            for (key,) in evicted_keys:
+                try:
+                    os.unlink(self.get_path(key))
+                except FileNotFoundError:
+                    pass
+        except (OSError, sqlite3.Error) as error:
+            debug(f"Couldn't shrink the thumbnail cache in {self.cache_dir} ({error})")
+
+    def save_used_keys(self) -> None:
+        """
+        Records when each copy which has been used since this was last called was used.
+        """
+        if self.connection is None or not self.used_keys:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany("UPDATE thumbnails SET last_used = ? WHERE key = ?", \
+                    [(last_used, key) for key, last_used in self.used_keys.items()])
+        except sqlite3.Error as error:
+            debug(f"Couldn't update the thumbnail cache in {self.cache_dir} ({error})")
+        self.used_keys = {}
+
+    def close(self) -> None:
+        """
+        Records which copies were used, and closes the index.
+        """
+        if self.connection is None:
+            return
+        self.save_used_keys()
+        self.connection.close()
+        self.connection = None
+        debug(f"Found {self.num_hits} of {self.num_hits + self.num_misses} images "
+            f"in the thumbnail cache")
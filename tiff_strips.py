@@ -0,0 +1,530 @@
+"""Works on large uncompressed or deflate ("ZIP") compressed TIFFs (e.g., 16-bit film scans of
+    100-300 MB) a strip of rows at a time, so that only a few strips are ever in memory,
+    however big the scan is.
+
+The input file is memory-mapped, so each strip of rows is read straight from it (and let go of
+    again) as it's needed, and each finished strip is written straight to the output file,
+    uncompressed. Compressed rows are decompressed a few at a time as they're read.
+Bit depth (8 or 16 bits per channel), alpha channels and the input's tags (resolution, ICC
+    profile, EXIF, orientation, ...) are kept as they are.
+TIFFs with other compression (e.g., LZW), tiles and other unusual TIFFs are left to Pillow,
+    which decodes them in full.
+
+e.g.,
+    if not transform_tiff("scans/PICT0001.TIF", "out/PICT0001.TIF", [(NEGATIVE_COMMAND, None)]):
+        ...decode it with Pillow instead
+"""
+import mmap
+import os
+import struct
+import zlib
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image, TiffImagePlugin, TiffTags
+
+from constants import *
+import instrumentation
+from instrumentation import timed
+from file_copy import atomic_output
+from negative_engine import NegativeSettings, make_negative_tables
+
+#TIFF tags which are read to find the pixel data
+IMAGE_WIDTH_TAG = 256
+IMAGE_LENGTH_TAG = 257
+BITS_PER_SAMPLE_TAG = 258
+COMPRESSION_TAG = 259
+PHOTOMETRIC_TAG = 262
+STRIP_OFFSETS_TAG = 273
+SAMPLES_PER_PIXEL_TAG = 277
+ROWS_PER_STRIP_TAG = 278
+STRIP_BYTE_COUNTS_TAG = 279
+PLANAR_CONFIGURATION_TAG = 284
+PREDICTOR_TAG = 317
+TILE_OFFSETS_TAG = 324
+SAMPLE_FORMAT_TAG = 339
+
+#Tags which describe how the pixel data is stored, so aren't copied to the output as they are
+LAYOUT_TAGS = [IMAGE_WIDTH_TAG, IMAGE_LENGTH_TAG, COMPRESSION_TAG, STRIP_OFFSETS_TAG, \
+    ROWS_PER_STRIP_TAG, STRIP_BYTE_COUNTS_TAG, 288, 289, PREDICTOR_TAG, 322, 323, \
+    TILE_OFFSETS_TAG, 325, 330, 347]
+#Tags which point to a separate directory of EXIF or GPS tags, which are copied in full
+SUB_DIRECTORY_TAGS = [0x8769, 0x8825]
+#The EXIF tag pointing to the interoperability directory, which isn't copied
+INTEROP_TAG = 0xA005
+
+UNCOMPRESSED = 1
+#Deflate compression, under both its standard and its older (Adobe) tag value
+DEFLATE_COMPRESSIONS = [8, 32946]
+NO_PREDICTOR = 1
+#Each value is stored as the difference from the one to its left in the same channel
+HORIZONTAL_PREDICTOR = 2
+#How much of a compressed strip is given to the decompressor at once
+DEFLATE_CHUNK_BYTES = 1 << 16
+#PhotometricInterpretation: how many of each pixel's values are colours (the rest are alpha)
+MAP_PHOTOMETRIC_TO_COLOUR_SAMPLES = {
+    1 : 1, #greyscale, with 0 as black
+    2 : 3, #RGB
+}
+MAP_BITS_TO_MAX_VALUE = {8 : EIGHT_BIT_MAX, 16 : SIXTEEN_BIT_MAX}
+
+#Offsets in a (non-Big) TIFF are 32-bit
+MAX_TIFF_SIZE = (1 << 32) - 1
+TIFF_HEADER_SIZE = 8
+
+class TiffLayout(NamedTuple):
+    """Where a TIFF's pixels are in its file, and how they're stored"""
+    size : tuple[int,int]
+    #How many values each pixel has (e.g., 4 for RGBA), and how many of those are colours
+    samples_per_pixel : int
+    colour_samples : int
+    #The type of each value, in the file's byte order (e.g., big-endian 16-bit)
+    dtype : np.dtype
+    #The (offset in the file, number of bytes, number of rows) of each strip of rows
+    strips : tuple[tuple[int,int,int], ...]
+    #b"II" for a little-endian file, b"MM" for a big-endian one
+    byte_order : bytes
+    #Every tag in the file's first directory, with any EXIF/GPS directories as dicts
+    tags : dict[int, tuple[int, object]]
+    #How the strips are compressed (UNCOMPRESSED or one of DEFLATE_COMPRESSIONS), and
+    #   whether their values are differences (HORIZONTAL_PREDICTOR)
+    compression : int = UNCOMPRESSED
+    predictor : int = NO_PREDICTOR
+
+    @property
+    def max_value(self) -> int:
+        """The brightest value a pixel's channel can have"""
+        return MAP_BITS_TO_MAX_VALUE[self.dtype.itemsize * 8]
+
+    @property
+    def row_bytes(self) -> int:
+        """How many bytes each row of pixels takes up"""
+        return self.size[0] * self.samples_per_pixel * self.dtype.itemsize
+
+
+def is_tiff_path(_image_path : str) -> bool:
+    """
+    Returns True if _image_path has a TIFF file extension (in any case).
+    """
+    return os.path.splitext(_image_path)[1].lower() in TIFF_EXTENSIONS
+
+
+def read_tiff_layout(_image_path : str) -> Optional[TiffLayout]:
+    """
+    Reads the tags of the TIFF at _image_path, without decoding it.
+    Returns where its pixels are and how they're stored, or None if they can't be read
+        a strip at a time (e.g., they're LZW compressed or in tiles).
+    """
+    with Image.open(_image_path) as image_object:
+        if image_object.format != "TIFF":
+            return None
+        tags = image_object.tag_v2
+
+        bits = set(get_tag_values(tags, BITS_PER_SAMPLE_TAG, 1))
+        colour_samples = MAP_PHOTOMETRIC_TO_COLOUR_SAMPLES.get(tags.get(PHOTOMETRIC_TAG))
+        samples_per_pixel = tags.get(SAMPLES_PER_PIXEL_TAG, 1)
+        compression = tags.get(COMPRESSION_TAG, UNCOMPRESSED)
+        predictor = tags.get(PREDICTOR_TAG, NO_PREDICTOR)
+        if compression not in [UNCOMPRESSED] + DEFLATE_COMPRESSIONS or \
+            predictor not in [NO_PREDICTOR, HORIZONTAL_PREDICTOR] or \
+            (compression == UNCOMPRESSED and predictor != NO_PREDICTOR) or \
+            TILE_OFFSETS_TAG in tags or STRIP_OFFSETS_TAG not in tags or \
+            tags.get(PLANAR_CONFIGURATION_TAG, 1) != 1 or \
+            set(get_tag_values(tags, SAMPLE_FORMAT_TAG, 1)) != {1} or \
+            len(bits) != 1 or bits.isdisjoint(MAP_BITS_TO_MAX_VALUE) or \
+            colour_samples is None or samples_per_pixel < colour_samples:
+            return None
+
+        byte_order = tags.prefix
+        dtype = np.dtype(f"{'<' if byte_order == TiffImagePlugin.II else '>'}u{bits.pop() // 8}")
+        #Pillow reports the size once the image has been turned the right way up
+        width, height = tags[IMAGE_WIDTH_TAG], tags[IMAGE_LENGTH_TAG]
+        rows_per_strip = min(tags.get(ROWS_PER_STRIP_TAG, height), height)
+        row_bytes = width * samples_per_pixel * dtype.itemsize
+        strips = []
+        for strip_index, (offset, byte_count) in enumerate(zip( \
+            get_tag_values(tags, STRIP_OFFSETS_TAG), get_tag_values(tags, STRIP_BYTE_COUNTS_TAG))):
+            num_rows = min(rows_per_strip, height - strip_index * rows_per_strip)
+            if num_rows <= 0:
+                break
+            #e.g., a truncated file, which Pillow reports more helpfully
+            if compression == UNCOMPRESSED and byte_count < num_rows * row_bytes:
+                return None
+            strips.append((offset, byte_count, num_rows))
+        if sum(num_rows for _offset, _byte_count, num_rows in strips) != height:
+            return None
+
+        copied_tags = {tag : (tags.tagtype[tag], value) for tag, value in tags.items() \
+            if tag not in LAYOUT_TAGS and tag not in SUB_DIRECTORY_TAGS}
+        exif = image_object.getexif()
+        for tag in SUB_DIRECTORY_TAGS:
+            sub_directory = {sub_tag : value for sub_tag, value in exif.get_ifd(tag).items() \
+                if sub_tag != INTEROP_TAG}
+            if sub_directory:
+                copied_tags[tag] = (TiffTags.LONG, sub_directory)
+
+    return TiffLayout((width, height), samples_per_pixel, colour_samples, dtype, tuple(strips), \
+        byte_order, copied_tags, compression, predictor)
+
+
+def get_tag_values(_tags : TiffImagePlugin.ImageFileDirectory_v2, _tag : int, \
+    _default : Optional[int] = None) -> tuple:
+    """
+    Returns the values of _tag in _tags as a tuple, even if there is only one of them,
+        or (_default,) if it isn't there.
+    """
+    values = _tags.get(_tag, _default)
+    return values if isinstance(values, tuple) else (values,)
+
+
+class TiffStripReader:
+    """
+    Reads rows of a TIFF (see read_tiff_layout()) from a memory map of its file.
+    The memory holding each row is let go of once it has been read, so reading through the
+        whole file never needs more than a few strips of memory.
+    Compressed strips are decompressed only as far as the rows being read, so a strip of
+        any size can be read a few rows at a time, as long as the rows are read in order.
+
+    e.g.,
+        with TiffStripReader("scan.tif", layout) as reader:
+            top_rows = reader.read_rows(0, 100)
+    """
+    def __init__(self, _path : str, _layout : TiffLayout) -> None:
+        self.layout = _layout
+        self.file = open(_path, "rb") #pylint: disable=consider-using-with
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.file.close()
+            raise
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+        #The row each strip starts at
+        self.strip_tops = np.cumsum([0] + [num_rows for _offset, _byte_count, num_rows \
+            in _layout.strips])
+        #The compressed strip being read: its index, its decompressor, how many of its bytes
+        #   have been given to the decompressor, and the row the decompressor has got to
+        self.decompressing = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Unmaps and closes the file.
+        """
+        self.map.close()
+        self.file.close()
+
+    def read_rows(self, _top : int, _bottom : int) -> np.ndarray:
+        """
+        Returns a copy of rows _top to _bottom (not included), as an array of shape
+            (rows, width, samples per pixel), in the machine's byte order.
+        """
+        width, samples_per_pixel = self.layout.size[0], self.layout.samples_per_pixel
+        if _bottom <= _top:
+            return np.empty((0, width, samples_per_pixel), self.layout.dtype.newbyteorder("="))
+
+        row_bytes = self.layout.row_bytes
+        parts = []
+        first_strip = int(np.searchsorted(self.strip_tops, _top, side="right")) - 1
+        for strip_index in range(max(first_strip, 0), len(self.layout.strips)):
+            strip_top = int(self.strip_tops[strip_index])
+            if strip_top >= _bottom:
+                break
+            offset, _byte_count, num_rows = self.layout.strips[strip_index]
+            first_row = max(_top - strip_top, 0)
+            last_row = min(_bottom - strip_top, num_rows)
+            if self.layout.compression != UNCOMPRESSED:
+                parts.append(self.read_compressed_rows(strip_index, first_row, last_row))
+                continue
+
+            start = offset + first_row * row_bytes
+            strip = np.frombuffer(self.map, self.layout.dtype, \
+                (last_row - first_row) * width * samples_per_pixel, start)
+            parts.append(strip.reshape(-1, width, samples_per_pixel).astype( \
+                self.layout.dtype.newbyteorder("=")))
+            del strip
+            self.release(start, (last_row - first_row) * row_bytes)
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def read_compressed_rows(self, _strip_index : int, _first_row : int, _last_row : int) \
+        -> np.ndarray:
+        """
+        Returns rows _first_row to _last_row (not included) of the compressed strip
+            _strip_index, counted from the top of the strip, as read_rows() does.
+        The strip is only decompressed from its start again if rows before those last read
+            from it are wanted.
+        """
+        if self.decompressing is None or self.decompressing[0] != _strip_index or \
+            self.decompressing[3] > _first_row:
+            self.decompressing = [_strip_index, zlib.decompressobj(), 0, 0]
+        #Any rows before the wanted ones are decompressed and let go of a bit at a time
+        skipped_rows = max(1, TIFF_STRIP_BYTES // self.layout.row_bytes)
+        while self.decompressing[3] < _first_row:
+            self.decompress_rows(min(_first_row - self.decompressing[3], skipped_rows))
+
+        width, samples_per_pixel = self.layout.size[0], self.layout.samples_per_pixel
+        rows = np.frombuffer(self.decompress_rows(_last_row - _first_row), self.layout.dtype) \
+            .reshape(-1, width, samples_per_pixel).astype(self.layout.dtype.newbyteorder("="))
+        if self.layout.predictor == HORIZONTAL_PREDICTOR:
+            #Each row's differences add up to its values (wrapping around, as they were made)
+            np.cumsum(rows, axis=1, dtype=rows.dtype, out=rows)
+        return rows
+
+    def decompress_rows(self, _num_rows : int) -> bytearray:
+        """
+        Returns the next _num_rows rows of the strip being decompressed, as bytes.
+        Raises ValueError if the strip's data runs out first.
+        """
+        strip_index, decompressor, bytes_read, next_row = self.decompressing
+        offset, byte_count, _strip_rows = self.layout.strips[strip_index]
+        wanted_bytes = _num_rows * self.layout.row_bytes
+        data = bytearray()
+        while len(data) < wanted_bytes:
+            compressed = decompressor.unconsumed_tail
+            if not compressed:
+                if decompressor.eof or bytes_read >= byte_count:
+                    raise ValueError(f"Strip {strip_index} of the TIFF has too few rows")
+                start = offset + bytes_read
+                compressed = self.map[start : offset + min(bytes_read + DEFLATE_CHUNK_BYTES, \
+                    byte_count)]
+                bytes_read += len(compressed)
+                self.release(start, len(compressed))
+            data += decompressor.decompress(compressed, wanted_bytes - len(data))
+
+        self.decompressing = [strip_index, decompressor, bytes_read, next_row + _num_rows]
+        return data
+
+    def release(self, _start : int, _length : int) -> None:
+        """
+        Lets go of the memory holding _length bytes of the file from _start, which will be
+            read again (usually from the page cache) if they're needed again.
+        """
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        page_start = _start - _start % mmap.PAGESIZE
+        self.map.madvise(mmap.MADV_DONTNEED, page_start, _start + _length - page_start)
+
+
+class TiffStreamWriter:
+    """
+    Writes an uncompressed TIFF of a known size, with its rows supplied in order as a series
+        of arrays of shape (rows, width, samples per pixel).
+    The pixels are stored in the same way as _layout's (i.e., bit depth, channels and byte
+        order), with a copy of its tags (see read_tiff_layout()).
+    Only the rows being written are kept in memory.
+    If anything goes wrong, the file is closed without being finished.
+
+    e.g.,
+        with TiffStreamWriter("out.tif", (100, 200), layout) as writer:
+            writer.write_rows(top_half)
+            writer.write_rows(bottom_half)
+    """
+    def __init__(self, _path : str, _size : tuple[int,int], _layout : TiffLayout) -> None:
+        self.size = _size
+        self.layout = _layout
+        self.rows_written = 0
+
+        self.file = open(_path, "wb") #pylint: disable=consider-using-with
+        try:
+            self.write_header()
+        except BaseException:
+            self.file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exception_type, _exception, _traceback) -> None:
+        self.close(_exception_type is None)
+
+    def write_header(self) -> None:
+        """
+        Writes the TIFF header and its directory of tags, which comes before the pixels.
+        The pixels are written in strips of roughly TIFF_STRIP_BYTES.
+        """
+        width, height = self.size
+        row_bytes = width * self.layout.samples_per_pixel * self.layout.dtype.itemsize
+        rows_per_strip = max(1, min(height, TIFF_STRIP_BYTES // row_bytes))
+        strip_byte_counts = [min(rows_per_strip, height - top) * row_bytes \
+            for top in range(0, height, rows_per_strip)]
+
+        directory = TiffImagePlugin.ImageFileDirectory_v2(prefix=self.layout.byte_order)
+        for tag, (tag_type, value) in self.layout.tags.items():
+            directory.tagtype[tag] = tag_type
+            directory[tag] = value
+        for tag, value in [(IMAGE_WIDTH_TAG, width), (IMAGE_LENGTH_TAG, height), \
+            (COMPRESSION_TAG, UNCOMPRESSED), (ROWS_PER_STRIP_TAG, rows_per_strip), \
+            (STRIP_BYTE_COUNTS_TAG, tuple(strip_byte_counts)), \
+            #Offsets from the end of the directory, which Pillow turns into offsets in the file
+            (STRIP_OFFSETS_TAG, tuple(np.cumsum([0] + strip_byte_counts[:-1]).tolist()))]:
+            directory.tagtype[tag] = TiffTags.LONG
+            directory[tag] = value
+
+        byte_order = "<" if self.layout.byte_order == TiffImagePlugin.II else ">"
+        directory_data = directory.tobytes(TIFF_HEADER_SIZE)
+        if TIFF_HEADER_SIZE + len(directory_data) + sum(strip_byte_counts) > MAX_TIFF_SIZE:
+            raise ValueError(f"A {width}x{height} image is too big for a TIFF")
+        self.file.write(self.layout.byte_order + struct.pack(f"{byte_order}HI", 42, \
+            TIFF_HEADER_SIZE))
+        self.file.write(directory_data)
+
+    def write_rows(self, _rows : np.ndarray) -> None:
+        """
+        Writes out all of _rows, which are placed directly below any rows that have
+            already been written.
+        """
+        if _rows.shape[1:] != (self.size[0], self.layout.samples_per_pixel):
+            raise ValueError(f"Rows of shape {_rows.shape} don't fit a TIFF of {self.size}")
+        if self.rows_written + _rows.shape[0] > self.size[1]:
+            raise ValueError("Too many rows have been written to the TIFF")
+
+        self.file.write(np.ascontiguousarray(_rows, self.layout.dtype).data)
+        self.rows_written += _rows.shape[0]
+
+    def close(self, _finish : bool = True) -> None:
+        """
+        Closes the file, checking that every row was written unless _finish is False
+            (e.g., after an error).
+        """
+        if self.file.closed:
+            return
+        try:
+            if _finish and self.rows_written != self.size[1]:
+                raise ValueError(f"Only {self.rows_written} of the TIFF's "
+                    f"{self.size[1]} rows were written")
+        finally:
+            self.file.close()
+
+
+def get_strip_stages(_stages : list[tuple]) \
+    -> Optional[tuple[Optional[NegativeSettings], Optional[tuple[int,int,int]]]]:
+    """
+    Returns the (negative settings, pad colour) which _stages (see image_ops.apply_stages())
+        come down to, with None for a stage which isn't there.
+    Returns None if they can't be done a strip at a time: a negative after padding is
+        sampled from the padding too, so needs the whole padded image.
+    """
+    negative_settings = pad_colour = None
+    for stage in _stages:
+        if stage[0] == NEGATIVE_COMMAND:
+            if pad_colour is not None or negative_settings is not None:
+                return None
+            negative_settings = (stage[1:] and stage[1]) or NegativeSettings()
+        elif stage[0] == PADDING_COMMAND:
+            #Padding an image which is already square does nothing
+            pad_colour = pad_colour or stage[1]
+        else:
+            return None
+
+    return negative_settings, pad_colour
+
+
+def transform_tiff(_input_image_path : str, _output_image_path : str, _stages : list[tuple]) \
+    -> bool:
+    """
+    Puts the TIFF at _input_image_path through _stages (see image_ops.apply_stages()) a strip
+        of rows at a time, and saves it to _output_image_path (see atomic_output()).
+    Unlike decoding it with Pillow, 16-bit images stay 16-bit, alpha channels are kept,
+        and the EXIF orientation is kept as a tag rather than by rotating the pixels.
+        The output is uncompressed.
+    Returns False (having done nothing) if the image can't be worked on this way, e.g., it
+        isn't a TIFF read_tiff_layout() can read, in which case it should be decoded in full
+        instead.
+    """
+    strip_stages = get_strip_stages(_stages)
+    if strip_stages is None or not is_tiff_path(_input_image_path) or \
+        not is_tiff_path(_output_image_path):
+        return False
+    layout = read_tiff_layout(_input_image_path)
+    if layout is None:
+        return False
+    negative_settings, pad_colour = strip_stages
+
+    #Padding centres the image in a square (see image_ops.pad_image_object())
+    width, height = layout.size
+    output_size = (max(layout.size), max(layout.size)) if pad_colour else layout.size
+    x_offset, y_offset = (output_size[0] - width) // 2, (output_size[1] - height) // 2
+    pad_values = None if pad_colour is None else get_pad_values(pad_colour, layout)
+
+    strip_rows = max(1, TIFF_STRIP_BYTES // layout.row_bytes)
+    with TiffStripReader(_input_image_path, layout) as reader:
+        tables = None
+        if negative_settings is not None:
+            sample = None
+            if negative_settings.film_base is not None:
+                with timed("transform"):
+                    sample = sample_colours(reader, strip_rows)
+            tables = make_negative_tables(sample, negative_settings, layout.colour_samples, \
+                layout.max_value)
+
+        with atomic_output(_output_image_path) as temp_path, \
+            TiffStreamWriter(temp_path, output_size, layout) as writer:
+            for top in range(0, output_size[1], strip_rows):
+                bottom = min(top + strip_rows, output_size[1])
+                input_top = min(max(top - y_offset, 0), height)
+                input_bottom = min(max(bottom - y_offset, 0), height)
+                with timed("decode"):
+                    rows = reader.read_rows(input_top, input_bottom)
+
+                with timed("transform"):
+                    if tables is not None:
+                        for band_index, table in enumerate(tables):
+                            rows[..., band_index] = table[rows[..., band_index]]
+                    if pad_values is not None:
+                        padded_rows = np.empty((bottom - top, output_size[0], \
+                            layout.samples_per_pixel), rows.dtype)
+                        padded_rows[...] = pad_values
+                        padded_rows[input_top + y_offset - top : input_bottom + y_offset - top, \
+                            x_offset : x_offset + width] = rows
+                        rows = padded_rows
+
+                with timed("write"):
+                    writer.write_rows(rows)
+
+    if instrumentation.ENABLED:
+        instrumentation.count_bytes("in", os.path.getsize(_input_image_path))
+        instrumentation.count_bytes("out", os.path.getsize(_output_image_path))
+    return True
+
+
+def get_pad_values(_pad_colour : tuple[int,int,int], _layout : TiffLayout) -> np.ndarray:
+    """
+    Returns the value of each of a pixel's samples for the 8-bit _pad_colour, in an image
+        stored as _layout describes (e.g., 16-bit greyscale), with any alpha fully opaque.
+    """
+    colour = np.array(_pad_colour, dtype=np.float64)
+    if _layout.colour_samples == 1:
+        colour = colour.mean(keepdims=True)
+    values = np.full(_layout.samples_per_pixel, _layout.max_value, dtype=np.float64)
+    values[:_layout.colour_samples] = colour * _layout.max_value / EIGHT_BIT_MAX
+    return np.rint(values).astype(_layout.dtype.newbyteorder("="))
+
+
+def sample_colours(_reader : TiffStripReader, _strip_rows : int) -> np.ndarray:
+    """
+    Returns a shrunken copy of the colour channels of the image _reader reads, as an array
+        of shape (pixels, channels), like negative_engine.get_sample() does for a decoded image.
+    Blocks of pixels are averaged, a few strips at a time.
+    """
+    layout = _reader.layout
+    width, height = layout.size
+    factor = max(1, int((width * height / NEGATIVE_SAMPLE_PIXELS) ** 0.5))
+    sample_width = width // factor
+    #Every strip holds a whole number of blocks
+    strip_rows = max(1, _strip_rows // factor) * factor
+    sample = []
+    for top in range(0, height - height % factor, strip_rows):
+        rows = _reader.read_rows(top, min(top + strip_rows, height - height % factor))
+        blocks = rows[:, :sample_width * factor, :layout.colour_samples].reshape( \
+            rows.shape[0] // factor, factor, sample_width, factor, layout.colour_samples)
+        sample.append(blocks.mean(axis=(1, 3)).reshape(-1, layout.colour_samples))
+
+    return np.concatenate(sample)
@@ -0,0 +1,124 @@
+"""Works on images as they arrive in a directory (e.g., from a scanner working through a roll
+    of film over several hours), rather than waiting for the whole batch to be there.
+
+The directory is checked every WATCH_POLL_INTERVAL seconds. An image is ready once its size
+    and modification time have stayed the same for WATCH_SETTLE_TIME seconds, so images which
+    are still being written are left alone. Every image which has become ready since the last
+    batch is put in the next one (up to a limit), so that a burst of new images is worked on
+    together, while a single new image is worked on within a few seconds of arriving.
+"""
+import os
+import threading
+import time
+
+from typing import Callable, Optional
+
+from constants import *
+from batch import JobFailure
+from folder_scan import iter_folder_images
+
+class FolderWatcher:
+    """
+    Keeps track of the images in a directory, and hands out each one once it has finished
+        being written, and again whenever it is changed.
+    If _in_order is True, images are only handed out in (natural) order, so a ready image
+        waits for any image before it which is still being written.
+
+    e.g.,
+        watcher = FolderWatcher("scans/")
+        while True:
+            for image_path in watcher.take_ready_images(8):
+                ...
+    """
+    def __init__(self, _dir_name : str, _recursive : bool = False, _in_order : bool = False, \
+        _settle_time : float = WATCH_SETTLE_TIME) -> None:
+        self.dir_name = _dir_name
+        self.recursive = _recursive
+        self.in_order = _in_order
+        self.settle_time = _settle_time
+        #The (size, modification time) of each image, and when it was last seen to change
+        self.changes = {}
+        #The (size, modification time) of each image when it was last handed out
+        self.taken = {}
+
+    def scan(self) -> list[str]:
+        """
+        Notes any images which have appeared, changed or gone since the last scan.
+        Returns the paths of the images in the directory, in natural order.
+        """
+        now = time.time()
+        image_paths = []
+        changes = {}
+        for image_path in iter_folder_images(self.dir_name, self.recursive):
+            try:
+                file_stats = os.stat(image_path)
+            except OSError:
+                #It was removed (or renamed) since the directory was read
+                continue
+            signature = (file_stats.st_size, file_stats.st_mtime_ns)
+
+            previous = self.changes.get(image_path)
+            if previous is None:
+                #An image which was already there when watching began can be ready straight away
+                changes[image_path] = (signature, min(now, file_stats.st_mtime_ns / 1e9))
+            elif previous[0] != signature:
+                changes[image_path] = (signature, now)
+            else:
+                changes[image_path] = previous
+            image_paths.append(image_path)
+
+        self.changes = changes
+        return image_paths
+
+    def is_ready(self, _image_path : str) -> bool:
+        """
+        Returns True if _image_path isn't empty, and hasn't changed for the settle time.
+        """
+        signature, changed_at = self.changes[_image_path]
+        return signature[0] > 0 and time.time() - changed_at >= self.settle_time
+
+    def take_ready_images(self, _max_images : int) -> list[str]:
+        """
+        Returns up to _max_images images which have finished being written since they
+            were last handed out (or which haven't been handed out before), in natural order.
+        """
+        ready_paths = []
+        for image_path in self.scan():
+            if len(ready_paths) >= _max_images:
+                break
+            if self.taken.get(image_path) == self.changes[image_path][0]:
+                continue
+            if self.is_ready(image_path):
+                ready_paths.append(image_path)
+                self.taken[image_path] = self.changes[image_path][0]
+            elif self.in_order:
+                break
+
+        return ready_paths
+
+
+def watch_folder(_dir_name : str, _run_batch : Callable[[list[str]], list[JobFailure]], \
+    _max_batch : int, _recursive : bool = False, _in_order : bool = False, \
+    _stop : Optional[threading.Event] = None) -> list[JobFailure]:
+    """
+    Calls _run_batch with the paths of each batch of (at most _max_batch) images which are
+        ready in _dir_name (see FolderWatcher), until interrupted, or until _stop is set.
+    Returns the images which could not be processed, across every batch.
+    """
+    watcher = FolderWatcher(_dir_name, _recursive, _in_order)
+    stopping = _stop or threading.Event()
+    failures = []
+    print(f"Watching {_dir_name} for new images (press Ctrl+C to stop)")
+    try:
+        while not stopping.is_set():
+            image_paths = watcher.take_ready_images(_max_batch)
+            if image_paths:
+                print(f"Working on {len(image_paths)} new images")
+                failures += _run_batch(image_paths)
+            #Only wait when there's nothing left to do, so a backlog is worked through straight away
+            else:
+                stopping.wait(WATCH_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print(f"Stopped watching {_dir_name}")
+
+    return failures